@@ -13,16 +13,21 @@
                 执行单个报警算法 (以插件形式存在)
 '''
 
+import collections
 import datetime
 import dateutil
-import importlib
+import hashlib
 import jqdatasdk
 import json
+import numpy as np
 import os
 import pandas as pd
+import queue
 import re
 import schedule
+import signal
 import sqlalchemy
+import sys
 import threading
 import time
 import vlc
@@ -34,7 +39,15 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import Session
 
 # our apps
+import indicator_cache
+import kline_store
+import notify
+import plugin_budget
+import plugin_registry
 import settings as settings
+import snapshot
+import trading_calendar
+from feed import SocketFeed
 
 __version__ = 1.3
 
@@ -81,6 +94,85 @@ def to_csv_mt5(df, f_name=None, write_mode='w'):
             )
 
 
+def get_aligned_bars(arr_obj_stock, period, n_bars=None):
+    ''' 多个股票的k线数据，按时间对齐 (报警算法的批量接口)
+    入口参数:
+        arr_obj_stock       [SingleStockInfo(), ...]
+        period              k线周期
+        n_bars              每个股票最近的k线数量，None: 全部
+    返回值: dict
+        arr_stock_code      股票代码 [stock_code, ...]
+        index               k线时间 (所有股票k线时间的并集), pandas.DatetimeIndex
+        open, high, low, close
+                            2维数组 (股票 x k线)，没有k线的位置为nan
+    '''
+    arr_name = ['open', 'high', 'low', 'close']
+    info_df = {}
+    for obj in arr_obj_stock:
+        df = obj.get_bar(period)
+        if n_bars is not None:
+            df = df.iloc[-n_bars:]
+        info_df[obj.stock_code] = df[arr_name]
+    df_all = pd.concat(info_df, axis=1, sort=True)
+    if n_bars is not None:
+        df_all = df_all.iloc[-n_bars:]
+    info = {
+            'arr_stock_code': list(info_df.keys()),
+            'index': df_all.index,
+            }
+    for name in arr_name:
+        info[name] = np.array(
+                df_all.xs(name, axis=1, level=1).values.T, dtype=np.float64
+                )
+    return info
+
+
+def get_time_new(obj_calendar, index, period, s_last_time):
+    ''' 上次运行之后结束的第一个k线的时间 (k线时间为开始时间)
+        k线的结束时间(交易日历) > s_last_time: 新的k线；
+        上次运行时未结束的k线(开始时间 < s_last_time < 结束时间)，也是新的k线。
+    入口参数:
+        index           k线时间, pandas.DatetimeIndex (按时间排序)
+        s_last_time     上次运行时间，None or str
+    返回值: pandas.Timestamp (k线时间 >= 返回值: 新的k线)，None: 全部k线
+    '''
+    if not s_last_time:
+        return None
+    last_time = pd.Timestamp(s_last_time)
+    pos = index.searchsorted(last_time)
+    if 0 < pos:
+        # 只有上次运行之前开始的最后一个k线，可能在上次运行之后结束
+        obj_PeriodType = PeriodType(period)
+        try:
+            close_time = obj_calendar.bar_close_time(
+                    index[pos - 1:pos], obj_PeriodType
+                    )[0]
+        except ValueError:
+            close_time = (index[pos - 1] + obj_PeriodType.get_rule()).to_datetime64()
+        if np.datetime64(last_time, 'm') < close_time:
+            pos -= 1
+    if pos < index.size:
+        return index[pos]
+    return last_time
+
+
+def calc_base_bars(obj_calendar, period, n_bars, period_base='1m'):
+    ''' period周期的n_bars个k线，需要的基础周期k线数量 (多一个k线，第一个k线可能不完整)
+        日线: 交易日历每天的交易分钟数
+        返回值: int，无法换算(秒线等): None
+    '''
+    obj_PeriodType = PeriodType(period)
+    try:
+        if obj_PeriodType.key == 'd':
+            n_minutes = obj_PeriodType.count * obj_calendar.arr_minute_of_day.size
+        else:
+            n_minutes = obj_PeriodType.get_minutes()
+        n_minutes_base = PeriodType(period_base).get_minutes()
+    except ValueError:
+        return None
+    return -(-(n_bars + 1) * n_minutes // n_minutes_base)
+
+
 class TimingStart:
     ''' 定时开始任务
         更新k线数据 ---> 遍历报警程序(所有k线周期)
@@ -91,18 +183,43 @@ class TimingStart:
     obj_KlineInfo = None
     # vlc
     obj_sound = None
+    # 报警信息的通知
+    obj_Notify = None
     # 仅第一次运行
     only_once = None
 
     def __init__(self):
-        self.only_once = True
         self.obj_KlineInfo = KlineInfo()
+        # 从快照恢复时，不需要第一次运行
+        self.only_once = not self.obj_KlineInfo.flag_warm_start
         self.init_audio()
+        # 报警信息的通知(打印、声音等)，在工作线程中执行，不影响定时任务
+        self.obj_Notify = notify.create_dispatcher(func_audio=self.play_audio)
+        self.obj_KlineInfo.obj_Notify = self.obj_Notify
+        if hasattr(signal, 'SIGHUP'):
+            # kill -HUP <pid>: 重新读取报警程序数据表
+            signal.signal(
+                    signal.SIGHUP,
+                    lambda signum, frame: self.obj_KlineInfo.request_reload(),
+                    )
+        # kill <pid>: 待写入的数据写入数据表后退出 (main()中的close())
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        if settings.feed_address:
+            # 推送行情，定时下载作为后备
+            self.obj_KlineInfo.start_feed(SocketFeed(settings.feed_address))
 
     def __del__(self):
         ''' 析构函数 '''
+        self.close()
         self.obj_sound.stop()
 
+    def close(self):
+        ''' 退出前: 待写入的数据写入数据表，通知发送完成 '''
+        if self.obj_KlineInfo is not None:
+            self.obj_KlineInfo.close(settings.n_persist_timeout)
+        if self.obj_Notify is not None:
+            self.obj_Notify.stop(timeout=settings.n_notify_timeout)
+
     def event_timer(self):
         ''' 定时器事件
         开市时间：每20秒启动一次时间监控程序。
@@ -120,6 +237,9 @@ class TimingStart:
             if market_opening or settings.DEBUG:
                 # 开市时间，运行报警检测程序
                 schedule.run_pending()
+            else:
+                # 闭市后，补充k线数据的缺口
+                self.obj_KlineInfo.check_after_close()
             time.sleep(sleep_seconds)
 
     def run_threaded(self, job_func):
@@ -131,9 +251,8 @@ class TimingStart:
         ''' 定时执行的任务 '''
         obj = self.obj_KlineInfo
         try:
-            flag = obj.run_cron(self)
-            if flag and not self.only_once:
-                self.play_audio()
+            # 报警信息由obj_Notify通知(声音)
+            obj.run_cron(self.only_once)
         except ValueError as e:
             logger.error(f'{e}')
         else:
@@ -141,43 +260,18 @@ class TimingStart:
                 self.only_once = False
 
     def calc_sleep_seconds(self):
-        ''' 计算休眠时间 '''
-        market_opening = False
+        ''' 计算休眠时间
+            开市期间(包含闭市后继续运行的时间): 休眠settings.n_sleep秒
+            其它时间(午休、闭市、周末、节假日): 休眠到下一个开市时间
+        '''
         now = datetime.datetime.now()
-        now_weekday = now.date().weekday()
-        t_am_begin = datetime.datetime(now.year, now.month, now.day, 9, 30)
-        t_am_end = datetime.datetime(now.year, now.month, now.day, 11, 30)
-        t_pm_begin = datetime.datetime(now.year, now.month, now.day, 13)
-        t_pm_end = datetime.datetime(now.year, now.month, now.day, 15, 0)
-        if now_weekday < 5:
-            if now < t_am_begin:
-                # 早市之前
-                sleep_seconds = (t_am_begin - now).total_seconds()
-            elif t_am_begin <= now <= t_am_end + self.t_continue_run:
-                # 早上开市期间
-                sleep_seconds = settings.n_sleep
-                market_opening = True
-            elif t_am_end < now < t_pm_begin:
-                # 中午休市时间
-                sleep_seconds = (t_pm_begin - now).total_seconds()
-            elif t_pm_begin <= now <= t_pm_end + self.t_continue_run:
-                # 下午开市期间
-                sleep_seconds = settings.n_sleep
-                market_opening = True
-            else:
-                # 下午闭市之后
-                if now_weekday == 4:
-                    # 周五
-                    wait_day = datetime.timedelta(days=3)
-                else:
-                    # 周一..周四
-                    wait_day = datetime.timedelta(days=1)
-                sleep_seconds = (t_am_begin + wait_day - now).total_seconds()
+        market_opening, next_time = self.obj_KlineInfo.calc_session(
+                now, self.t_continue_run
+                )
+        if market_opening:
+            sleep_seconds = settings.n_sleep
         else:
-            # 周末
-            wait_day = datetime.timedelta(days=7 - now_weekday)
-            sleep_seconds = (t_am_begin + wait_day - now).total_seconds()
-        sleep_seconds = int(sleep_seconds)
+            sleep_seconds = int((next_time - now).total_seconds())
         if sleep_seconds < 1:
             # 开市之前的(0.9..0]秒
             sleep_seconds = settings.n_sleep
@@ -211,6 +305,8 @@ class DataTable:
     engine = None
     # 数据表名称
     db_name = None
+    # 已经存在的数据表 (减少has_table()的查询)
+    set_table_exists = None
     # 数据表
     arr_name_table = (
             'market_info',
@@ -219,6 +315,7 @@ class DataTable:
             'alarm_program_info',
             'alarm_message',
             'QuotesDataSource_account',
+            'alarm_price_level',
              )
     # 删除数据表
     sql_table_drop = '''drop table "{t_name}";'''
@@ -275,16 +372,70 @@ class DataTable:
                     "remark" TEXT
                     );
             '''
-    # 创建数据表: 报警信息
+    # 创建数据表: 报警信息 (按月分区, alarm_message_YYYYMM)
+    #   ts          报警时间(s_now)的数值, 1970-01-01 00:00以来的分钟数
     sql_table_create__alarm_message = '''
-            CREATE TABLE "alarm_message" (
+            CREATE TABLE IF NOT EXISTS "{t_name}" (
                     "s_now" TEXT NOT NULL,
                     "stock_code" TEXT NOT NULL,
                     "period" TEXT NOT NULL,
                     "message" TEXT,
+                    "ts" INTEGER NOT NULL,
                     PRIMARY KEY ("s_now", "stock_code", "period")
                     );
             '''
+    # 创建索引: 报警信息 (按时间、股票代码、k线周期查询)
+    arr_sql_index_create__alarm_message = (
+            '''CREATE INDEX IF NOT EXISTS "ix_{t_name}_ts"
+                    ON "{t_name}" ("ts");''',
+            '''CREATE INDEX IF NOT EXISTS "ix_{t_name}_stock_code"
+                    ON "{t_name}" ("stock_code", "ts");''',
+            '''CREATE INDEX IF NOT EXISTS "ix_{t_name}_period"
+                    ON "{t_name}" ("period", "ts");''',
+            )
+    # 报警信息: 原来没有分区的数据表已检查(转换)
+    flag_migrated_alarm_message = False
+    # 创建数据表: 价格报警
+    #   direction       穿越方向, 'up' or 'down', NULL: 两个方向
+    #   price_type      'close': 收盘价穿越, NULL: k线的[low, high]触及
+    sql_table_create__alarm_price_level = '''
+            CREATE TABLE "alarm_price_level" (
+                    "id" INTEGER NOT NULL,
+                    "stock_code" TEXT NOT NULL,
+                    "price" FLOAT NOT NULL,
+                    "direction" TEXT,
+                    "price_type" TEXT,
+                    "remark" TEXT,
+                    PRIMARY KEY ("id")
+                    );
+            '''
+    # 创建数据表: 历史回放的运行记录 (replay.py)
+    sql_table_create__replay_run = '''
+            CREATE TABLE IF NOT EXISTS "replay_run" (
+                    "run_id" TEXT NOT NULL,
+                    "algorithm" TEXT NOT NULL,
+                    "arr_stock_code" TEXT,
+                    "arr_period" TEXT,
+                    "other_kwargs" TEXT,
+                    "date_start" TEXT,
+                    "date_end" TEXT,
+                    "n_alarm" INTEGER,
+                    "run_time" FLOAT,
+                    "time_create" TEXT,
+                    PRIMARY KEY ("run_id")
+                    );
+            '''
+    # 创建数据表: 历史回放的报警信息 (与alarm_message相同，增加run_id)
+    sql_table_create__replay_message = '''
+            CREATE TABLE IF NOT EXISTS "replay_message" (
+                    "run_id" TEXT NOT NULL,
+                    "s_now" TEXT NOT NULL,
+                    "stock_code" TEXT NOT NULL,
+                    "period" TEXT NOT NULL,
+                    "message" TEXT,
+                    PRIMARY KEY ("run_id", "s_now", "stock_code", "period")
+                    );
+            '''
     # 创建数据表: 数据源账号
     sql_table_create__QuotesDataSource_account = '''
             CREATE TABLE "QuotesDataSource_account" (
@@ -296,6 +447,7 @@ class DataTable:
             '''
 
     def __init__(self, db_name=settings.sql_url):
+        self.set_table_exists = set()
         self.set_database_name(db_name)
 
     def get_database_name(self):
@@ -310,11 +462,17 @@ class DataTable:
         if self.engine:
             self.engine.dispose()
         self.db_name = db_name
+        self.set_table_exists = set()
         self.engine = create_engine(self.db_name, echo=False)
 
     def table_is_exists(self, t_name):
-        ''' 检查数据表的存在 '''
-        return self.engine.has_table(t_name)
+        ''' 检查数据表的存在 (已存在的数据表，记录在set_table_exists中) '''
+        if t_name in self.set_table_exists:
+            return True
+        flag = self.engine.has_table(t_name)
+        if flag:
+            self.set_table_exists.add(t_name)
+        return flag
 
     def sql_execute(self, s_sql, info={}):
         ''' 在数据表中，执行sql语句 '''
@@ -328,6 +486,7 @@ class DataTable:
     def table_drop(self, t_name):
         ''' 删除数据表 '''
         self.sql_execute(self.sql_table_drop, {'t_name': t_name})
+        self.set_table_exists.discard(t_name)
 
     def table_empty(self, t_name):
         ''' 清空数据表的数据 '''
@@ -354,21 +513,112 @@ class DataTable:
         ''' 创建数据表: 报警程序 '''
         self.sql_execute(self.sql_table_create__alarm_program)
 
-    def table_create__alarm_message(self):
-        ''' 创建数据表: 报警程序 '''
-        self.sql_execute(self.sql_table_create__alarm_message)
+    def table_create__alarm_message(self, t_name=None):
+        ''' 创建数据表: 报警信息的分区 (包含索引)
+            t_name      分区的数据表名称，None: 本月
+        '''
+        if t_name is None:
+            t_name = self.get_partition__alarm_message(datetime.date.today())
+        self.sql_execute(self.sql_table_create__alarm_message, {'t_name': t_name})
+        for s_sql in self.arr_sql_index_create__alarm_message:
+            self.sql_execute(s_sql, {'t_name': t_name})
+
+    @staticmethod
+    def get_partition__alarm_message(date):
+        ''' 报警信息的分区: 数据表名称 alarm_message_YYYYMM
+            date        日期 or 时间 (str, datetime, date)
+        '''
+        return f'alarm_message_{pd.Timestamp(date):%Y%m}'
+
+    @staticmethod
+    def get_ts__alarm_message(s_now):
+        ''' 报警时间的数值 (分钟)，s_now: str or [str, ...] '''
+        return np.array(s_now, dtype='datetime64[m]').astype(np.int64)
+
+    def read_partition__alarm_message(self):
+        ''' 报警信息的分区, 月份(YYYYMM) ---> t_name
+            每次从sqlite_master读取(不缓存): 其它进程(监控服务)可能创建、归档删除分区
+            原来没有分区的数据表alarm_message，第一次读取时转换为分区
+        '''
+        if not self.flag_migrated_alarm_message:
+            if self.table_is_exists('alarm_message'):
+                self.migrate__alarm_message()
+            self.flag_migrated_alarm_message = True
+        s_sql = '''
+                select name from sqlite_master where type = 'table'
+                and name glob 'alarm_message_[0-9][0-9][0-9][0-9][0-9][0-9]'
+                '''
+        with self.engine.connect() as conn:
+            arr_row = conn.execute(sqlalchemy.text(s_sql)).fetchall()
+        return {row[0][-6:]: row[0] for row in arr_row}
+
+    def migrate__alarm_message(self):
+        ''' 原来的数据表alarm_message转换为按月分区
+            转换后，原来的数据表改名为alarm_message__migrated_YYYYmmddHHMMSS
+        '''
+        t_name_old = 'alarm_message'
+        s_sql = f'select distinct substr(s_now, 1, 7) from "{t_name_old}"'
+        with self.engine.connect() as conn:
+            arr_month = [row[0] for row in conn.execute(s_sql).fetchall()]
+        for s_month in arr_month:
+            t_name = self.get_partition__alarm_message(f'{s_month}-01')
+            self.table_create__alarm_message(t_name)
+            s_sql = f'''
+                    insert or ignore into "{t_name}"
+                    select s_now, stock_code, period, message,
+                        cast(strftime('%s', s_now) as integer) / 60
+                    from "{t_name_old}" where substr(s_now, 1, 7) = :month
+                    '''
+            with self.engine.begin() as conn:
+                conn.execute(sqlalchemy.text(s_sql), {'month': s_month})
+        s_time = f'{datetime.datetime.now():%Y%m%d%H%M%S}'
+        self.sql_execute(
+                f'alter table "{t_name_old}" rename to "{t_name_old}__migrated_{s_time}"'
+                )
+        self.set_table_exists.discard(t_name_old)
+        logger.info(f'报警信息转换为按月分区: {len(arr_month)}个月')
 
     def table_create__QuotesDataSource_account(self):
         ''' 创建数据表: 数据源账号 '''
         self.sql_execute(self.sql_table_create__QuotesDataSource_account)
 
-    def read_db__kline(self, t_name):
-        ''' 从数据表读取k线数据 '''
-        if self.table_is_exists(t_name):
-            df = pd.read_sql(t_name, con=self.engine, index_col='date')
-        else:
+    def table_create__alarm_price_level(self):
+        ''' 创建数据表: 价格报警 '''
+        self.sql_execute(self.sql_table_create__alarm_price_level)
+
+    def read_db__kline(self, t_name, n_bars=None, end_time=None, start_time=None):
+        ''' 从数据表读取k线数据
+        入口参数:
+            t_name          数据表名
+            n_bars          最后的n_bars个k线 (order by date desc limit)，None: 全部
+            end_time        仅读取end_time之前的k线，None: 不限制
+            start_time      仅读取start_time及以后的k线，None: 不限制
+        '''
+        if not self.table_is_exists(t_name):
             raise ValueError(f'{t_name}数据表不存在')
-        return df
+        if n_bars is None and end_time is None and start_time is None:
+            return pd.read_sql(t_name, con=self.engine, index_col='date')
+        s_where = s_limit = ''
+        info = {}
+        arr_where = []
+        if end_time is not None:
+            arr_where.append('"date" < :end_time')
+            info['end_time'] = pd.Timestamp(end_time).strftime('%Y-%m-%d %H:%M:%S.%f')
+        if start_time is not None:
+            arr_where.append(':start_time <= "date"')
+            info['start_time'] = pd.Timestamp(start_time).strftime('%Y-%m-%d %H:%M:%S.%f')
+        if arr_where:
+            s_where = 'where ' + ' and '.join(arr_where)
+        if n_bars is not None:
+            s_limit = f'limit {int(n_bars)}'
+        sql = sqlalchemy.text(
+                f'select * from (select * from "{t_name}" {s_where} '
+                f'order by "date" desc {s_limit}) order by "date"'
+                )
+        return pd.read_sql(
+                sql, con=self.engine, params=info, index_col='date',
+                parse_dates=['date'],
+                )
 
     def read_db__kline__last_time(self, t_name):
         ''' 从数据表读取k线数据的最后时间
@@ -387,12 +637,89 @@ class DataTable:
             self.table_create__kline(t_name)
         return last_time
 
+    def read_db__kline__date(self, t_name, start_time=None):
+        ''' 从数据表读取k线的时间 (仅date列)
+        入口参数:
+            t_name          数据表名
+            start_time      仅读取start_time及以后的k线，None: 全部
+        返回值:
+            pandas.DatetimeIndex，数据表不存在时为空
+        '''
+        if not self.table_is_exists(t_name):
+            return pd.DatetimeIndex([], name='date')
+        info = {}
+        s_where = ''
+        if start_time is not None:
+            s_where = 'where :start_time <= "date"'
+            info['start_time'] = pd.Timestamp(start_time).strftime('%Y-%m-%d %H:%M:%S.%f')
+        sql = sqlalchemy.text(
+                f'select "date" from "{t_name}" {s_where} order by "date"'
+                )
+        df = pd.read_sql(sql, con=self.engine, params=info, parse_dates=['date'])
+        return pd.DatetimeIndex(df['date'], name='date')
+
     def save_db__kline(self, df, t_name):
         ''' k线数据写入数据表 '''
         if not self.table_is_exists(t_name):
             self.table_create__kline(t_name)
         df.to_sql(t_name, con=self.engine, if_exists='append', chunksize=1000)
 
+    def save_db__kline_batch(self, info):
+        ''' k线数据批量写入数据表，一个事务
+            已经存在的k线(主键date重复)，忽略。
+        入口参数:
+            info            {t_name: DataFrame, ...}
+        返回值:
+            写入的记录数量
+        '''
+        n_rows, _ = self.save_db__batch(info)
+        return n_rows
+
+    def save_db__batch(self, info_kline, df_alarm=None):
+        ''' k线数据、报警信息写入数据表，一个事务 (executemany)
+        入口参数:
+            info_kline      k线数据, {t_name: DataFrame, ...}
+            df_alarm        报警信息, index: (s_now, stock_code, period)，None: 没有
+        返回值:
+            (k线的记录数量, 报警信息的记录数量)
+        '''
+        info_alarm = {}
+        if df_alarm is not None and len(df_alarm):
+            info_alarm = self.prepare__alarm_message(df_alarm)
+        sql_create = self.sql_table_create__kline_data.replace(
+                'CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1
+                )
+        n_kline = n_alarm = 0
+        with self.engine.begin() as conn:
+            for t_name, df in info_kline.items():
+                if df.empty:
+                    continue
+                if t_name not in self.set_table_exists:
+                    conn.execute(sql_create.format(t_name=t_name))
+                n_kline += self.insert__kline(conn, t_name, df)
+            for t_name, arr_row in info_alarm.items():
+                n_alarm += self.insert__alarm_message(conn, t_name, arr_row)
+        self.set_table_exists.update(info_kline)
+        return n_kline, n_alarm
+
+    def insert__kline(self, conn, t_name, df):
+        ''' k线数据写入数据表 (在事务conn中)，已经存在的k线忽略
+            返回值: 记录数量
+        '''
+        sql_insert = (
+                f'INSERT OR IGNORE INTO "{t_name}" '
+                '("date", "open", "high", "low", "close") '
+                'VALUES (?, ?, ?, ?, ?)'
+                )
+        arr_date = df.index.strftime('%Y-%m-%d %H:%M:%S.%f')
+        arr_row = list(zip(
+                arr_date,
+                *[df[name].astype(float).tolist()
+                  for name in ('open', 'high', 'low', 'close')]
+                ))
+        conn.execute(sql_insert, arr_row)
+        return len(arr_row)
+
     def read_db__stock_code(self):
         ''' 读取数据表: 股票代码 '''
         df = pd.read_sql(
@@ -401,6 +728,28 @@ class DataTable:
                 )
         return df
 
+    def read_db__stock_universe(self, str_type=None, date=None):
+        ''' 读取数据表: 股票代码 (全市场筛选的股票范围)
+        入口参数:
+            str_type        股票类型(stock_type_info.type)，None: 全部
+            date            日期，排除已退市的股票，None: 今天
+        返回值: list, [stock_code, ...]
+        '''
+        if date is None:
+            date = datetime.date.today()
+        s_sql = '''
+                select code from stock_code_info
+                where (end_date is null or :date <= end_date)
+                '''
+        info = {'date': str(date)}
+        if str_type is not None:
+            s_sql += ' and type = :type'
+            info['type'] = str_type
+        s_sql += ' order by code'
+        with self.engine.connect() as conn:
+            arr_row = conn.execute(sqlalchemy.text(s_sql), info).fetchall()
+        return [row[0] for row in arr_row]
+
     def read_db__alarm_program(self):
         ''' 读取数据表: 报警程序 '''
         t_name = 'alarm_program_info'
@@ -414,18 +763,329 @@ class DataTable:
             self.table_create__alarm_program(t_name)
         df.to_sql(t_name, con=self.engine, if_exists='append', chunksize=1000)
 
-    def read_db__alarm_message(self):
-        ''' 读取数据表: 报警信息 '''
+    def read_db__alarm_price_level(self):
+        ''' 读取数据表: 价格报警 '''
+        t_name = 'alarm_price_level'
+        if not self.table_is_exists(t_name):
+            return pd.DataFrame(columns=[
+                    'id', 'stock_code', 'price', 'direction', 'price_type',
+                    'remark',
+                    ])
+        df = pd.read_sql(t_name, con=self.engine)
+        return df
+
+    def read_db__alarm_price_level__version(self):
+        ''' 价格报警数据表的版本 (按id排序的全部记录的所有列，md5)
+            增加、删除记录，修改任意一列(价格、方向、价格类型、备注)时，版本改变。
+        '''
+        t_name = 'alarm_price_level'
+        if not self.table_is_exists(t_name):
+            return None
+        s_sql = f'''
+                select id, stock_code, price, direction, price_type, remark
+                from "{t_name}" order by id
+                '''
+        obj_md5 = hashlib.md5()
+        with self.engine.connect() as conn:
+            for row in conn.execute(s_sql):
+                obj_md5.update(repr(tuple(row)).encode('utf-8'))
+        return obj_md5.hexdigest()
+
+    def save_db__alarm_price_level(self, df):
+        ''' 价格报警写入数据表 '''
+        t_name = 'alarm_price_level'
+        if not self.table_is_exists(t_name):
+            self.table_create__alarm_price_level()
+        df.to_sql(t_name, con=self.engine, if_exists='append', index=False)
+
+    def read_db__alarm_message(
+            self, date_start=None, date_end=None, stock_code=None, period=None,
+            ):
+        ''' 读取数据表: 报警信息 (仅读取日期范围内的分区)
+        入口参数:
+            date_start      开始日期 (包含)，None: 不限
+            date_end        结束日期 (包含)，None: 不限
+            stock_code      股票代码，None: 全部
+            period          k线周期，None: 全部
+        返回值: DataFrame, index: (s_now, stock_code, period), columns: message
+        '''
+        ts_start, ts_end = self.get_ts_range__alarm_message(date_start, date_end)
+        arr_record = self.query__alarm_message(ts_start, ts_end, stock_code, period)
+        return self.to_df__alarm_message(arr_record)
+
+    def read_db__alarm_message__today(self, today=None):
+        ''' 读取数据表: 今天的报警信息 (DataFrame) '''
+        if today is None:
+            today = datetime.date.today()
+        return self.read_db__alarm_message(today, today)
+
+    def read_db__alarm_message__range(self, s_start, s_end):
+        ''' 读取数据表: 报警时间在[s_start, s_end]之间的报警信息 (DataFrame)
+            s_start, s_end      报警时间, 'YYYY-MM-DD HH:MM'
+        '''
+        ts_start = int(self.get_ts__alarm_message(s_start))
+        ts_end = int(self.get_ts__alarm_message(s_end)) + 1
+        return self.to_df__alarm_message(
+                self.query__alarm_message(ts_start, ts_end)
+                )
+
+    def read_db__alarm_message__symbol(
+            self, stock_code, date_start=None, date_end=None,
+            ):
+        ''' 读取数据表: 一个股票的报警信息 (DataFrame) '''
+        return self.read_db__alarm_message(date_start, date_end, stock_code)
+
+    def read_db__alarm_message__page(
+            self, n_rows, key_last=None, date_start=None, date_end=None,
+            stock_code=None, period=None,
+            ):
+        ''' 读取数据表: 报警信息的一页 (按时间倒序，使用索引，与数据表的大小无关)
+        入口参数:
+            n_rows          每页的记录数量
+            key_last        上一页最后一条记录的(s_now, stock_code, period)，
+                            None: 第一页
+            date_start      开始日期 (包含)，None: 不限
+            date_end        结束日期 (包含)，None: 不限
+            stock_code      股票代码，None: 全部
+            period          k线周期，None: 全部
+        返回值: list, [(s_now, stock_code, period, message), ...]
+        '''
+        ts_start, ts_end = self.get_ts_range__alarm_message(date_start, date_end)
+        return self.query__alarm_message(
+                ts_start, ts_end, stock_code, period, n_rows, key_last,
+                )
+
+    def get_ts_range__alarm_message(self, date_start=None, date_end=None):
+        ''' 日期范围[date_start, date_end] ---> 报警时间的数值范围[ts_start, ts_end) '''
+        ts_start = ts_end = None
+        if date_start is not None:
+            ts_start = int(self.get_ts__alarm_message(
+                    str(pd.Timestamp(date_start).date())
+                    ))
+        if date_end is not None:
+            ts_end = int(self.get_ts__alarm_message(str(
+                    pd.Timestamp(date_end).date() + datetime.timedelta(days=1)
+                    )))
+        return ts_start, ts_end
+
+    def query__alarm_message(
+            self, ts_start=None, ts_end=None, stock_code=None, period=None,
+            n_rows=None, key_last=None,
+            ):
+        ''' 查询报警信息 (按时间倒序，仅查询时间范围内的分区)
+        入口参数:
+            ts_start, ts_end    报警时间的数值范围[ts_start, ts_end)，None: 不限
+            stock_code          股票代码，None: 全部
+            period              k线周期，None: 全部
+            n_rows              记录数量，None: 全部
+            key_last            从(s_now, stock_code, period)之后开始，None: 最新
+        返回值: list, [(s_now, stock_code, period, message), ...]
+        '''
+        info_partition = self.read_partition__alarm_message()
+        arr_where = []
+        info = {}
+        if key_last is not None:
+            arr_where.append('(ts, stock_code, period) < (:ts_last, :stock_code_last, :period_last)')
+            info['ts_last'] = int(self.get_ts__alarm_message(key_last[0]))
+            info['stock_code_last'], info['period_last'] = key_last[1:3]
+            if ts_end is None or info['ts_last'] + 1 < ts_end:
+                ts_end = info['ts_last'] + 1
+        if ts_start is not None:
+            arr_where.append('ts >= :ts_start')
+            info['ts_start'] = ts_start
+        if ts_end is not None:
+            arr_where.append('ts < :ts_end')
+            info['ts_end'] = ts_end
+        if stock_code:
+            arr_where.append('stock_code = :stock_code')
+            info['stock_code'] = stock_code
+        if period:
+            arr_where.append('period = :period')
+            info['period'] = period
+        # 时间范围内的分区
+        month_start = month_end = None
+        if ts_start is not None:
+            month_start = f'{np.datetime64(ts_start, "m").astype(datetime.datetime):%Y%m}'
+        if ts_end is not None:
+            month_end = f'{np.datetime64(ts_end - 1, "m").astype(datetime.datetime):%Y%m}'
+        arr_t_name = [
+                t_name for month, t_name in sorted(info_partition.items(), reverse=True)
+                if (month_start is None or month_start <= month)
+                and (month_end is None or month <= month_end)
+                ]
+        arr_record = []
+        with self.engine.connect() as conn:
+            for t_name in arr_t_name:
+                s_sql = f'select s_now, stock_code, period, message from "{t_name}"'
+                if arr_where:
+                    s_sql += ' where ' + ' and '.join(arr_where)
+                s_sql += ' order by ts desc, stock_code desc, period desc'
+                if n_rows is not None:
+                    s_sql += f' limit {int(n_rows) - len(arr_record)}'
+                try:
+                    arr_row = conn.execute(sqlalchemy.text(s_sql), info).fetchall()
+                except sqlalchemy.exc.OperationalError as e:
+                    # 读取分区列表之后，分区被其它进程归档删除
+                    if t_name in self.read_partition__alarm_message().values():
+                        raise
+                    logger.info(f'报警信息的分区已归档: {t_name}, {e}')
+                    continue
+                arr_record.extend(tuple(row) for row in arr_row)
+                if n_rows is not None and n_rows <= len(arr_record):
+                    break
+        return arr_record
+
+    @staticmethod
+    def to_df__alarm_message(arr_record):
+        ''' 报警信息 ---> DataFrame, index: (s_now, stock_code, period) '''
         index_name = ['s_now', 'stock_code', 'period']
-        df = pd.read_sql('alarm_message', con=self.engine, index_col=index_name)
+        df = pd.DataFrame(arr_record, columns=index_name + ['message'])
+        df.set_index(index_name, inplace=True)
+        return df
+
+    def archive__alarm_message(self, today=None):
+        ''' 超过保留时间(settings.n_alarm_hot_months)的分区，压缩保存到文件后删除
+            文件: settings.dir_alarm_archive/alarm_message_YYYYMM.csv.gz
+        返回值: 保存的分区 [t_name, ...]
+        '''
+        if today is None:
+            today = datetime.date.today()
+        n_months = settings.n_alarm_hot_months
+        if n_months is None or n_months <= 0:
+            return []
+        month_first = pd.Period(today, freq='M') - (n_months - 1)
+        month_first = f'{month_first.year:04d}{month_first.month:02d}'
+        info_partition = self.read_partition__alarm_message()
+        arr_t_name = [
+                t_name for month, t_name in sorted(info_partition.items())
+                if month < month_first
+                ]
+        if not arr_t_name:
+            return []
+        os.makedirs(settings.dir_alarm_archive, exist_ok=True)
+        for t_name in arr_t_name:
+            f_name = os.path.join(settings.dir_alarm_archive, f'{t_name}.csv.gz')
+            s_sql = f'select s_now, stock_code, period, message from "{t_name}" order by ts'
+            with self.engine.connect() as conn:
+                arr_row = conn.execute(s_sql).fetchall()
+            df = self.to_df__alarm_message([tuple(row) for row in arr_row])
+            if os.path.exists(f_name):
+                # 已经保存过(例如: 删除数据表之前中断)，合并
+                df = pd.concat((self.read_archive__alarm_message(t_name[-6:]), df))
+                df = df[~df.index.duplicated(keep='last')]
+            f_name_tmp = f'{f_name}.tmp'
+            df.to_csv(f_name_tmp, compression='gzip')
+            os.replace(f_name_tmp, f_name)
+            self.table_drop(t_name)
+            del info_partition[t_name[-6:]]
+            logger.info(f'报警信息归档: {t_name}, {len(df)}条 ---> {f_name}')
+        return arr_t_name
+
+    def read_archive__alarm_message(self, month):
+        ''' 读取归档的报警信息
+            month       月份, 'YYYYMM'
+        返回值: DataFrame, index: (s_now, stock_code, period)
+        '''
+        f_name = os.path.join(
+                settings.dir_alarm_archive, f'alarm_message_{month}.csv.gz'
+                )
+        if not os.path.exists(f_name):
+            return self.to_df__alarm_message([])
+        df = pd.read_csv(f_name, compression='gzip', dtype=str)
+        df.set_index(['s_now', 'stock_code', 'period'], inplace=True)
         return df
 
+    def read_db__stock_name(self):
+        ''' 读取数据表: 股票代码 ---> 股票名称, dict '''
+        s_sql = 'select code, display_name from stock_code_info'
+        with self.engine.connect() as conn:
+            arr_row = conn.execute(sqlalchemy.text(s_sql)).fetchall()
+        return {code: display_name for code, display_name in arr_row}
+
     def save_db__alarm_message(self, df):
-        ''' 报警信息写入数据表 '''
-        t_name = 'alarm_message'
-        if not self.table_is_exists(t_name):
-            self.table_create__alarm_message(t_name)
-        df.to_sql(t_name, con=self.engine, if_exists='append', chunksize=1000)
+        ''' 报警信息写入数据表 (按月分区，重复的记录忽略)
+            df      index: (s_now, stock_code, period), columns: message
+        '''
+        self.save_db__batch({}, df)
+
+    def prepare__alarm_message(self, df):
+        ''' 报警信息按分区分组 (创建不存在的分区)
+            df      index: (s_now, stock_code, period), columns: message
+        返回值: t_name ---> [(s_now, stock_code, period, message, ts), ...]
+        '''
+        info_partition = self.read_partition__alarm_message()
+        df = df.reset_index()
+        arr_ts = self.get_ts__alarm_message(df['s_now'].tolist())
+        info = {}
+        for row, ts in zip(df.itertuples(index=False), arr_ts):
+            t_name = f'alarm_message_{row.s_now[:4]}{row.s_now[5:7]}'
+            info.setdefault(t_name, []).append((
+                    row.s_now, row.stock_code, row.period, row.message, int(ts),
+                    ))
+        for t_name in info:
+            if t_name[-6:] not in info_partition:
+                self.table_create__alarm_message(t_name)
+        return info
+
+    def insert__alarm_message(self, conn, t_name, arr_row):
+        ''' 报警信息写入分区 (在事务conn中)，重复的记录忽略
+            返回值: 记录数量
+        '''
+        s_sql = (
+                f'INSERT OR IGNORE INTO "{t_name}" '
+                '(s_now, stock_code, period, message, ts) '
+                'VALUES (?, ?, ?, ?, ?)'
+                )
+        conn.execute(s_sql, arr_row)
+        return len(arr_row)
+
+    def table_create__replay(self):
+        ''' 创建数据表: 历史回放 (运行记录、报警信息) '''
+        self.sql_execute(self.sql_table_create__replay_run)
+        self.sql_execute(self.sql_table_create__replay_message)
+
+    def save_db__replay(self, info_run, arr_record):
+        ''' 历史回放的结果写入数据表，一个事务 (executemany)
+        入口参数:
+            info_run        运行记录, dict (replay_run的列)
+            arr_record      报警信息 [(s_now, stock_code, period, message), ...]
+        '''
+        self.table_create__replay()
+        arr_name = (
+                'run_id', 'algorithm', 'arr_stock_code', 'arr_period',
+                'other_kwargs', 'date_start', 'date_end', 'n_alarm',
+                'run_time', 'time_create',
+                )
+        sql_run = (
+                'INSERT INTO "replay_run" ('
+                + ', '.join(f'"{name}"' for name in arr_name)
+                + ') VALUES (' + ', '.join('?' * len(arr_name)) + ')'
+                )
+        sql_message = (
+                'INSERT OR IGNORE INTO "replay_message" '
+                '("run_id", "s_now", "stock_code", "period", "message") '
+                'VALUES (?, ?, ?, ?, ?)'
+                )
+        run_id = info_run['run_id']
+        with self.engine.begin() as conn:
+            conn.execute(sql_run, [tuple(info_run.get(name) for name in arr_name)])
+            if arr_record:
+                conn.execute(
+                        sql_message,
+                        [(run_id,) + tuple(record) for record in arr_record],
+                        )
+
+    def read_db__replay_message(self, run_id):
+        ''' 历史回放的报警信息 '''
+        sql = sqlalchemy.text(
+                'select "s_now", "stock_code", "period", "message" '
+                'from "replay_message" where "run_id" = :run_id '
+                'order by "s_now", "stock_code", "period"'
+                )
+        return pd.read_sql(
+                sql, con=self.engine, params={'run_id': run_id},
+                index_col=['s_now', 'stock_code', 'period'],
+                )
 
     def read_db__QuotesDataSource_account(self):
         ''' 读取数据表: 数据源账号 '''
@@ -448,6 +1108,301 @@ class DataTable:
         self.table_create__alarm_program()
         self.table_create__alarm_message()
         self.table_create__QuotesDataSource_account()
+        self.table_create__alarm_price_level()
+
+
+class BatchWriter:
+    ''' 数据写入 (group commit)
+    一次运行(定时任务 or 推送行情的一批消息)中的新的k线、报警信息，先放在内存中，
+    commit()时用executemany写入所有股票的数据，一个事务 (一次fsync)。
+    写入失败时，数据保留，下一次commit()重试。
+    '''
+    # 数据表
+    obj_DataTable = None
+    # 待写入的k线, t_name ---> [DataFrame, ...]
+    info_kline = None
+    # 待写入的报警信息 [DataFrame, ...]
+    arr_df_alarm = None
+    # 还没有写入数据表的报警信息 set([(s_now, stock_code, period), ...])
+    set_alarm_label = None
+    # 统计: 事务次数、写入的k线、报警信息的数量
+    n_commit = None
+    n_rows_kline = None
+    n_rows_alarm = None
+    # 最近的事务时间(秒)
+    arr_time_commit = None
+    # 线程锁
+    lock = None
+
+    def __init__(self, obj_DataTable):
+        self.obj_DataTable = obj_DataTable
+        self.info_kline = {}
+        self.arr_df_alarm = []
+        self.set_alarm_label = set()
+        self.n_commit = self.n_rows_kline = self.n_rows_alarm = 0
+        self.arr_time_commit = collections.deque(maxlen=1000)
+        self.lock = threading.Lock()
+
+    def add_kline(self, t_name, df):
+        ''' 增加待写入的k线 '''
+        if df.empty:
+            return
+        with self.lock:
+            self.info_kline.setdefault(t_name, []).append(df)
+
+    def add_alarm(self, df):
+        ''' 增加待写入的报警信息, index: (s_now, stock_code, period) '''
+        if df.empty:
+            return
+        with self.lock:
+            self.arr_df_alarm.append(df)
+            self.set_alarm_label.update(df.index)
+
+    def get_alarm_label(self):
+        ''' 还没有写入数据表的报警信息 (去除重复时，与数据表中的报警信息合并) '''
+        with self.lock:
+            return set(self.set_alarm_label)
+
+    def take(self):
+        ''' 取出待写入的数据
+            返回值: (info_kline, arr_df_alarm)
+        '''
+        with self.lock:
+            info_kline, self.info_kline = self.info_kline, {}
+            arr_df_alarm, self.arr_df_alarm = self.arr_df_alarm, []
+        return info_kline, arr_df_alarm
+
+    def restore(self, info_kline, arr_df_alarm):
+        ''' 没有写入的数据放回 (在新的数据之前，保持时间顺序) '''
+        with self.lock:
+            for t_name, arr_df in info_kline.items():
+                self.info_kline[t_name] = arr_df + self.info_kline.get(t_name, [])
+            self.arr_df_alarm = arr_df_alarm + self.arr_df_alarm
+
+    def commit(self):
+        ''' 写入数据表，一个事务
+            返回值: (k线的数量, 报警信息的数量)
+        '''
+        info_kline, arr_df_alarm = self.take()
+        try:
+            return self.write(info_kline, arr_df_alarm)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logger.error(f'写入数据表失败，下一次重试: {e!r}')
+            self.restore(info_kline, arr_df_alarm)
+            return 0, 0
+
+    def write(self, info_kline, arr_df_alarm):
+        ''' 写入数据表，一个事务
+            写入失败: raise sqlalchemy.exc.SQLAlchemyError
+            返回值: (k线的数量, 报警信息的数量)
+        '''
+        if not info_kline and not arr_df_alarm:
+            return 0, 0
+        info_table = {
+                t_name: pd.concat(arr_df) if len(arr_df) > 1 else arr_df[0]
+                for t_name, arr_df in info_kline.items()
+                }
+        df_alarm = None
+        if arr_df_alarm:
+            df_alarm = pd.concat(arr_df_alarm)
+        time_begin = time.perf_counter()
+        n_kline, n_alarm = self.obj_DataTable.save_db__batch(
+                info_table, df_alarm
+                )
+        time_commit = time.perf_counter() - time_begin
+        with self.lock:
+            self.n_commit += 1
+            self.n_rows_kline += n_kline
+            self.n_rows_alarm += n_alarm
+            self.arr_time_commit.append(time_commit)
+            if df_alarm is not None:
+                self.set_alarm_label.difference_update(df_alarm.index)
+        logger.debug(f'写入数据表: {len(info_table)}个数据表, k线{n_kline}条, 报警信息{n_alarm}条, 事务{time_commit * 1000:.1f}ms')
+        return n_kline, n_alarm
+
+    def get_stats(self):
+        ''' 统计信息，事务时间的单位: 毫秒 '''
+        with self.lock:
+            arr = np.array(self.arr_time_commit) * 1000
+            info = {
+                    'n_commit': self.n_commit,
+                    'n_rows_kline': self.n_rows_kline,
+                    'n_rows_alarm': self.n_rows_alarm,
+                    'n_pending_table': len(self.info_kline),
+                    'last_ms': float(arr[-1]) if arr.size else None,
+                    'p50_ms': float(np.percentile(arr, 50)) if arr.size else None,
+                    'p99_ms': float(np.percentile(arr, 99)) if arr.size else None,
+                    }
+        return info
+
+
+class PersistWorker(BatchWriter):
+    ''' 数据写入 (write-behind)
+    报警程序不需要等待k线写入数据表: commit()只把本次运行的数据放入队列，
+    后台线程从队列中取出(多批合并)，一个事务写入数据表。
+        队列满时(settings.n_persist_queue)，数据保留，下一次commit()一起放入队列；
+        写入失败时，按指数增加的间隔重试(settings.n_persist_backoff)，数据不丢弃。
+    flush(): 等待写入完成; stop(): 退出前(信号、关闭窗口)写入剩余的数据。
+    一个写入线程、按时间顺序写入，数据表中的k线是内存中k线的前缀，
+    异常退出时没有写入的k线(数据表的最后一个k线之后)，启动时由KlineInfo.recover()重新下载。
+    '''
+    # 队列, 每项: (放入队列的时间, info_kline, arr_df_alarm)
+    #             or threading.Event() (flush)
+    #             or None (停止)
+    obj_queue = None
+    # 写入线程
+    thread = None
+    # 停止标志 (不再重试)
+    event_stop = None
+    # 延迟(秒): 放入队列 ---> 写入数据表
+    arr_lag = None
+    # 统计: 队列满、重试的次数
+    n_full = None
+    n_retry = None
+
+    def __init__(self, obj_DataTable):
+        super().__init__(obj_DataTable)
+        self.obj_queue = queue.Queue(maxsize=settings.n_persist_queue)
+        self.event_stop = threading.Event()
+        self.arr_lag = collections.deque(maxlen=1000)
+        self.n_full = self.n_retry = 0
+        self.thread = threading.Thread(
+                target=self.run, name='persist', daemon=True,
+                )
+        self.thread.start()
+
+    def commit(self):
+        ''' 待写入的数据放入队列 (不等待写入)
+            返回值: 放入队列的(k线的数量, 报警信息的数量)
+        '''
+        if not self.thread.is_alive():
+            # 已经停止，直接写入
+            return super().commit()
+        info_kline, arr_df_alarm = self.take()
+        if not info_kline and not arr_df_alarm:
+            return 0, 0
+        try:
+            self.obj_queue.put_nowait((time.time(), info_kline, arr_df_alarm))
+        except queue.Full:
+            self.restore(info_kline, arr_df_alarm)
+            with self.lock:
+                self.n_full += 1
+            logger.warning('数据写入的队列已满，数据保留到下一次')
+            return 0, 0
+        return (
+                sum(len(df) for arr_df in info_kline.values() for df in arr_df),
+                sum(len(df) for df in arr_df_alarm),
+                )
+
+    def flush(self, timeout=None):
+        ''' 待写入的数据全部写入数据表 (等待)
+            返回值: 是否完成
+        '''
+        if not self.thread.is_alive():
+            super().commit()
+            return not self.info_kline and not self.arr_df_alarm
+        time_end = None if timeout is None else time.time() + timeout
+        get_timeout = lambda: None if time_end is None else max(0.0, time_end - time.time())
+        event = threading.Event()
+        info_kline, arr_df_alarm = self.take()
+        try:
+            if info_kline or arr_df_alarm:
+                self.obj_queue.put(
+                        (time.time(), info_kline, arr_df_alarm),
+                        timeout=get_timeout(),
+                        )
+                info_kline, arr_df_alarm = {}, []
+            self.obj_queue.put(event, timeout=get_timeout())
+        except queue.Full:
+            self.restore(info_kline, arr_df_alarm)
+            return False
+        return event.wait(get_timeout())
+
+    def stop(self, timeout=None):
+        ''' 停止写入线程 (待写入的数据写入数据表后)，最多等待timeout秒
+            返回值: 是否写入完成
+        '''
+        if self.event_stop.is_set():
+            return True
+        flag = self.flush(timeout)
+        self.event_stop.set()
+        try:
+            self.obj_queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if flag:
+            self.thread.join(timeout)
+            logger.info(f'数据写入已停止: {self.get_stats()}')
+        else:
+            logger.error(f'退出时数据没有全部写入数据表，下次启动时重新下载k线: {self.get_stats()}')
+        return flag
+
+    def run(self):
+        ''' 写入线程 '''
+        while True:
+            item = self.obj_queue.get()
+            if item is None:
+                return
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            # 队列中的多批数据合并，一个事务
+            arr_item, arr_control = [item], []
+            while True:
+                try:
+                    item = self.obj_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, tuple):
+                    arr_item.append(item)
+                else:
+                    arr_control.append(item)
+                    break
+            self.write_retry(arr_item)
+            for item in arr_control:
+                if item is None:
+                    return
+                item.set()
+
+    def write_retry(self, arr_item):
+        ''' 写入数据表，失败时重试 (停止后不再重试，数据放回) '''
+        info_kline, arr_df_alarm = {}, []
+        for _, info, arr_df in arr_item:
+            for t_name, arr in info.items():
+                info_kline.setdefault(t_name, []).extend(arr)
+            arr_df_alarm.extend(arr_df)
+        i = 0
+        while True:
+            try:
+                self.write(info_kline, arr_df_alarm)
+                break
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                if self.event_stop.is_set():
+                    logger.error(f'写入数据表失败: {e!r}')
+                    self.restore(info_kline, arr_df_alarm)
+                    return
+                logger.warning(f'写入数据表失败，第{i + 1}次重试: {e!r}')
+                with self.lock:
+                    self.n_retry += 1
+                self.event_stop.wait(min(settings.n_persist_backoff * 2 ** i, 60))
+                i += 1
+        time_now = time.time()
+        with self.lock:
+            self.arr_lag.extend(time_now - item[0] for item in arr_item)
+
+    def get_stats(self):
+        ''' 统计信息，事务时间、延迟的单位: 毫秒 '''
+        info = super().get_stats()
+        with self.lock:
+            arr = np.array(self.arr_lag) * 1000
+            info.update({
+                    'n_queue': self.obj_queue.qsize(),
+                    'n_full': self.n_full,
+                    'n_retry': self.n_retry,
+                    'lag_p50_ms': float(np.percentile(arr, 50)) if arr.size else None,
+                    'lag_p99_ms': float(np.percentile(arr, 99)) if arr.size else None,
+                    })
+        return info
 
 
 class KlineInfo:
@@ -458,7 +1413,12 @@ class KlineInfo:
             value   SingleStockInfo()
     报警程序, info_program, dict
             key     (algorithm, arr_tock_code, arr_program, other_kwargs)
-            value   SingleAlarmProgram()
+            value   报警程序的信息 (SingleAlarmProgram.info_program)
+    执行计划, obj_ExecutionPlan
+            报警程序展开为任务(algorithm, kwargs, stock_code, period)，去除重复后执行
+    全市场筛选(arr_stock_code为股票范围), obj_CrossSection
+            所有筛选程序共用的CrossSectionStore()
+            报警程序为ScreeningProgram()
     '''
     # 数据表
     obj_DataTable = None
@@ -468,36 +1428,259 @@ class KlineInfo:
     info_stock = None
     # 报警程序
     info_program = None
+    # 执行计划
+    obj_ExecutionPlan = None
     # 报警信息的内容
     arr_alarm_msg = None
     # k线分析周期
     period_base = None
+    # k线缺口检测
+    obj_GapScanner = None
+    # 最后一次闭市后缺口检测的日期
+    date_gap_scan = None
+    # 线程锁: 定时下载、推送行情，不能同时修改k线数据
+    lock = None
+    # 推送行情的适配器
+    obj_feed = None
+    # 推送行情的线程
+    thread_feed = None
+    # 推送行情的停止标志
+    event_feed_stop = None
+    # 推送行情产生报警时，调用的函数
+    func_alarm = None
+    # 报警信息的通知 (notify.NotifyDispatcher)，None: 打印
+    obj_Notify = None
+    # 数据写入 (后台线程，一次运行一个事务)
+    obj_Writer = None
+    # 全市场筛选的k线数据
+    obj_CrossSection = None
+    # 价格报警
+    obj_PriceLevel = None
+    # 重新读取报警程序的命令
+    event_reload = None
+    # 最后一次检查报警程序数据表的时间 (time.time())
+    time_program_check = None
+    # 快照 (快速重启)
+    obj_Snapshot = None
+    # 从快照恢复了报警程序的运行状态，不需要第一次运行(only_once)
+    flag_warm_start = None
+    # 最后一次保存快照的时间 (time.time())
+    time_snapshot = None
 
     def __init__(self):
         self.period_base = '1m'
         self.info_program = {}
         self.info_stock = {}
+        self.lock = threading.RLock()
+        self.event_reload = threading.Event()
+        self.time_program_check = time.time()
         self.obj_DataTable = DataTable()
+        self.obj_Writer = PersistWorker(self.obj_DataTable)
         self.obj_DataSource = JqData(self.obj_DataTable)
+        # 快照: k线数据(mmap)、报警程序的运行状态
+        t_begin = time.time()
+        self.obj_Snapshot = snapshot.StateSnapshot()
+        self.obj_Snapshot.load(self.obj_DataTable, self.period_base)
         # 获取报警信息(k线数据，报警程序)
         self.get_alarm_info()
+        # 价格报警
+        self.obj_PriceLevel = PriceLevelAlarm(self)
+        self.obj_PriceLevel.reload()
+        self.flag_warm_start = self.obj_Snapshot.restore_program(self)
+        self.obj_Snapshot.release()
+        self.time_snapshot = time.time()
+        logger.info(f'k线数据、报警程序加载完成, 快照恢复: {self.flag_warm_start}, run time: {time.time() - t_begin:.3f}s')
+        # 启动时的恢复: 补充k线数据的缺口，上次没有写入数据表的k线重新下载
+        self.obj_GapScanner = GapScanner(self)
+        self.recover()
+
+    def recover(self):
+        ''' 启动时的恢复
+            k线按时间顺序写入数据表(PersistWorker)，数据表的最后一个k线(水位)之前是完整的，
+            异常退出时没有写入的k线都在水位之后:
+                水位之后 ---> download_new_data()，中间的缺口 ---> GapScanner
+            报警程序第一次运行之前，下载的k线写入数据表
+        '''
+        self.obj_GapScanner.run()
+        try:
+            self.download_new_data()
+        except ValueError as e:
+            logger.error(f'recover() ... {e}')
+        self.obj_Writer.flush()
+
+    def close(self, timeout=None):
+        ''' 退出前: 停止推送行情，待写入的数据写入数据表(最多等待timeout秒)，保存快照 '''
+        self.stop_feed()
+        flag = self.obj_Writer.stop(timeout)
+        self.save_snapshot()
+        return flag
+
+    def save_snapshot(self):
+        ''' 保存快照
+            返回值: 快照的字节数，失败: None
+        '''
+        with self.lock:
+            self.time_snapshot = time.time()
+            try:
+                return self.obj_Snapshot.save(self)
+            except OSError as e:
+                logger.error(f'保存快照失败: {e!r}')
+                return None
+
+    def check_snapshot(self):
+        ''' 定时保存快照 (settings.n_snapshot_minutes) '''
+        n_minutes = settings.n_snapshot_minutes
+        if 0 < n_minutes and n_minutes * 60 <= time.time() - self.time_snapshot:
+            self.save_snapshot()
+
+    def get_memory_report(self):
+        ''' 内存报告: 进程、每个股票的k线数据、内存预算、指标缓存、全市场筛选 (字节) '''
+        info_stock = {}
+        for stock_code, obj_stock in list(self.info_stock.items()):
+            info_period = obj_stock.data_kline.get_report()
+            info_stock[stock_code] = {
+                    'n_bars': info_period[obj_stock.period_base]['n_bars'],
+                    'frame_bytes': sum(
+                        info['frame_bytes'] for info in info_period.values()
+                        ),
+                    'packed_bytes': info_period[obj_stock.period_base].get('packed_bytes', 0),
+                    'n_evicted': sum(
+                        not info['loaded'] for info in info_period.values()
+                        ),
+                    'n_rebuild': obj_stock.data_kline.n_rebuild,
+                    'period': info_period,
+                    }
+        return {
+                'kline': kline_store.get_stats(),
+                'indicator': indicator_cache.obj_cache.get_stats(),
+                'cross_section_bytes': (
+                    self.obj_CrossSection.get_nbytes()
+                    if self.obj_CrossSection is not None else 0
+                    ),
+                'stock': info_stock,
+                }
 
     def run_cron(self, only_once):
         ''' 定时执行 '''
-        # 下载最新的行情数据
-        logger.debug('下载最新的行情数据 ...')
-        self.download_new_data()
-        # 遍历报警程序
-        logger.debug('遍历报警程序 ...')
-        flag = self.traverse_the_alarm_program(only_once)
+        with self.lock:
+            # 插件热更新 (两次运行之间替换)
+            self.reload_plugin()
+            # 报警程序的变化
+            self.check_reload()
+            # 下载最新的行情数据
+            logger.debug('下载最新的行情数据 ...')
+            self.download_new_data()
+            # 遍历报警程序
+            logger.debug('遍历报警程序 ...')
+            flag = self.traverse_the_alarm_program(only_once)
+            # 新的k线、报警信息放入写入队列 (后台线程写入数据表，一个事务)
+            self.obj_Writer.commit()
+            self.check_snapshot()
         return flag
 
+    def reload_plugin(self):
+        ''' 插件文件修改后，重新加载，k线数据保持不变
+            返回值: 重新加载的插件 [algorithm, ...]
+        '''
+        arr_algorithm = plugin_registry.check_reload()
+        if arr_algorithm:
+            # 插件的计算方法可能改变，删除指标的缓存
+            indicator_cache.obj_cache.clear()
+            self.obj_ExecutionPlan.reload_plugin(arr_algorithm)
+            # 插件可能已经修正，解除隔离
+            for algorithm in arr_algorithm:
+                plugin_budget.obj_supervisor.release(algorithm)
+        return arr_algorithm
+
+    def start_feed(self, obj_feed, func_alarm=None):
+        ''' 启动推送行情
+            obj_feed        推送行情的适配器, feed.QuoteFeed
+            func_alarm      产生报警时，调用的函数
+        '''
+        self.stop_feed()
+        self.obj_feed = obj_feed
+        self.func_alarm = func_alarm
+        self.event_feed_stop = threading.Event()
+        self.thread_feed = threading.Thread(
+                target=self.run_feed, name='feed', daemon=True
+                )
+        self.thread_feed.start()
+
+    def stop_feed(self):
+        ''' 停止推送行情 '''
+        if self.thread_feed is None:
+            return
+        self.event_feed_stop.set()
+        self.obj_feed.close()
+        self.thread_feed.join()
+        self.thread_feed = None
+
+    def run_feed(self):
+        ''' 推送行情的线程
+            k线结束 ---> 更新k线数据 ---> 执行相关的报警程序
+        '''
+        while not self.event_feed_stop.is_set():
+            info = self.obj_feed.read(timeout=1)
+            with self.lock:
+                arr_closed = []
+                if info is not None:
+                    arr_closed.extend(self.push_message(info))
+                # tick合成的k线，分钟结束
+                now = datetime.datetime.now()
+                for obj_stock in self.info_stock.values():
+                    arr_closed.extend(obj_stock.flush_tick(now))
+                if arr_closed:
+                    self.trigger_alarm_program(arr_closed)
+                    self.obj_Writer.commit()
+
+    def push_message(self, info):
+        ''' 处理一条推送消息
+        返回值: 结束的k线
+            [(stock_code, period, date), ...]
+        '''
+        obj_stock = self.info_stock.get(info['stock_code'])
+        if obj_stock is None:
+            logger.debug(f'push_message() ... 不需要的股票代码: {info}')
+            return []
+        if info['type'] == 'bar':
+            return obj_stock.push_bar(
+                    info['date'], info['open'], info['high'], info['low'],
+                    info['close'],
+                    )
+        return obj_stock.push_tick(info['date'], info['price'])
+
+    def trigger_alarm_program(self, arr_closed):
+        ''' 执行结束的k线相关的报警程序
+            arr_closed      [(stock_code, period, date), ...]
+                date            1m k线的开始时间
+        '''
+        # 报警程序的运行时间: 1m k线的结束时间
+        info_label = {}
+        for stock_code, period, date in arr_closed:
+            s_now = (date + Minute(1)).strftime('%Y-%m-%d %H:%M')
+            info_label.setdefault(s_now, set()).add((stock_code, period))
+        for s_now, arr_label in sorted(info_label.items()):
+            flag = self.traverse_the_alarm_program(False, s_now, arr_label)
+            if flag and self.func_alarm:
+                self.func_alarm()
+
     def download_new_data(self):
-        ''' 下载最新行情 '''
-        arr_code = list(self.info_stock.keys())
+        ''' 下载最新行情
+            按交易日历检查缺失的k线，没有缺失时不访问数据源。
+        '''
+        if self.obj_CrossSection is not None:
+            # 全市场筛选
+            self.obj_CrossSection.download()
+        arr_code = [
+                code for code, obj in self.info_stock.items()
+                if obj.count_bars_missing()
+                ]
+        if not arr_code:
+            logger.debug('download_new_data() ... 没有缺失的k线数据')
+            return
         start_date = min([
-                obj.get_last_date(self.period_base)
-                for obj in self.info_stock.values()
+                self.info_stock[code].get_last_date(self.period_base)
+                for code in arr_code
                 ])
         info = self.obj_DataSource.get_data_missing(
                 arr_code, self.period_base, start_date, offset_right=True,
@@ -507,34 +1690,68 @@ class KlineInfo:
             df_new = obj_stock.data_merge(self.period_base, df)
             if df_new.empty:
                 continue
-            # 下载数据，写入数据表
-            obj_stock.obj_db.save_db__kline(df_new, obj_stock.table_name)
+            # 下载数据，写入数据表 (本次运行结束时放入写入队列)
+            self.obj_Writer.add_kline(obj_stock.table_name, df_new)
             # 更新k线其它周期的数据
             obj_stock.period_update()
 
+    def check_after_close(self, now=None):
+        ''' 闭市后，每个交易日执行一次: 补充k线数据的缺口，报警信息归档
+            与定时执行、推送行情修改相同的k线数据，在线程锁中执行
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        today = now.date()
+        if self.date_gap_scan == today:
+            return
+        arr_calendar = [
+                obj for obj in self.get_calendar() if obj.is_trading_day(today)
+                ]
+        if not arr_calendar:
+            return
+        if all(obj.session_close(today) < now for obj in arr_calendar):
+            with self.lock:
+                if self.date_gap_scan == today:
+                    return
+                self.date_gap_scan = today
+                self.obj_GapScanner.run(now)
+                # 报警信息: 超过保留时间的分区归档
+                self.obj_DataTable.archive__alarm_message(today)
+
+    def get_calendar(self):
+        ''' 所有股票的交易日历 '''
+        arr_calendar = set(
+                obj.obj_calendar for obj in self.info_stock.values()
+                )
+        if not arr_calendar:
+            arr_calendar.add(
+                    trading_calendar.get_calendar(settings.market_default)
+                    )
+        return arr_calendar
+
+    def calc_session(self, now, t_extend=datetime.timedelta(0)):
+        ''' 开市状态
+        返回值: (market_opening, next_time)
+            market_opening      开市期间 (包含闭市后继续运行的时间t_extend)
+            next_time           下一个开市时间
+        '''
+        return trading_calendar.calc_session(self.get_calendar(), now, t_extend)
+
     def get_alarm_info(self):
         ''' 从数据库读取需要报警的股票代码 '''
-        df_name = self.obj_DataTable.read_db__stock_code()
+        self.apply_program_info(self.read_program_info())
+
+    def read_program_info(self):
+        ''' 读取数据表: 报警程序 (不读取k线数据)
+        返回值: dict
+            key     (algorithm, arr_stock_code, arr_period, other_kwargs)
+            value   报警程序的信息
+        '''
         df_alarm_program = self.obj_DataTable.read_db__alarm_program()
+        info_program = {}
         for i, row in df_alarm_program.iterrows():
             logger.debug(f'{i}# \t({row.algorithm}, {row.arr_stock_code}, {row.arr_period}, {row.other_kwargs}), {row.remark}')
-            # k线数据
             arr_stock_code = json.loads(row.arr_stock_code)
-            arr_period = json.loads(row.arr_period)
-            for stock_code in arr_stock_code:
-                obj_code = self.info_stock.get(stock_code)
-                if obj_code is None:
-                    stock_name = df_name.loc[stock_code, 'display_name']
-                    obj_code = SingleStockInfo(
-                            stock_code, stock_name, self.period_base,
-                            obj_db=self.obj_DataTable,
-                            obj_source=self.obj_DataSource,
-                            )
-                    self.info_stock[stock_code] = obj_code
-                for period in arr_period:
-                    if period != obj_code.period_base:
-                        obj_code.period_add(period)
-            # 报警程序（若有重复值，取最后一个）
             if row.other_kwargs:
                 other_kwargs = json.loads(row.other_kwargs)
             else:
@@ -542,50 +1759,340 @@ class KlineInfo:
             info = {
                     'algorithm': row.algorithm,
                     'arr_stock_code': arr_stock_code,
-                    'arr_period': arr_period,
+                    'arr_period': json.loads(row.arr_period),
                     'other_kwargs': other_kwargs,
                     'remark': row.remark,
-                    'data_kline': obj_code.data_kline
+                    'info_stock': self.info_stock,
                     }
-            obj_program = SingleAlarmProgram(info)
+            if isinstance(arr_stock_code, str):
+                # 全市场筛选，股票范围
+                info['universe'] = arr_stock_code
             key = (
                     row.algorithm, row.arr_stock_code, row.arr_period,
                     row.other_kwargs,
                     )
-            self.info_program[key] = obj_program
+            # 报警程序（若有重复值，取最后一个）
+            info_program[key] = info
+        return info_program
+
+    def get_program_period(self, info_program):
+        ''' 每个股票需要的k线周期
+        返回值: dict
+            key     stock_code
+            value   set([period, ...])
+        '''
+        info_period = {}
+        for info in info_program.values():
+            if 'universe' in info:
+                continue
+            arr_period = list(info['arr_period'])
+            # 多个k线周期的算法，增加长周期
+            other_kwargs = info['other_kwargs']
+            if isinstance(other_kwargs, dict):
+                for name in ('period_long', 'period_short'):
+                    if other_kwargs.get(name):
+                        arr_period.append(other_kwargs[name])
+            for stock_code in info['arr_stock_code']:
+                info_period.setdefault(stock_code, set()).update(arr_period)
+        # 价格报警的股票 (基础周期)
+        if self.obj_PriceLevel is not None:
+            for stock_code in self.obj_PriceLevel.get_stock_code():
+                info_period.setdefault(stock_code, set())
+        return info_period
+
+    def get_program_lookback(self, obj_plan, info_period):
+        ''' 每个股票需要的基础周期k线数量 (插件的n_lookback，所有任务的最大值)
+            至少保留缺口检测的天数(settings.n_gap_scan_days + 1)
+            插件的n_lookback在增加、删除报警程序时生效
+        返回值: dict
+            key     stock_code
+            value   k线数量，None: 有插件没有声明(SingleStockInfo.limit_size)
+        '''
+        info_lookback = {}
+        for obj_program in obj_plan.info_runner.values():
+            info = obj_program.info_program
+            if 'universe' in info:
+                continue
+            arr_period_extra = []
+            other_kwargs = info['other_kwargs']
+            if isinstance(other_kwargs, dict):
+                arr_period_extra = [
+                        other_kwargs[name]
+                        for name in ('period_long', 'period_short')
+                        if other_kwargs.get(name)
+                        ]
+            for stock_code, period in obj_program.get_task():
+                if stock_code in info_lookback and info_lookback[stock_code] is None:
+                    continue
+                obj_calendar = trading_calendar.get_calendar(stock_code)
+                for period_task in [period] + arr_period_extra:
+                    n_bars = obj_program.get_lookback(period_task)
+                    if n_bars is not None:
+                        n_bars = calc_base_bars(
+                                obj_calendar, period_task, n_bars,
+                                self.period_base,
+                                )
+                    if n_bars is None:
+                        info_lookback[stock_code] = None
+                        break
+                    info_lookback[stock_code] = max(
+                            n_bars, info_lookback.get(stock_code, 0)
+                            )
+        for stock_code in info_period:
+            n_bars = info_lookback.get(stock_code, 0)
+            if n_bars is not None:
+                obj_calendar = trading_calendar.get_calendar(stock_code)
+                n_bars_min = calc_base_bars(
+                        obj_calendar, '1d', settings.n_gap_scan_days + 1,
+                        self.period_base,
+                        )
+                n_bars = max(n_bars, n_bars_min)
+            info_lookback[stock_code] = n_bars
+        return info_lookback
+
+    def apply_program_info(self, info_program):
+        ''' 按报警程序的变化，增量更新
+            新的股票: 读取k线数据，补充缺口
+            新的k线周期: period_add()
+            不再需要的k线周期、股票: period_remove()、删除
+            没有变化的报警程序，保留运行状态(上次运行时间、防止重复报警、指标缓存)
+        返回值: (增加的报警程序数量, 删除的报警程序数量)
+        '''
+        info_program_old = self.info_program
+        set_add = set(info_program) - set(info_program_old)
+        set_remove = set(info_program_old) - set(info_program)
+        for key in set(info_program) & set(info_program_old):
+            info_program_old[key]['remark'] = info_program[key]['remark']
+            info_program[key] = info_program_old[key]
+        # 编译执行计划 (已有的任务，保留运行状态)
+        obj_plan = ExecutionPlan()
+        for key, info in info_program.items():
+            obj_plan.add_program(key, info)
+        obj_plan.compile(self.obj_ExecutionPlan)
+        # k线数据
+        info_period = self.get_program_period(info_program)
+        info_lookback = self.get_program_lookback(obj_plan, info_period)
+        arr_code_new = [
+                code for code in info_period if code not in self.info_stock
+                ]
+        df_name = None
+        if arr_code_new:
+            df_name = self.obj_DataTable.read_db__stock_code()
+        for stock_code, set_period in info_period.items():
+            n_lookback = info_lookback[stock_code]
+            obj_code = self.add_stock(stock_code, df_name, n_lookback)
+            # 需要的k线数量增加: 读取更早的k线，减少: 截取
+            obj_code.set_lookback(n_lookback)
+            for period in set_period:
+                if period != obj_code.period_base:
+                    obj_code.period_add(period)
+            set_period_remove = (
+                    set(obj_code.data_kline) - set_period
+                    - {obj_code.period_base}
+                    )
+            for period in set_period_remove:
+                obj_code.period_remove(period)
+        for stock_code in set(self.info_stock) - set(info_period):
+            self.info_stock.pop(stock_code).data_kline.release()
+            indicator_cache.invalidate(stock_code)
+        if arr_code_new and self.obj_GapScanner is not None:
+            # 新的股票，补充k线数据的缺口
+            self.obj_GapScanner.run(arr_code=arr_code_new)
+        # 全市场筛选
+        self.get_screening_info(obj_plan)
+        self.obj_ExecutionPlan = obj_plan
+        self.info_program = info_program
+        n_bars = sum(
+                obj.data_kline.get_n_bars(obj.period_base)
+                for obj in self.info_stock.values()
+                )
+        logger.info(f'报警程序: 增加{len(set_add)}个, 删除{len(set_remove)}个; 股票: 增加{len(arr_code_new)}个, 共{len(self.info_stock)}个, 基础周期k线{n_bars}个')
+        return len(set_add), len(set_remove)
+
+    def reload_program(self):
+        ''' 重新读取报警程序数据表，有变化时增量更新 (定时检查 or 命令)
+            返回值: 是否有变化
+        '''
+        with self.lock:
+            self.event_reload.clear()
+            self.time_program_check = time.time()
+            info_program = self.read_program_info()
+            if set(info_program) == set(self.info_program):
+                for key, info in info_program.items():
+                    self.info_program[key]['remark'] = info['remark']
+                return False
+            self.apply_program_info(info_program)
+        return True
+
+    def request_reload(self):
+        ''' 重新读取报警程序的命令 (下一次定时执行前处理) '''
+        self.event_reload.set()
+
+    def check_reload(self):
+        ''' 收到命令 or 定时检查的时间到，重新读取报警程序数据表 '''
+        n_minutes = settings.n_program_check_minutes
+        flag = self.event_reload.is_set() or (
+                0 < n_minutes
+                and n_minutes * 60 <= time.time() - self.time_program_check
+                )
+        if flag:
+            return self.reload_program()
+        return False
+
+    def add_stock(self, stock_code, df_name=None, n_lookback=None):
+        ''' 增加监控的股票 (已存在时，不重复创建)
+        入口参数:
+            stock_code      股票代码
+            df_name         read_db__stock_code()，None: 读取数据表
+            n_lookback      需要的基础周期k线数量，None: SingleStockInfo.limit_size
+        返回值: SingleStockInfo() or KeyError(股票代码不存在)
+        '''
+        obj_code = self.info_stock.get(stock_code)
+        if obj_code is None:
+            if df_name is None:
+                df_name = self.obj_DataTable.read_db__stock_code()
+            stock_name = df_name.loc[stock_code, 'display_name']
+            data_kline = None
+            if self.obj_Snapshot is not None:
+                data_kline = self.obj_Snapshot.get_kline(
+                        stock_code, self.obj_DataTable
+                        )
+            obj_code = SingleStockInfo(
+                    stock_code, stock_name, self.period_base,
+                    obj_db=self.obj_DataTable,
+                    obj_source=self.obj_DataSource,
+                    data_kline=data_kline, n_lookback=n_lookback,
+                    )
+            obj_code.obj_Writer = self.obj_Writer
+            self.info_stock[stock_code] = obj_code
+        return obj_code
+
+    def get_universe(self, universe):
+        ''' 全市场筛选的股票范围
+        入口参数:
+            universe        "*" or "type:xxx"
+        返回值: list, [stock_code, ...]
+        '''
+        if universe == '*':
+            return self.obj_DataTable.read_db__stock_universe()
+        prefix, sep, str_type = universe.partition(':')
+        if prefix == 'type' and sep and str_type:
+            return self.obj_DataTable.read_db__stock_universe(str_type)
+        raise ValueError(f'股票范围错误: {universe}')
+
+    def get_screening_lookback(self, arr_program, obj_calendar):
+        ''' 全市场筛选需要的基础周期k线数量 (插件的n_lookback，所有筛选程序的最大值)
+            至少settings.n_screen_bars；有插件没有声明 or 无法换算: settings.n_screen_bars
+        '''
+        n_max = settings.n_screen_bars
+        for obj_program in arr_program:
+            arr_period = list(obj_program.info_program['arr_period'])
+            period_long = obj_program.get_period_long()
+            if period_long is not None:
+                arr_period.append(period_long)
+            for period in arr_period:
+                n_bars = obj_program.get_lookback(period)
+                if n_bars is not None:
+                    n_bars = calc_base_bars(
+                            obj_calendar, period, n_bars, self.period_base
+                            )
+                if n_bars is None:
+                    return settings.n_screen_bars
+                n_max = max(n_max, n_bars)
+        return n_max
+
+    def get_screening_info(self, obj_plan):
+        ''' 全市场筛选的报警程序 (执行计划中的ScreeningProgram)
+            所有筛选程序的股票范围合并，共用一个CrossSectionStore；
+            每个股票保留的k线数量由插件的n_lookback换算(get_screening_lookback())；
+            股票范围、k线数量不变时，保留原来的k线数据。
+        '''
+        arr_program = [
+                obj_program for obj_program in obj_plan.info_runner.values()
+                if 'universe' in obj_program.info_program
+                ]
+        if not arr_program:
+            self.obj_CrossSection = None
+            return
+        info_universe = {}
+        for obj_program in arr_program:
+            info = obj_program.info_program
+            universe = info['universe']
+            if universe not in info_universe:
+                info_universe[universe] = self.get_universe(universe)
+            info['arr_stock_code'] = info_universe[universe]
+        set_code = set()
+        for arr_code in info_universe.values():
+            set_code.update(arr_code)
+        arr_code = sorted(set_code)
+        if arr_code:
+            obj_calendar = trading_calendar.get_calendar(arr_code[0])
+        else:
+            obj_calendar = trading_calendar.get_calendar(settings.market_default)
+        n_bars = self.get_screening_lookback(arr_program, obj_calendar)
+        if (
+                self.obj_CrossSection is None
+                or self.obj_CrossSection.arr_stock_code != arr_code
+                or self.obj_CrossSection.n_bars != n_bars
+                ):
+            self.obj_CrossSection = CrossSectionStore(
+                    arr_code, self.obj_DataSource, self.period_base, n_bars,
+                    )
+            logger.info(f'全市场筛选: {len(arr_code)}个股票, 每个股票{n_bars}个k线, 内存: {self.obj_CrossSection.get_nbytes() / 1024 / 1024:.1f}MB')
+        for obj_program in arr_program:
+            obj_program.info_program['obj_CrossSection'] = self.obj_CrossSection
+            obj_program.obj_calendar = self.obj_CrossSection.obj_calendar
 
-    def traverse_the_alarm_program(self, only_once):
+    def traverse_the_alarm_program(self, only_once, s_now=None, arr_label=None):
         ''' 遍历报警程序
+        入口参数:
+            only_once       第一次运行的标志
+            s_now           运行时间，None: 当前时间
+            arr_label       仅执行指定的(stock_code, period)，None: 全部
         报警算法的返回值：
             None or tuple
                 ((stock_code, period, s_now, message), ...)
         '''
         flag = False
         now = datetime.datetime.now()
-        s_now = now.strftime('%Y-%m-%d %H:%M')
+        if s_now is None:
+            s_now = now.strftime('%Y-%m-%d %H:%M')
         self.arr_alarm_msg = []
-        df_alarm_message = self.obj_DataTable.read_db__alarm_message()
-        for alarm_program in self.info_program.values():
-            arr_msg = alarm_program.run(s_now, only_once)
-            if arr_msg:
-                # 去除重复数据
-                arr_msg = self.check_repeat(df_alarm_message, arr_msg)
-                self.arr_alarm_msg.extend(arr_msg)
+        arr_program = [self.obj_ExecutionPlan]
+        if self.obj_PriceLevel is not None:
+            arr_program.append(self.obj_PriceLevel)
+        arr_msg = []
+        for alarm_program in arr_program:
+            arr_msg.extend(alarm_program.run(s_now, only_once, arr_label) or ())
+        if arr_msg:
+            # 去除重复数据 (仅读取报警时间范围内的报警信息)
+            self.arr_alarm_msg.extend(self.check_repeat(arr_msg))
         if self.arr_alarm_msg:
             df_msg = self.save_alarm_message()
-            self.output_alarm_msg(df_msg)
+            self.output_alarm_msg(df_msg, only_once)
             flag = True
             logger.debug(f'flag: {flag}, arr_alarm_msg: {self.arr_alarm_msg}')
         logger.debug(f'traverse_the_alarm_program() ... s_now: {s_now}, flag: {flag}, run time: {(datetime.datetime.now() - now).total_seconds()}s')
         return flag
 
-    def check_repeat(self, df_alarm_message, arr_msg):
-        ''' 输出报警信息 '''
+    def check_repeat(self, arr_msg):
+        ''' 去除数据表中已有的报警信息
+            arr_msg     [(s_now, stock_code, period, message), ...]
+        '''
+        arr_s_now = [record[0] for record in arr_msg]
+        # 还在写入队列中的报警信息 (先于数据表读取: 写入事务提交后才从队列中删除，
+        # 读取之间提交的报警信息，至少在其中一个里)
+        set_label = self.obj_Writer.get_alarm_label()
+        df_alarm_message = self.obj_DataTable.read_db__alarm_message__range(
+                min(arr_s_now), max(arr_s_now),
+                )
+        set_label.update(df_alarm_message.index)
         arr_msg_new = []
         for record in arr_msg:
-            stock_code, period, s_now, message = record
-            label = (stock_code, period, s_now)
-            if label not in df_alarm_message.index:
+            s_now, stock_code, period, message = record
+            label = (s_now, stock_code, period)
+            if label not in set_label:
+                set_label.add(label)
                 arr_msg_new.append(record)
         return tuple(arr_msg_new)
 
@@ -595,13 +2102,504 @@ class KlineInfo:
         df = pd.DataFrame(self.arr_alarm_msg, columns=arr_column)
         df.set_index(index_name, inplace=True)
         df.sort_index(inplace=True)
-        self.obj_DataTable.save_db__alarm_message(df)
+        # 本次运行结束时，与新的k线一起放入写入队列
+        self.obj_Writer.add_alarm(df)
         logger.debug(f'save_alarm_message() ...\n{df}')
         return df
 
-    def output_alarm_msg(self, df_msg):
-        ''' 输出报警信息 '''
-        print(df_msg)
+    def output_alarm_msg(self, df_msg, only_once=False):
+        ''' 输出报警信息
+            有obj_Notify时放入通知队列，不等待通知完成
+        '''
+        if self.obj_Notify is None:
+            print(df_msg)
+            return
+        self.obj_Notify.publish(self.arr_alarm_msg, only_once)
+
+
+class ExecutionPlan:
+    ''' 报警程序的执行计划 (KlineInfo.get_alarm_info()编译)
+    报警程序(alarm_program_info的一行) ---> 任务(algorithm, kwargs, stock_code, period)
+        kwargs为other_kwargs的规范json(sort_keys)，参数相同、书写顺序不同的报警程序，合并。
+    任务去除重复后，按(algorithm, kwargs)分组，每组由一个SingleAlarmProgram执行:
+        插件只加载一次，批量接口一次调用，每个任务每次只执行一次。
+        全市场筛选按(algorithm, kwargs, universe)分组，由ScreeningProgram执行。
+    任务的报警信息，分发给包含该任务的所有报警程序(info_program['arr_alarm_msg'])。
+    每组在自己的工作线程中执行，有执行预算(plugin_budget，按runner_key)，
+    一个分组超时，不影响其他分组的报警。
+    超时的结果丢弃，运行状态不更新(SingleAlarmProgram.evaluate())，下次运行重新检查这些k线；
+    超时的任务还在运行时，该分组跳过。
+    '''
+    # 分组的任务, runner_key ---> {(stock_code, period): None, ...} (有序集合)
+    info_task = None
+    # 分组的报警程序信息(第一个报警程序), runner_key ---> info_program
+    info_runner_program = None
+    # 执行任务, runner_key ---> SingleAlarmProgram()
+    info_runner = None
+    # 任务 ---> 报警程序, runner_key + (stock_code, period) ---> [info_program, ...]
+    info_subscriber = None
+    # 报警程序的信息 [info_program, ...]
+    arr_program = None
+    # 展开的任务数量
+    n_task_request = None
+
+    def __init__(self):
+        self.info_task = {}
+        self.info_runner_program = {}
+        self.info_runner = {}
+        self.info_subscriber = {}
+        self.arr_program = []
+        self.n_task_request = 0
+
+    def add_program(self, key, info):
+        ''' 增加报警程序，展开为任务
+        入口参数:
+            key             报警程序的键值 (KlineInfo.info_program)
+            info            报警程序的信息
+        '''
+        s_kwargs = json.dumps(info['other_kwargs'], sort_keys=True)
+        if 'universe' in info:
+            runner_key = (info['algorithm'], s_kwargs, info['universe'])
+            arr_task = [('*', period) for period in info['arr_period']]
+        else:
+            runner_key = (info['algorithm'], s_kwargs)
+            arr_task = [
+                    (stock_code, period)
+                    for stock_code in info['arr_stock_code']
+                    for period in info['arr_period']
+                    ]
+        info['arr_alarm_msg'] = []
+        self.info_runner_program.setdefault(runner_key, info)
+        info_task = self.info_task.setdefault(runner_key, {})
+        for task in arr_task:
+            info_task[task] = None
+            self.info_subscriber.setdefault(runner_key + task, []).append(info)
+        self.arr_program.append(info)
+        self.n_task_request += len(arr_task)
+
+    def compile(self, obj_plan_old=None):
+        ''' 每组任务，创建一个报警程序
+            obj_plan_old中已有的分组，使用原来的报警程序(保留运行状态)，更新任务。
+        返回值: None or ValueError(报警程序不存在)
+        '''
+        self.info_runner = {}
+        if obj_plan_old is not None:
+            info_runner_old = obj_plan_old.info_runner
+        else:
+            info_runner_old = {}
+        for runner_key, info_task in self.info_task.items():
+            arr_task = list(info_task)
+            info = dict(self.info_runner_program[runner_key])
+            info['arr_period'] = list(dict.fromkeys(
+                    period for _, period in arr_task
+                    ))
+            if 'universe' not in info:
+                info['arr_task'] = arr_task
+                info['arr_stock_code'] = list(dict.fromkeys(
+                        stock_code for stock_code, _ in arr_task
+                        ))
+            obj_program = info_runner_old.get(runner_key)
+            if obj_program is not None:
+                obj_program.info_program.update(info)
+            elif 'universe' in info:
+                obj_program = ScreeningProgram(info)
+            else:
+                obj_program = SingleAlarmProgram(info)
+            self.info_runner[runner_key] = obj_program
+        logger.info(f'执行计划: {len(self.arr_program)}个报警程序, {self.n_task_request}个任务, 去除重复后{self.count_task()}个任务, {len(self.info_runner)}组')
+
+    def reload_plugin(self, arr_algorithm):
+        ''' 插件重新加载后，替换报警程序的算法函数 (保留运行状态) '''
+        for runner_key, obj_program in self.info_runner.items():
+            if runner_key[0] not in arr_algorithm:
+                continue
+            try:
+                obj_program.set_module(
+                        plugin_registry.get_module(runner_key[0])
+                        )
+            except ValueError as e:
+                logger.error(f'{e}, 继续使用原来的算法函数')
+
+    def count_task(self):
+        ''' 去除重复后的任务数量 '''
+        return sum(len(info_task) for info_task in self.info_task.values())
+
+    def run(self, s_now, only_once, arr_label=None):
+        ''' 执行所有任务 (接口同SingleAlarmProgram.run())
+            报警信息分发给包含该任务的报警程序；返回值不重复。
+        '''
+        for info in self.arr_program:
+            info['arr_alarm_msg'] = []
+        arr_runner = list(self.info_runner.items())
+        arr_result = plugin_budget.obj_supervisor.run([
+                (
+                    runner_key, obj_program.n_budget_seconds,
+                    obj_program.evaluate, (s_now, only_once, arr_label),
+                    )
+                for runner_key, obj_program in arr_runner
+                ])
+        arr_alarm_msg = []
+        for (runner_key, obj_program), result in zip(arr_runner, arr_result):
+            if result is None:
+                # 超时、错误、隔离、跳过: 运行状态不变
+                continue
+            arr_msg, info_state = result
+            obj_program.apply_state(info_state)
+            if not arr_msg:
+                continue
+            for record in arr_msg:
+                arr_info = self.info_subscriber.get(
+                        runner_key + (record[1], record[2])
+                        )
+                if arr_info is None:
+                    arr_info = self.info_subscriber.get(
+                            runner_key + ('*', record[2]), ()
+                            )
+                for info in arr_info:
+                    info['arr_alarm_msg'].append(record)
+            arr_alarm_msg.extend(arr_msg)
+        return arr_alarm_msg
+
+
+class PriceLevelAlarm:
+    ''' 价格报警 (内置的报警引擎)
+    数据表alarm_price_level中的每条记录为一个价格，例如: 000300.XSHG上穿4850。
+    每个股票的价格按方向分别保存在排序的数组中，
+    新的k线用二分查找得到穿越的价格，O(log n + k):
+        上穿: prev < price <= high
+        下穿: low <= price < prev
+        prev为上一个k线的收盘价；price_type='close'时，high、low为收盘价。
+    报警程序数据表检查时(定时settings.n_program_check_minutes or 命令)，同时检查数据表的版本，
+    增加、删除价格后重新加载，不需要重启程序 (每次运行都计算整个数据表的md5，开销较大)。
+    接口与SingleAlarmProgram相同，报警信息写入alarm_message。
+    '''
+    # k线数据
+    obj_KlineInfo = None
+    # 数据表的版本
+    version = None
+    # 价格索引, (stock_code, price_type) ---> {'up': (arr_price, arr_id), 'down': ...}
+    info_index = None
+    # 价格的信息, id ---> (price, remark)
+    info_level = None
+    # 已检查的最后k线时间, (stock_code, price_type) ---> pandas.Timestamp
+    info_last_time = None
+    # 上次检查数据表版本的时间
+    time_check = None
+
+    def __init__(self, obj_KlineInfo):
+        self.obj_KlineInfo = obj_KlineInfo
+        self.info_index = {}
+        self.info_level = {}
+        self.info_last_time = {}
+        self.time_check = 0
+
+    def check_reload(self):
+        ''' 报警程序数据表检查后(KlineInfo.reload_program())，检查价格报警数据表的版本
+            返回值: 是否重新加载
+        '''
+        time_program_check = self.obj_KlineInfo.time_program_check
+        if time_program_check is None or time_program_check <= self.time_check:
+            return False
+        return self.reload()
+
+    def reload(self):
+        ''' 数据表的版本改变时，重新加载价格
+            返回值: 是否重新加载
+        '''
+        self.time_check = time.time()
+        obj_db = self.obj_KlineInfo.obj_DataTable
+        version = obj_db.read_db__alarm_price_level__version()
+        if version == self.version:
+            return False
+        df = obj_db.read_db__alarm_price_level()
+        df['direction'] = df['direction'].fillna('')
+        df['price_type'] = df['price_type'].fillna('')
+        df['remark'] = df['remark'].fillna('')
+        mask = (
+                df['direction'].isin(['', 'up', 'down'])
+                & df['price_type'].isin(['', 'close'])
+                )
+        for row in df[~mask].itertuples():
+            logger.error(f'价格报警的参数错误: id={row.id}, direction={row.direction}, price_type={row.price_type}')
+        df = df[mask]
+        # 增加监控的股票
+        set_code = set(df['stock_code']) - set(self.obj_KlineInfo.info_stock)
+        if set_code:
+            df_name = obj_db.read_db__stock_code()
+            for stock_code in sorted(set_code):
+                try:
+                    self.obj_KlineInfo.add_stock(stock_code, df_name)
+                except (KeyError, ValueError) as e:
+                    logger.error(f'价格报警的股票代码错误: {stock_code}, {e}')
+        # 价格索引
+        info_index = {}
+        for key, df_code in df.groupby(['stock_code', 'price_type']):
+            info_dir = {}
+            for direction in ('up', 'down'):
+                df_dir = df_code[df_code['direction'].isin([direction, ''])]
+                df_dir = df_dir.sort_values('price')
+                info_dir[direction] = (
+                        df_dir['price'].values.astype(np.float64),
+                        df_dir['id'].values,
+                        )
+            info_index[key] = info_dir
+        self.info_index = info_index
+        self.info_level = {
+                row.id: (row.price, row.remark) for row in df.itertuples()
+                }
+        self.version = version
+        logger.info(f'价格报警: 加载{len(self.info_level)}个价格, {len(info_index)}个股票')
+        return True
+
+    def get_stock_code(self):
+        ''' 价格报警的股票代码 '''
+        return {stock_code for stock_code, _ in self.info_index}
+
+    def run(self, s_now, only_once, arr_label=None):
+        ''' 检查新的k线 (接口同SingleAlarmProgram.run())
+            第一次运行、新增的股票，只记录最后的k线时间，不检查历史k线。
+        '''
+        self.check_reload()
+        period = self.obj_KlineInfo.period_base
+        info_stock = self.obj_KlineInfo.info_stock
+        info_msg = {}
+        for key, info_dir in self.info_index.items():
+            stock_code, price_type = key
+            if arr_label is not None and (stock_code, period) not in arr_label:
+                continue
+            obj_stock = info_stock.get(stock_code)
+            if obj_stock is None:
+                continue
+            df = obj_stock.get_bar(period)
+            if df.empty:
+                continue
+            last_time = self.info_last_time.get(key)
+            self.info_last_time[key] = df.index[-1]
+            if last_time is None or only_once:
+                continue
+            i = df.index.searchsorted(last_time, side='right')
+            if df.index.size <= i:
+                continue
+            arr_close = df['close'].values
+            if 0 < i:
+                arr_prev = arr_close[i - 1:-1]
+            else:
+                arr_prev = np.r_[df['open'].values[0], arr_close[:-1]]
+            if price_type == 'close':
+                arr_high = arr_low = arr_close[i:]
+            else:
+                arr_high = df['high'].values[i:]
+                arr_low = df['low'].values[i:]
+            arr_time = df.index[i:]
+            for direction, msg, arr_left, arr_right, side in (
+                    ('up', '上穿', arr_prev, arr_high, 'right'),
+                    ('down', '下穿', arr_low, arr_prev, 'left'),
+                    ):
+                arr_price, arr_id = info_dir[direction]
+                if not arr_price.size:
+                    continue
+                arr_begin = np.searchsorted(arr_price, arr_left, side)
+                arr_end = np.searchsorted(arr_price, arr_right, side)
+                for j in np.nonzero(arr_begin < arr_end)[0]:
+                    label = (arr_time[j].strftime('%Y-%m-%d %H:%M'), stock_code)
+                    for level_id in arr_id[arr_begin[j]:arr_end[j]]:
+                        price, remark = self.info_level[level_id]
+                        text = f'{msg}{price:g}'
+                        if remark:
+                            text = f'{text}({remark})'
+                        info_msg.setdefault(label, []).append(text)
+        # 同一个k线的多个价格，合并为一条报警信息
+        arr_alarm_msg = [
+                (s_time, stock_code, period, '; '.join(arr_text))
+                for (s_time, stock_code), arr_text in sorted(info_msg.items())
+                ]
+        logger.debug(f'PriceLevelAlarm.run() ... arr_alarm_msg: {arr_alarm_msg}')
+        return arr_alarm_msg
+
+
+class GapScanner:
+    ''' k线数据的缺口检测、补充
+        download_new_data()只补充最后一个k线之后的数据，
+        网络错误、交易时间内重启造成的中间缺口，由GapScanner补充。
+    检测: (所有股票，向量化)
+        k线的时间: 数据表({code}_today)中保存的全部k线(仅读取date列)，
+            settings.n_gap_scan_days不为0时，仅检测最近的交易日
+        k线的时间 ---> 交易日历的交易分钟序列中的位置
+        键值 = 股票序号 * n_key + 位置
+        缺口 = setdiff1d(应有的键值, 已有的键值)
+    合并:
+        交易分钟序列中，位置连续的缺口，合并为一个时间范围 (跨越午休、隔夜)。
+    补充:
+        时间范围相同的多个股票，合并为一次数据源请求。
+        下载的数据，在一个事务中写入数据表({code}_today、{code}_{year})。
+    '''
+    # k线数据
+    obj_KlineInfo = None
+    # 检测的交易日数量，0: 数据表中的全部k线
+    n_scan_days = settings.n_gap_scan_days
+    # 数据源没有数据的缺口(停牌等)，不再重复下载
+    set_gap_empty = None
+
+    def __init__(self, obj_KlineInfo):
+        self.obj_KlineInfo = obj_KlineInfo
+        self.set_gap_empty = set()
+
+    def run(self, now=None, arr_code=None):
+        ''' 检测缺口 ---> 补充缺口
+            arr_code        检测的股票代码，None: 全部
+        返回值:
+            补充的k线数量
+        '''
+        t_begin = time.time()
+        info_gap = self.scan(now, arr_code)
+        n_gap = sum(len(arr) for arr in info_gap.values())
+        if not n_gap:
+            return 0
+        n_rows = self.fill(info_gap)
+        logger.info(f'GapScanner.run() ... 缺口: {n_gap}, 补充k线: {n_rows}, run time: {time.time() - t_begin:.3f}s')
+        return n_rows
+
+    def scan(self, now=None, arr_code=None):
+        ''' 检测缺口 (最后一个k线之前)
+        返回值: dict
+            {
+                    stock_code: [(start, end), ...],
+                    ...
+                    }
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        obj_KI = self.obj_KlineInfo
+        # 按交易日历分组
+        info_group = {}
+        for code, obj_stock in obj_KI.info_stock.items():
+            if arr_code is not None and code not in arr_code:
+                continue
+            info_group.setdefault(obj_stock.obj_calendar, []).append(code)
+        info_gap = {}
+        for obj_calendar, arr_code in info_group.items():
+            info_gap.update(self.scan_calendar(obj_calendar, arr_code, now))
+        return info_gap
+
+    def scan_calendar(self, obj_calendar, arr_code, now):
+        ''' 检测缺口 (同一个交易日历的股票) '''
+        obj_KI = self.obj_KlineInfo
+        # 检测的开始时间，None: 数据表中的全部k线
+        scan_begin = None
+        if self.n_scan_days:
+            day = now.date()
+            for _ in range(self.n_scan_days):
+                day = obj_calendar.prev_trading_day(day)
+            scan_begin = pd.Timestamp(day)
+        arr_index = []
+        for code in arr_code:
+            obj_stock = obj_KI.info_stock[code]
+            # 数据表中保存的k线时间 + 内存中的k线时间(还没有写入数据表的)
+            index = obj_KI.obj_DataTable.read_db__kline__date(
+                    obj_stock.table_name, scan_begin,
+                    )
+            index_bar = obj_stock.get_bar(obj_KI.period_base).index
+            if scan_begin is not None:
+                index_bar = index_bar[scan_begin <= index_bar]
+            arr_index.append(index.union(index_bar))
+        arr_first = [index[0] for index in arr_index if index.size]
+        arr_last = [index[-1] for index in arr_index if index.size]
+        if not arr_last:
+            return {}
+        # 交易分钟序列
+        grid = obj_calendar.trading_minutes(min(arr_first), max(arr_last))
+        arr_grid = grid.values.astype('datetime64[m]').astype(np.int64)
+        n_key = arr_grid.size + 1
+        arr_expected, arr_exist = [], []
+        for i, index in enumerate(arr_index):
+            if not index.size:
+                continue
+            arr_minute = index.values.astype('datetime64[m]').astype(np.int64)
+            arr_pos = np.searchsorted(arr_grid, arr_minute)
+            # 非交易分钟的k线，忽略
+            mask = arr_pos < arr_grid.size
+            mask[mask] = arr_grid[arr_pos[mask]] == arr_minute[mask]
+            arr_pos = arr_pos[mask]
+            if not arr_pos.size:
+                continue
+            # 第一个k线 ... 最后一个k线
+            arr_expected.append(
+                    i * n_key + np.arange(arr_pos[0], arr_pos[-1] + 1)
+                    )
+            arr_exist.append(i * n_key + arr_pos)
+        if not arr_expected:
+            return {}
+        arr_missing = np.setdiff1d(
+                np.concatenate(arr_expected), np.concatenate(arr_exist),
+                assume_unique=True,
+                )
+        if not arr_missing.size:
+            return {}
+        # 合并连续的缺口
+        arr_break = np.flatnonzero(np.diff(arr_missing) != 1) + 1
+        arr_first = np.r_[arr_missing[0], arr_missing[arr_break]]
+        arr_end = np.r_[arr_missing[arr_break - 1], arr_missing[-1]]
+        info_gap = {}
+        for key_first, key_end in zip(arr_first, arr_end):
+            code = arr_code[key_first // n_key]
+            start = grid[key_first % n_key]
+            end = grid[key_end % n_key]
+            if (code, start, end) in self.set_gap_empty:
+                continue
+            info_gap.setdefault(code, []).append((start, end))
+        return info_gap
+
+    def fill(self, info_gap):
+        ''' 补充缺口
+        返回值:
+            补充的k线数量
+        '''
+        obj_KI = self.obj_KlineInfo
+        period = obj_KI.period_base
+        # 时间范围相同的股票，一次下载
+        info_range = {}
+        for code, arr_range in info_gap.items():
+            for start, end in arr_range:
+                info_range.setdefault((start, end), []).append(code)
+        info_new = {}
+        for (start, end), arr_code in info_range.items():
+            logger.debug(f'GapScanner.fill() ... {start} -- {end}, {arr_code}')
+            try:
+                # 数据源的k线时间为结束时间
+                ret = obj_KI.obj_DataSource.get_data_missing(
+                        arr_code, period, start.to_pydatetime(),
+                        (end + Minute(1)).to_pydatetime(), offset_right=True,
+                        )
+            except ValueError as e:
+                logger.info(f'GapScanner.fill() ... {e}')
+                ret = {}
+            for code in arr_code:
+                df = ret.get(code)
+                if df is not None:
+                    df = df.loc[(start <= df.index) & (df.index <= end)]
+                if df is None or df.empty:
+                    self.set_gap_empty.add((code, start, end))
+                    continue
+                info_new.setdefault(code, []).append(df)
+        # 写入数据表，一个事务
+        info_table = {}
+        for code, arr_df in info_new.items():
+            obj_stock = obj_KI.info_stock[code]
+            df = pd.concat(arr_df)
+            info_table[obj_stock.table_name] = df
+            for year, df_year in obj_stock.group_year(df):
+                t_name = f'{code}_{year}'
+                if not df_year.empty and obj_KI.obj_DataTable.table_is_exists(t_name):
+                    info_table[t_name] = df_year
+        n_rows = 0
+        if info_table:
+            obj_KI.obj_DataTable.save_db__kline_batch(info_table)
+        # 更新内存中的k线数据
+        for code, arr_df in info_new.items():
+            obj_stock = obj_KI.info_stock[code]
+            df = pd.concat(arr_df)
+            n_rows += obj_stock.data_insert(period, df)
+        return n_rows
 
 
 class PeriodType:
@@ -613,15 +2611,25 @@ class PeriodType:
             'h': Hour,
             'd': Day,
             }
+    # 每个单位的分钟数
+    info_minutes = {
+            'm': 1,
+            'h': 60,
+            }
     period = None
     rule = None
+    # 数量，例如: '5m' ---> 5
+    count = None
+    # 单位，例如: '5m' ---> 'm'
+    key = None
 
     def __init__(self, period):
         self.period = period
         m = self.pattern.match(period)
         if m:
             info = m.groupdict()
-            count = int(info['count'])
+            self.count = count = int(info['count'])
+            self.key = info['key']
             cls_time= self.cls_type[ info['key'] ]
             self.rule = cls_time(count)
         else:
@@ -630,6 +2638,12 @@ class PeriodType:
     def get_rule(self):
         return self.rule
 
+    def get_minutes(self):
+        ''' k线周期的交易分钟数 (日线以上、秒线，raise ValueError) '''
+        if self.key not in self.info_minutes:
+            raise ValueError(f'k线周期不是分钟的整数倍. {self.period}')
+        return self.count * self.info_minutes[self.key]
+
 
 class SingleStockInfo:
     ''' 单个股票信息
@@ -644,12 +2658,13 @@ class SingleStockInfo:
                     },
             ...
             }
-    k线数据, data_kline, dict
+    k线数据, data_kline, kline_store.KlineStore (接口同dict)
     {
             '1m': 1分钟k线数据,
             '5m': 1分钟k线数据,
             ...
             }
+    内存预算(settings.n_kline_budget_mb)删除的k线周期，读取时重新计算(build_period())
     '''
     period_base = '1m'
     # 股票代码
@@ -660,22 +2675,36 @@ class SingleStockInfo:
     table_name = None
     # 数据库
     obj_db = None
+    # 数据写入 (BatchWriter)，None: 直接写入数据表
+    obj_Writer = None
     # 数据源
     obj_source = None
+    # 交易日历
+    obj_calendar = None
     # 报警信息
     info_alarm = None
     # k线数据
     data_kline = None
+    # 推送行情: tick合成中的1m k线
+    bar_forming = None
+    # as-of索引的缓存
+    #   (period_short, period_long) ---> (arr_asof, arr_close_long, 短周期的最后时间, 长周期的最后时间)
+    info_asof = None
     # 限制k线数据的长度(1年 = 52周 * 5天 * 4小时 * 60分钟)
     limit_size = 62400
+    # 报警程序需要的基础周期k线数量(插件的n_lookback)，None: limit_size
+    n_lookback = None
 
     def __init__(
-            self, stock_code, stock_name, period_base, obj_db, obj_source
+            self, stock_code, stock_name, period_base, obj_db, obj_source,
+            data_kline=None, n_lookback=None,
             ):
         ''' 实例初始化
             stock_code          股票代码
             stock_name          股票名称
             obj_source          行情数据源
+            data_kline          快照中的k线数据，None: 从数据表读取
+            n_lookback          需要的基础周期k线数量，None: limit_size
         '''
         self.period_base = period_base
         self.stock_code = stock_code
@@ -683,8 +2712,28 @@ class SingleStockInfo:
         self.table_name = f'{stock_code}_today'
         self.obj_db = obj_db
         self.obj_source = obj_source
-        df = self.get_bars_history(True)
-        self.data_kline = {period_base: df}
+        self.obj_calendar = trading_calendar.get_calendar(stock_code)
+        self.info_asof = {}
+        self.n_lookback = n_lookback
+        if data_kline is not None and period_base in data_kline:
+            self.data_kline = kline_store.KlineStore(
+                    stock_code, period_base, self.build_period, data_kline
+                    )
+            # 快照的k线数量与需要的不同时，扩展 or 截取
+            self.set_lookback(n_lookback, True)
+        else:
+            df = self.get_bars_history(True)
+            self.data_kline = kline_store.KlineStore(
+                    stock_code, period_base, self.build_period,
+                    {period_base: df},
+                    )
+
+    def save_kline(self, df):
+        ''' 新的k线写入数据表 (有obj_Writer时，commit()时写入) '''
+        if self.obj_Writer is not None:
+            self.obj_Writer.add_kline(self.table_name, df)
+        else:
+            self.obj_db.save_db__kline(df, self.table_name)
 
     def get_bar(self, period):
         ''' 获取k线数据 '''
@@ -692,22 +2741,101 @@ class SingleStockInfo:
 
     def get_last_date(self, period):
         ''' 最后一个k线数据的时间 '''
-        return self.data_kline[period].index[-1]
+        return self.data_kline.get_last_time(period)
 
     def get_bars_history(self, flag_limit_size=False):
         ''' 获取历史数据
             从数据源获取数据失败，raise ValueError()
         '''
+        n_bars = self.get_limit() if flag_limit_size else None
         try:
             # 从数据表读取数据
-            df = self.read_data_from_database()
+            df = self.read_data_from_database(n_bars)
         except (sqlalchemy.exc.OperationalError, ValueError):
             # 从行情数据源获取数据
             df = self.read_data_from_QuotesDataSource()
-        if flag_limit_size and self.limit_size < df.index.size:
-            df = df[-self.limit_size:]
+        if n_bars is not None and n_bars < df.index.size:
+            df = df[-n_bars:]
         return df
 
+    def get_limit(self):
+        ''' 内存中保留的基础周期k线数量 '''
+        if self.n_lookback is None:
+            return self.limit_size
+        return min(self.n_lookback, self.limit_size)
+
+    def set_lookback(self, n_lookback, flag_force=False):
+        ''' 报警程序需要的k线数量改变 (增加、删除报警程序)
+            增加: 从数据表读取更早的k线(最早的k线之前)，重建其它的k线周期
+                {code}_today不足时，读取历史数据表{code}_{year}
+            减少: trim()
+        '''
+        if n_lookback == self.n_lookback and not flag_force:
+            return
+        self.n_lookback = n_lookback
+        n_limit = self.get_limit()
+        df_base = self.data_kline[self.period_base]
+        n_more = n_limit - df_base.index.size
+        if 0 < n_more and df_base.index.size:
+            # 先读取{code}_today，不足时向前读取历史数据表{code}_{year} (同replay.read_history)
+            arr_df = []
+            end_time = df_base.index[0]
+            year = end_time.year
+            t_name = self.table_name
+            while 0 < n_more:
+                try:
+                    df = self.obj_db.read_db__kline(t_name, n_more, end_time)
+                except ValueError:
+                    if t_name != self.table_name:
+                        break
+                    df = df_base.iloc[:0]
+                if not df.empty:
+                    arr_df.insert(0, df)
+                    n_more -= df.index.size
+                    end_time = df.index[0]
+                    year = end_time.year
+                elif t_name != self.table_name:
+                    # 当年的数据表没有更早的k线，读取上一年
+                    year -= 1
+                t_name = f'{self.stock_code}_{year}'
+            if 0 < n_more:
+                logger.warning(f'{self.stock_code}: 数据表中的k线不足, 需要{n_limit}, 缺少{n_more}')
+            if arr_df:
+                df_old = pd.concat(arr_df)
+                df_old.index.rename(df_base.index.name, inplace=True)
+                self.data_kline[self.period_base] = pd.concat([df_old, df_base])
+                for period in self.data_kline.get_loaded():
+                    if period != self.period_base:
+                        self.data_kline[period] = self.period_conversion(period)
+                self.info_asof.clear()
+                indicator_cache.invalidate(self.stock_code)
+                logger.debug(f'{self.stock_code}: 扩展k线数据 {df_old.index.size}, 共{self.data_kline[self.period_base].index.size}')
+        self.trim(0)
+
+    def trim(self, n_slack=None):
+        ''' 截取k线数据，保留最后的get_limit()个基础周期k线
+            n_slack     超出的数量大于n_slack时才截取(减少截取的次数)，None: get_limit()的1/4
+            其它的k线周期，删除第一个基础周期k线之前的k线(可能不完整)
+        返回值: 是否截取
+        '''
+        n_limit = self.get_limit()
+        if n_slack is None:
+            n_slack = n_limit // 4
+        df_base = self.data_kline[self.period_base]
+        if df_base.index.size <= n_limit + n_slack:
+            return False
+        df_base = df_base.iloc[-n_limit:]
+        self.data_kline[self.period_base] = df_base
+        first_time = df_base.index[0]
+        for period in self.data_kline.get_loaded():
+            if period != self.period_base:
+                df = self.data_kline[period]
+                self.data_kline[period] = df.iloc[df.index.searchsorted(first_time):]
+        # 序号改变: as-of索引、指标的缓存无效
+        self.info_asof.clear()
+        indicator_cache.invalidate(self.stock_code)
+        return True
+
     def get_bars_new(self):
         ''' 从行情数据源更新单个k线的数据
         返回值:
@@ -732,12 +2860,103 @@ class SingleStockInfo:
             # 数据合并
             logger.debug(f'\tdf.index.size: {df.index.size}, df.index[0]: {df.index[0]}')
             self.data_kline[period] = pd.concat([df_old, df])
+            # 新的k线数据，删除指标的缓存
+            indicator_cache.invalidate(self.stock_code)
         return df
 
-    def read_data_from_database(self):
-        ''' 从数据库读取历史数据 '''
+    def data_insert(self, period, df_new):
+        ''' 插入k线数据(中间的缺口)，重建受影响的其它k线周期
+        返回值:
+            插入的k线数量
+        '''
+        df_old = self.data_kline[period]
+        df = df_new.loc[~df_new.index.isin(df_old.index)]
+        if df.empty:
+            return 0
+        df.index.rename(df_old.index.name, inplace=True)
+        self.data_kline[period] = pd.concat([df_old, df]).sort_index()
+        indicator_cache.invalidate(self.stock_code)
+        self.info_asof.clear()
+        if period == self.period_base:
+            self.period_rebuild(df.index[0])
+        return df.index.size
+
+    def push_bar(self, date, open, high, low, close):
+        ''' 推送行情: 一个已经结束的1m k线
+        返回值: 结束的k线
+            [(stock_code, period, date), ...]
+        '''
+        period = self.period_base
+        date = pd.Timestamp(date)
+        if date <= self.get_last_date(period):
+            # 重复、过时的数据
+            return []
+        df = pd.DataFrame(
+                {'open': [open], 'high': [high], 'low': [low], 'close': [close]},
+                index=pd.DatetimeIndex([date], name='date'),
+                columns=['open', 'high', 'low', 'close'],
+                )
+        df_new = self.data_merge(period, df)
+        if df_new.empty:
+            return []
+        self.save_kline(df_new)
+        self.period_update()
+        return [
+                (self.stock_code, p, date) for p in self.get_period_closed(date)
+                ]
+
+    def push_tick(self, date, price):
+        ''' 推送行情: tick合成1m k线
+            新的分钟的tick到达时，上一分钟的k线结束。
+        返回值: 结束的k线
+            [(stock_code, period, date), ...]
+        '''
+        minute = pd.Timestamp(date).floor('min')
+        arr_closed = []
+        bar = self.bar_forming
+        if bar is not None and bar['date'] < minute:
+            arr_closed = self.push_bar(**bar)
+            self.bar_forming = bar = None
+        if bar is None:
+            self.bar_forming = dict(
+                    date=minute, open=price, high=price, low=price, close=price,
+                    )
+        elif bar['date'] == minute:
+            bar['high'] = max(bar['high'], price)
+            bar['low'] = min(bar['low'], price)
+            bar['close'] = price
+        return arr_closed
+
+    def flush_tick(self, now):
+        ''' 推送行情: 当前分钟之前，tick合成的k线结束 '''
+        bar = self.bar_forming
+        if bar is None or pd.Timestamp(now).floor('min') <= bar['date']:
+            return []
+        self.bar_forming = None
+        return self.push_bar(**bar)
+
+    def get_period_closed(self, date):
+        ''' 1m k线date结束时，同时结束的k线周期 '''
+        date_next = self.obj_calendar.next_trading_minute(date)
+        index = pd.DatetimeIndex([date, date_next])
+        arr_period = [self.period_base]
+        for period in self.data_kline:
+            if period == self.period_base:
+                continue
+            try:
+                labels = self.obj_calendar.bin_labels(index, PeriodType(period))
+            except ValueError:
+                continue
+            if labels[0] != labels[1]:
+                arr_period.append(period)
+        return arr_period
+
+    def read_data_from_database(self, n_bars=None):
+        ''' 从数据库读取历史数据
+            n_bars      最后的n_bars个k线，None: 全部
+        '''
         try:
-            df = self.obj_db.read_db__kline(self.table_name)
+            df = self.obj_db.read_db__kline(self.table_name, n_bars)
         except ValueError as e:
             logger.info(f'{e}')
             df = None
@@ -745,7 +2964,7 @@ class SingleStockInfo:
         if df is None or df.empty:
             year = datetime.date.today().year
             t_name = f'{self.stock_code}_{year}'
-            df = self.obj_db.read_db__kline(t_name)
+            df = self.obj_db.read_db__kline(t_name, n_bars)
         return df
 
     def read_data_from_QuotesDataSource(self, n_bars=None):
@@ -850,16 +3069,40 @@ class SingleStockInfo:
             period          k线周期
             df_base         转换前的k线数据
             func_name       k线周期转换的函数名称
+        按交易日历分组（午休、节假日不计入k线周期），
+        秒线等无法按交易分钟分组的周期，使用resample()。
         '''
         obj_PeriodType = PeriodType(period)
-        rule = obj_PeriodType.get_rule()
         if df_base is None:
             df_base = self.data_kline[self.period_base]
         if func_name is None:
             func_name = dict(open='first', high='max', low='min', close='last')
-        df = df_base.resample(rule=rule).agg(func_name).dropna()
+        try:
+            labels = self.obj_calendar.bin_labels(df_base.index, obj_PeriodType)
+        except ValueError:
+            rule = obj_PeriodType.get_rule()
+            df = df_base.resample(rule=rule).agg(func_name).dropna()
+        else:
+            df = df_base.groupby(labels).agg(func_name).dropna()
         return df
 
+    def build_period(self, period):
+        ''' 重新计算内存预算删除的k线周期 (KlineStore读取时) '''
+        for key in [key for key in self.info_asof if period in key]:
+            del self.info_asof[key]
+        return self.period_conversion(period)
+
+    def count_bars_missing(self, now=None):
+        ''' 最后一个k线之后，已经结束的交易分钟数量
+            0: 不需要下载数据 (闭市、节假日、数据已是最新)
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        start = self.get_last_date(self.period_base) + Minute(1)
+        # 当前分钟的k线还没有结束
+        end = pd.Timestamp(now).floor('min') - Minute(1)
+        return self.obj_calendar.count_trading_minutes(start, end)
+
     def period_add(self, period):
         ''' 增加k线周期数据 '''
         if period not in self.data_kline:
@@ -870,20 +3113,329 @@ class SingleStockInfo:
         ''' 删除k线周期数据 '''
         if period in self.data_kline:
             del self.data_kline[period]
+            indicator_cache.invalidate(self.stock_code, period)
+            for key in [key for key in self.info_asof if period in key]:
+                del self.info_asof[key]
+
+    def get_asof_index(self, period_short, period_long):
+        ''' 短周期的每个k线，对应的最后一个已结束的长周期k线的序号 (as-of)
+            增量计算: 新的k线到达时，只计算新增的k线和最后一个(未结束的)短周期k线。
+        返回值: numpy.ndarray, 长度与data_kline[period_short]相同，没有时为-1
+        '''
+        index_short = self.data_kline[period_short].index
+        index_long = self.data_kline[period_long].index
+        obj_short = PeriodType(period_short)
+        obj_long = PeriodType(period_long)
+        key = (period_short, period_long)
+        item = self.info_asof.get(key)
+        n_short = n_long = 0
+        if item is not None:
+            arr_asof, arr_close_long, last_short, last_long = item
+            if (
+                    0 < arr_asof.size <= index_short.size
+                    and 0 < arr_close_long.size <= index_long.size
+                    and index_short[arr_asof.size - 1] == last_short
+                    and index_long[arr_close_long.size - 1] == last_long
+                    ):
+                n_short = arr_asof.size - 1
+                n_long = arr_close_long.size
+        if n_long:
+            arr_close_long = np.concatenate([
+                    arr_close_long,
+                    self.obj_calendar.bar_close_time(
+                        index_long[n_long:], obj_long
+                        ),
+                    ])
+            arr_head = arr_asof[:n_short]
+        else:
+            arr_close_long = self.obj_calendar.bar_close_time(
+                    index_long, obj_long
+                    )
+            arr_head = np.empty(0, dtype=np.int64)
+        arr_close_short = self.obj_calendar.bar_close_time(
+                index_short[n_short:], obj_short
+                )
+        arr_asof = np.concatenate([
+                arr_head,
+                np.searchsorted(arr_close_long, arr_close_short, 'right') - 1,
+                ])
+        if index_short.size and index_long.size:
+            self.info_asof[key] = (
+                    arr_asof, arr_close_long, index_short[-1], index_long[-1],
+                    )
+        return arr_asof
+
+    def period_rebuild(self, start_date):
+        ''' 重建start_date之后的其它k线周期数据 (已删除的k线周期，读取时计算) '''
+        arr_period = set(self.data_kline.get_loaded())
+        arr_period.discard(self.period_base)
+        df_base = self.data_kline[self.period_base]
+        for period in arr_period:
+            df_old = self.data_kline[period]
+            # start_date所在k线周期的开始时间
+            df_before = df_old.loc[df_old.index <= start_date]
+            if df_before.empty:
+                self.data_kline[period] = self.period_conversion(period)
+                continue
+            label = df_before.index[-1]
+            df_new = self.period_conversion(
+                    period, df_base=df_base.loc[label <= df_base.index]
+                    )
+            self.data_kline[period] = pd.concat([df_before[:-1], df_new])
 
     def period_update(self):
         ''' 更新其它的k线周期数据
             period_base周期，使用get_bars_new()
+            内存预算删除的k线周期不更新，读取时计算
         '''
-        arr_period = set(self.data_kline.keys())
-        arr_period.remove(self.period_base)
+        arr_period = set(self.data_kline.get_loaded())
+        arr_period.discard(self.period_base)
         for period in arr_period:
             df_base = self.data_kline[self.period_base]
             df_old = self.data_kline[period]
             start_date = df_old.index[-1]
-            df_base_new = df_base.loc[start_date <= df_base.index]
+            df_base_new = df_base.iloc[df_base.index.searchsorted(start_date):]
             df_new = self.period_conversion(period, df_base=df_base_new)
             self.data_kline[period] = pd.concat([df_old[:-1], df_new])
+        # 超出需要的k线数量，截取
+        self.trim()
+
+
+class CrossSectionStore:
+    ''' 全市场筛选的k线数据 (截面数组)
+    所有股票的基础周期k线按时间对齐，保存在2维数组(股票 x k线)中:
+        open, high, low, close      float32，没有k线的位置为nan
+        arr_time                    k线的开始时间(所有股票共用)，datetime64[m]
+    数组的容量为n_bars的2倍；写满时，最近的k线移到数组的开头，
+    读取时返回数组的切片，不复制。
+    其它k线周期，由基础周期按交易日历分组转换，按最后的k线时间缓存。
+    '''
+    # k线数据的名称
+    arr_name = ('open', 'high', 'low', 'close')
+    # 股票代码 [stock_code, ...]
+    arr_stock_code = None
+    # 股票代码 ---> 行号
+    info_row = None
+    # 数据源
+    obj_source = None
+    # 交易日历
+    obj_calendar = None
+    # 基础k线周期
+    period_base = None
+    # 每个股票保留的k线数量
+    n_bars = None
+    # 数组的容量 (k线数量)
+    n_capacity = None
+    # 数组中已使用的k线数量
+    n_size = None
+    # k线时间
+    arr_time = None
+    # k线数据, 'open' ---> 2维数组
+    info_data = None
+    # 其它k线周期的缓存, period ---> (最后的k线时间, dict)
+    info_period = None
+    # 线程锁
+    lock = None
+
+    def __init__(
+            self, arr_stock_code, obj_source, period_base='1m',
+            n_bars=settings.n_screen_bars,
+            ):
+        self.arr_stock_code = list(arr_stock_code)
+        self.info_row = {
+                code: i for i, code in enumerate(self.arr_stock_code)
+                }
+        self.obj_source = obj_source
+        self.period_base = period_base
+        self.n_bars = n_bars
+        self.n_capacity = 2 * n_bars
+        self.n_size = 0
+        self.arr_time = np.empty(self.n_capacity, dtype='datetime64[m]')
+        shape = (len(self.arr_stock_code), self.n_capacity)
+        self.info_data = {
+                name: np.full(shape, np.nan, dtype=np.float32)
+                for name in self.arr_name
+                }
+        self.info_period = {}
+        self.lock = threading.RLock()
+        if self.arr_stock_code:
+            market = trading_calendar.get_market(self.arr_stock_code[0])
+        else:
+            market = settings.market_default
+        self.obj_calendar = trading_calendar.get_calendar(market)
+
+    def get_last_time(self):
+        ''' 最后一个k线的时间，None: 没有数据 '''
+        if not self.n_size:
+            return None
+        return pd.Timestamp(self.arr_time[self.n_size - 1])
+
+    def get_nbytes(self):
+        ''' 占用的内存 (字节) '''
+        return sum(arr.nbytes for arr in self.info_data.values())
+
+    def download(self, now=None):
+        ''' 下载最新的k线，每次请求settings.n_screen_batch个股票
+            第一次下载最近的n_bars个k线；
+            之后按交易日历检查，没有新的k线时，不访问数据源；
+            有新的k线时，重新下载最近的几个k线(迟到的k线写入原来的列)。
+        返回值: 新增的k线数量
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        last_time = self.get_last_time()
+        if last_time is None:
+            kwargs = {'count': self.n_bars}
+        else:
+            end = pd.Timestamp(now).floor('min') - Minute(1)
+            if not self.obj_calendar.count_trading_minutes(
+                    last_time + Minute(1), end
+                    ):
+                return 0
+            # 从最近的n_screen_late_bars个k线开始下载，补齐迟到的k线
+            n_late = max(1, settings.n_screen_late_bars)
+            start_date = pd.Timestamp(self.arr_time[max(0, self.n_size - n_late)])
+            kwargs = {'start_date': start_date}
+        arr_df = []
+        n = settings.n_screen_batch
+        for i in range(0, len(self.arr_stock_code), n):
+            arr_code = self.arr_stock_code[i:i + n]
+            try:
+                df = self.obj_source.get_data_cross_section(
+                        arr_code, self.period_base, end_date=now, **kwargs
+                        )
+            except ValueError as e:
+                logger.info(f'{e}')
+                continue
+            arr_df.append(df)
+        if not arr_df:
+            return 0
+        return self.append(pd.concat(arr_df, ignore_index=True))
+
+    def append(self, df):
+        ''' 写入k线
+            已有的k线时间(迟到、更新的k线)写入原来的列，
+            比最后的k线新的时间增加新的列。
+        入口参数:
+            df          长表格式: date(k线的开始时间), code, open, high, low, close
+        返回值: 新增的k线数量
+        '''
+        arr_date = df['date'].values.astype('datetime64[m]')
+        arr_row = df['code'].map(self.info_row).values
+        with self.lock:
+            mask = ~pd.isnull(arr_row)
+            arr_row = np.where(mask, arr_row, 0).astype(np.int64)
+            # 数据变化的行 (已有的k线时间)
+            set_row = set()
+            if self.n_size:
+                arr_time = self.arr_time[:self.n_size]
+                mask_old = mask & (arr_date <= arr_time[-1])
+                arr_col = np.searchsorted(arr_time, arr_date[mask_old])
+                mask_hit = arr_time[arr_col] == arr_date[mask_old]
+                arr_col = arr_col[mask_hit]
+                arr_row_old = arr_row[mask_old][mask_hit]
+                for name in self.arr_name:
+                    arr = self.info_data[name]
+                    value = df[name].values[mask_old][mask_hit].astype(np.float32)
+                    value_old = arr[arr_row_old, arr_col]
+                    mask_change = ~(
+                            (value == value_old)
+                            | (np.isnan(value) & np.isnan(value_old))
+                            )
+                    set_row.update(arr_row_old[mask_change].tolist())
+                    arr[arr_row_old, arr_col] = value
+                mask &= arr_time[-1] < arr_date
+            arr_time_new = np.unique(arr_date[mask])[-self.n_bars:]
+            n_new = arr_time_new.size
+            if n_new:
+                mask &= arr_time_new[0] <= arr_date
+                self.reserve(n_new)
+                n = self.n_size
+                arr_col = n + np.searchsorted(arr_time_new, arr_date[mask])
+                arr_row_new = arr_row[mask]
+                for name in self.arr_name:
+                    arr = self.info_data[name]
+                    arr[:, n:n + n_new] = np.nan
+                    arr[arr_row_new, arr_col] = df[name].values[mask]
+                self.arr_time[n:n + n_new] = arr_time_new
+                self.n_size += n_new
+            if n_new or set_row:
+                self.info_period.clear()
+            for i in set_row:
+                # 已有的k线变化，最后的k线时间不变，缓存的指标需要删除
+                indicator_cache.invalidate(self.arr_stock_code[i])
+        logger.debug(f'CrossSectionStore.append() ... n_new: {n_new}, n_update: {len(set_row)}, last_time: {self.get_last_time()}')
+        return n_new
+
+    def reserve(self, n_new):
+        ''' 数组的剩余空间不足时，最近的k线移到数组的开头 '''
+        if self.n_size + n_new <= self.n_capacity:
+            return
+        n_keep = min(self.n_size, self.n_bars - n_new)
+        start = self.n_size - n_keep
+        for arr in self.info_data.values():
+            arr[:, :n_keep] = arr[:, start:self.n_size]
+        self.arr_time[:n_keep] = self.arr_time[start:self.n_size]
+        self.n_size = n_keep
+
+    def get_period(self, period):
+        ''' 其它k线周期的数据 (按交易日历分组转换)
+            最后的k线可能还没有结束。
+        '''
+        last_time = self.get_last_time()
+        item = self.info_period.get(period)
+        if item is not None and item[0] == last_time:
+            return item[1]
+        index = pd.DatetimeIndex(self.arr_time[:self.n_size], name='date')
+        arr_label = self.obj_calendar.bin_labels(index, PeriodType(period))
+        info = {}
+        for name, func_name in (
+                ('open', 'first'), ('high', 'max'),
+                ('low', 'min'), ('close', 'last'),
+                ):
+            df = pd.DataFrame(self.info_data[name][:, :self.n_size].T)
+            df = df.groupby(arr_label.values).agg(func_name)
+            info[name] = np.ascontiguousarray(df.values.T)
+        info['index'] = pd.DatetimeIndex(df.index, name='date')
+        self.info_period[period] = (last_time, info)
+        return info
+
+    def get_bars(self, period, arr_stock_code=None, n_bars=None):
+        ''' 读取k线数据 (报警算法批量接口的入口参数，同get_aligned_bars())
+        入口参数:
+            period              k线周期
+            arr_stock_code      股票代码 [stock_code, ...]，None: 全部
+            n_bars              每个股票最近的k线数量，None: 全部
+        返回值: dict
+            arr_stock_code      股票代码
+            index               k线时间, pandas.DatetimeIndex
+            open, high, low, close
+                                2维数组 (股票 x k线)，没有k线的位置为nan
+        '''
+        with self.lock:
+            if period == self.period_base:
+                info_all = {
+                        name: arr[:, :self.n_size]
+                        for name, arr in self.info_data.items()
+                        }
+                info_all['index'] = pd.DatetimeIndex(
+                        self.arr_time[:self.n_size], name='date'
+                        )
+            else:
+                info_all = self.get_period(period)
+        start = 0 if n_bars is None else max(0, info_all['index'].size - n_bars)
+        if arr_stock_code is None or arr_stock_code == self.arr_stock_code:
+            arr_stock_code = self.arr_stock_code
+            rows = slice(None)
+        else:
+            rows = np.array([self.info_row[code] for code in arr_stock_code])
+        info = {
+                'arr_stock_code': arr_stock_code,
+                'index': info_all['index'][start:],
+                }
+        for name in self.arr_name:
+            info[name] = info_all[name][rows, start:]
+        return info
 
 
 class QuotesDataSource(ABC):
@@ -988,6 +3540,26 @@ class QuotesDataSource(ABC):
         '''
         pass
 
+    @abstractmethod
+    def get_data_cross_section(
+            self, arr_stock_code, period, end_date=None, start_date=None,
+            count=None,
+            ):
+        ''' 下载多个股票的数据 (全市场筛选，一次请求)
+        入口参数:
+            arr_stock_code          股票代码 [stock_code, ...]
+            period                  k线周期
+            end_date                数据结束时间，None: 现在
+            start_date              数据开始时间(k线的开始时间)
+            count                   每个股票的k线数量 (start_date为None时)
+        返回值:
+            pandas.DataFrame, 长表格式 (不设置索引)
+                date        k线的开始时间
+                code        股票代码
+                open, high, low, close
+        '''
+        pass
+
 
 class JqData(QuotesDataSource):
     ''' 聚宽量化交易平台
@@ -1117,6 +3689,39 @@ class JqData(QuotesDataSource):
         ret = self._data_format_change(str_or_list, df)
         return ret
 
+    def get_data_cross_section(
+            self, arr_stock_code, period, end_date=None, start_date=None,
+            count=None,
+            ):
+        ''' 下载多个股票的数据 (全市场筛选，一次请求)
+            不转换为dict，k线时间向量化地转为"开始时间"。
+        '''
+        if end_date is None:
+            end_date = datetime.datetime.now()
+        if start_date is not None:
+            # k线的开始时间 ---> 结束时间
+            start_date = self.set_time_right(pd.Timestamp(start_date))
+            count = None
+        if not self.is_auth():
+            self.connect_server()
+        df = jqdatasdk.get_price(
+                security=list(arr_stock_code),
+                start_date=start_date,
+                end_date=end_date,
+                count=count,
+                frequency=period,
+                fields=['open', 'high', 'low', 'close'],
+                skip_paused=True,
+                panel=False,
+                )
+        logger.debug(f'get_data_cross_section() ... n_stock: {len(arr_stock_code)}, download record: {df.index.size}')
+        if df.empty:
+            raise ValueError(f'未能获取数据. n_stock: {len(arr_stock_code)}, {period}')
+        df = df.rename(columns={'time': 'date'})
+        # k线的结束时间 ---> 开始时间
+        df['date'] = df['date'] - pd.Timedelta(minutes=1)
+        return df
+
     def _data_prepare(self, start_date, end_date, offset_right):
         ''' get_data_missing() 数据准备 '''
         now = datetime.datetime.now()
@@ -1149,8 +3754,12 @@ class JqData(QuotesDataSource):
         else:
             # 多个股票
             df.set_index(['code', 'time'], inplace=True)
+            set_code = set(df.index.get_level_values('code'))
             info = {}
             for code in str_or_list:
+                if code not in set_code:
+                    # 停牌等，没有数据
+                    continue
                 df_code = df.loc[code]
                 df_code.index.rename(index_name, inplace=True)
                 self.set_time_left(df_code, Minute(1))
@@ -1168,6 +3777,33 @@ class SingleAlarmProgram:
         遍历n个股票代码:
             遍历n个k线周期:
                 执行一个报警算法
+    批量接口(可选)：alarm_algorithm_batch()，优先使用
+        遍历n个k线周期:
+            n个股票的k线数据按时间对齐(股票 x k线的2维数组)，执行一个报警算法
+        入口参数, dict
+            arr_stock_code      股票代码 [stock_code, ...]
+            period              k线周期
+            other_kwargs        算法的参数
+            remark              算法的备注
+            index               k线时间, pandas.DatetimeIndex
+            open, high, low, close
+                                2维数组 (股票 x k线)，没有k线的位置为nan
+            arr_last_time       每个股票的上次运行时间 [None or str, ...]
+            arr_time_new        每个股票的第一个新的k线的时间 [None or pandas.Timestamp, ...]
+                                (get_time_new()，k线时间 >= arr_time_new[i]: 上次运行之后结束的k线)
+            s_now               本次运行时间，str
+            多个k线周期时，增加:
+            period_long         长周期
+            long                长周期的k线 (index, open, high, low, close)
+            asof_index          短周期的每个k线，对应的已结束的长周期k线的序号
+                                1维数组，没有时为-1
+        返回值, ValueError or list (同alarm_algorithm())
+        k线数量: 插件模块的n_bars_batch，缺省为settings.n_batch_bars
+    执行预算: 插件模块的n_budget_seconds(秒)，缺省为settings.n_plugin_budget_seconds
+        evaluate()在插件的工作线程中执行，不修改运行状态，返回(报警信息, 运行状态的更新)；
+        结果被接受时(没有超时)，apply_state()在主线程中更新运行状态。
+    预热k线数量: 插件模块的n_lookback，int(所有周期) or {period: int}，
+        KlineInfo按所有插件的最大值读取、保留k线数据；没有声明时，SingleStockInfo.limit_size
     1) 单个k线周期:
         算法:
             macd的diff上穿dea or macd的diff下穿dea
@@ -1207,18 +3843,33 @@ class SingleAlarmProgram:
                 other_kwargs = {'period_long': '30m', 'period_short': '5m'}
         注意:
             算法包含多个k线周期时，arr_period选最小的k线周期。
-    info_program        报警程序的信息，由KlineInfo.get_alarm_info()设置。
+        alarm_algorithm()的入口参数，增加:
+            period_long         长周期
+            asof_index          短周期的每个k线，对应的已结束的长周期k线的序号
+                                (SingleStockInfo.get_asof_index())
+        按短周期的k线结束时间运行，长周期的指标由多个短周期共用(indicator_cache)。
+    info_program        报警程序的信息，由ExecutionPlan.compile()设置。
     {
             'algorithm': row.algorithm,
             'arr_stock_code': arr_stock_code,
             'arr_period': arr_period,
             'other_kwargs': other_kwargs,
             'remark': row.remark,
-            'data_kline': obj_code.data_kline
+            'info_stock': KlineInfo.info_stock,
+            # 任务 [(stock_code, period), ...]，没有时: arr_stock_code x arr_period
+            'arr_task': arr_task,
             }
     '''
     # 报警算法函数
     algorithm = None
+    # 报警算法函数 (批量接口)
+    algorithm_batch = None
+    # 批量接口，每个股票的k线数量
+    n_bars_batch = None
+    # 执行预算(秒)，None: settings.n_plugin_budget_seconds
+    n_budget_seconds = None
+    # 预热需要的k线数量: int(所有周期) or {period: int}，None: 没有声明
+    n_lookback = None
     # 报警输出信息
     arr_alarm_msg = None
     # 最后运行时间，减少计算量
@@ -1227,75 +3878,191 @@ class SingleAlarmProgram:
     info_alarm_msg = None
     # 报警程序的信息，由KlineInfo.get_alarm_info()设置。
     info_program = None
+    # 交易日历 (k线周期的结束时间)
+    obj_calendar = None
 
     def __init__(self, info):
         ''' 返回值: None or ValueError '''
         self.info_alarm_msg = {}
         self.info_last_time_run = {}
         self.info_program = info
-        # 报警算法函数
-        module_name = f'{settings.dir_plugin}.{info["algorithm"]}'
-        spec = importlib.util.find_spec(module_name)
-        if spec is None:
-            raise ValueError(f'报警程序{module_name}不存在')
-        obj_module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(obj_module)
-        try:
-            self.algorithm = obj_module.alarm_algorithm
-        except AttributeError:
-            msg = f'报警程序{module_name}中，没有报警函数alarm_algorithm()'
+        arr_stock_code = info['arr_stock_code']
+        self.obj_calendar = trading_calendar.get_calendar(
+                arr_stock_code[0] if arr_stock_code else settings.market_default
+                )
+        # 报警算法函数 (插件模块只加载一次，所有报警程序共用)
+        self.set_module(plugin_registry.get_module(info['algorithm']))
+
+    def set_module(self, obj_module):
+        ''' 设置报警算法函数 (插件重新加载时，替换)
+            返回值: None or ValueError
+        '''
+        algorithm = getattr(obj_module, 'alarm_algorithm', None)
+        algorithm_batch = getattr(obj_module, 'alarm_algorithm_batch', None)
+        if algorithm is None and algorithm_batch is None:
+            msg = f'报警程序{obj_module.__name__}中，没有报警函数alarm_algorithm()'
             logger.error(msg)
             raise ValueError(msg)
+        self.algorithm = algorithm
+        self.algorithm_batch = algorithm_batch
+        self.n_bars_batch = getattr(
+                obj_module, 'n_bars_batch', settings.n_batch_bars
+                )
+        self.n_budget_seconds = getattr(obj_module, 'n_budget_seconds', None)
+        self.n_lookback = getattr(obj_module, 'n_lookback', None)
+
+    def get_lookback(self, period):
+        ''' 插件声明的预热k线数量 (period周期的k线)，None: 没有声明 '''
+        if isinstance(self.n_lookback, dict):
+            return self.n_lookback.get(period)
+        return self.n_lookback
 
-    def run(self, s_now, only_once):
-        ''' 定时执行
+    def run(self, s_now, only_once, arr_label=None):
+        ''' 定时执行 (evaluate() + apply_state())
         入口参数:
             s_now           程序启动时间
             only_once       第一次运行的标志
-        返回值: tuple
+            arr_label       仅执行指定的(stock_code, period)，None: 全部
+        返回值: list
 
         self.algorithm()的返回值: ValueError or list
             [(s_now, stock_code, period, message), ...]
         '''
-        # 当天k线周期的时间序列
-        info_time_range = {}
+        arr_alarm_msg, info_state = self.evaluate(s_now, only_once, arr_label)
+        self.apply_state(info_state)
+        return arr_alarm_msg
+
+    def apply_state(self, info_state):
+        ''' 更新运行状态 (evaluate()的返回值) '''
+        self.info_last_time_run.update(info_state['info_last_time_run'])
+        self.info_alarm_msg.update(info_state['info_alarm_msg'])
+
+    def evaluate(self, s_now, only_once, arr_label=None):
+        ''' 执行报警算法，不修改运行状态 (入口参数同run())
+        返回值: (报警信息 list, 运行状态的更新 dict)
+            {
+                'info_last_time_run': {label: s_now, ...},
+                'info_alarm_msg': {label: s_now, ...},
+                }
+        '''
+        if self.algorithm_batch is not None:
+            return self.evaluate_batch(s_now, only_once, arr_label)
+        info_state = {'info_last_time_run': {}, 'info_alarm_msg': {}}
+        # k线周期是否结束
+        info_closed = {}
+        period_long = self.get_period_long()
+        info_stock = self.info_program['info_stock']
         # 报警的信息内容
         arr_alarm_msg = []
-        # 一个报警算法 ---> n个股票代码 ---> n个k线周期
-        for stock_code in self.info_program['arr_stock_code']:
-            for period in self.info_program['arr_period']:
-                if not self.check_run_time(only_once, s_now, info_time_range):
-                    # not (第0次运行 or 第[1..n)次运行 and now在时间序列df_ts中)
-                    continue
-                alarm_algorithm = self.info_program['algorithm']
-                label = (stock_code, period)
-                s_last_time = self.info_last_time_run.get(label)
-                info = {
-                        'stock_code': stock_code,
-                        'period': period,
-                        'other_kwargs': self.info_program['other_kwargs'],
-                        'remark': self.info_program['remark'],
-                        'data_kline': self.info_program['data_kline'],
-                        # 上次运行时间
-                        's_last_time': s_last_time,
-                        # 本次运行时间
-                        's_now': s_now,
-                        }
-                logger.debug(f'alarm_algorithm: {alarm_algorithm}, label: {label}, s_last_time: {s_last_time}, s_now: {s_now}')
-                try:
-                    arr_cross = self.algorithm(info)
-                    logger.debug(f'arr_cross: {arr_cross}')
-                except ValueError as e:
-                    logger.info(f'{e}')
-                    continue
-                if arr_cross and self.info_alarm_msg.get(label) != s_now:
+        # 一个报警算法 ---> n个任务(股票代码, k线周期)
+        for stock_code, period in self.get_task():
+            if arr_label is not None and (stock_code, period) not in arr_label:
+                continue
+            if not self.check_run_time(only_once, s_now, period, info_closed):
+                # not (第0次运行 or 第[1..n)次运行 and k线周期结束)
+                continue
+            alarm_algorithm = self.info_program['algorithm']
+            label = (stock_code, period)
+            obj_stock = info_stock[stock_code]
+            s_last_time = self.info_last_time_run.get(label)
+            info = {
+                    'stock_code': stock_code,
+                    'period': period,
+                    'other_kwargs': self.info_program['other_kwargs'],
+                    'remark': self.info_program['remark'],
+                    'data_kline': obj_stock.data_kline,
+                    # 上次运行时间
+                    's_last_time': s_last_time,
+                    # 第一个新的k线的时间 (上次运行之后结束的k线)，None: 全部k线
+                    'time_new': get_time_new(
+                        obj_stock.obj_calendar, obj_stock.get_bar(period).index,
+                        period, s_last_time,
+                        ),
+                    # 本次运行时间
+                    's_now': s_now,
+                    }
+            if period_long is not None:
+                info['period_long'] = period_long
+                info['asof_index'] = obj_stock.get_asof_index(
+                        period, period_long
+                        )
+            logger.debug(f'alarm_algorithm: {alarm_algorithm}, label: {label}, s_last_time: {s_last_time}, s_now: {s_now}')
+            try:
+                arr_cross = self.algorithm(info)
+                logger.debug(f'arr_cross: {arr_cross}')
+            except ValueError as e:
+                logger.info(f'{e}')
+                continue
+            if arr_cross and self.info_alarm_msg.get(label) != s_now:
+                # 记录上次报警时间，防止重复报警
+                info_state['info_alarm_msg'][label] = s_now
+                arr_alarm_msg.extend(arr_cross)
+            # 记录本次算法的运行时间
+            info_state['info_last_time_run'][label] = s_now
+        logger.debug(f'arr_alarm_msg: {arr_alarm_msg}')
+        return arr_alarm_msg, info_state
+
+    def evaluate_batch(self, s_now, only_once, arr_label=None):
+        ''' 执行报警算法 (批量接口)，不修改运行状态
+            一个报警算法 ---> n个k线周期 ---> n个股票代码(一次调用)
+        '''
+        info_state = {'info_last_time_run': {}, 'info_alarm_msg': {}}
+        info_closed = {}
+        arr_alarm_msg = []
+        info_stock = self.info_program['info_stock']
+        period_long = self.get_period_long()
+        arr_task = self.get_task()
+        for period in self.info_program['arr_period']:
+            arr_code = [
+                    code for code, period_task in arr_task
+                    if period_task == period
+                    and (arr_label is None or (code, period) in arr_label)
+                    ]
+            if not arr_code:
+                continue
+            if not self.check_run_time(only_once, s_now, period, info_closed):
+                continue
+            arr_obj_stock = [info_stock[code] for code in arr_code]
+            info = get_aligned_bars(arr_obj_stock, period, self.n_bars_batch)
+            if period_long is not None:
+                self.add_period_long(
+                        info, period, period_long,
+                        get_aligned_bars(
+                            arr_obj_stock, period_long, self.n_bars_batch
+                            ),
+                        )
+            info.update({
+                    'period': period,
+                    'other_kwargs': self.info_program['other_kwargs'],
+                    'remark': self.info_program['remark'],
+                    'arr_last_time': [
+                        self.info_last_time_run.get((code, period))
+                        for code in arr_code
+                        ],
+                    's_now': s_now,
+                    })
+            self.add_time_new(info, period)
+            logger.debug(f'alarm_algorithm_batch: {self.info_program["algorithm"]}, period: {period}, n_stock: {len(arr_code)}, s_now: {s_now}')
+            try:
+                arr_cross = self.algorithm_batch(info)
+            except ValueError as e:
+                logger.info(f'{e}')
+                continue
+            # 按(stock_code, period)分组
+            info_cross = {}
+            for record in arr_cross:
+                info_cross.setdefault((record[1], record[2]), []).append(record)
+            for code in arr_code:
+                label = (code, period)
+                arr = info_cross.get(label)
+                if arr and self.info_alarm_msg.get(label) != s_now:
                     # 记录上次报警时间，防止重复报警
-                    self.info_alarm_msg[label] = s_now
-                    arr_alarm_msg.extend(arr_cross)
+                    info_state['info_alarm_msg'][label] = s_now
+                    arr_alarm_msg.extend(arr)
                 # 记录本次算法的运行时间
-                self.info_last_time_run[label] = s_now
+                info_state['info_last_time_run'][label] = s_now
         logger.debug(f'arr_alarm_msg: {arr_alarm_msg}')
-        return arr_alarm_msg
+        return arr_alarm_msg, info_state
 
     def get_today_time_range(self, period, info_ts):
         ''' 获取当天的时间序列 '''
@@ -1309,29 +4076,150 @@ class SingleAlarmProgram:
             info_ts[period] = arr_ts
         return arr_ts
 
-    def check_run_time(self, only_once, s_now, info_time_range):
-        ''' 第0次运行 or 第[1..n)次运行 and now在时间序列df_ts中 '''
+    def check_run_time(self, only_once, s_now, period, info_closed):
+        ''' 第0次运行 or 第[1..n)次运行 and s_now时刻k线周期结束
+            k线周期按交易日历分组(午休不计入)，例如: 60m在10:30、11:30、14:00、15:00结束。
+        入口参数:
+            info_closed     本次运行的缓存, period ---> flag
+        '''
         if only_once:
             # 第0次运行
             flag = True
+        elif period in info_closed:
+            flag = info_closed[period]
         else:
             # 第[1..n)次运行
-            now = pd.Timestamp(s_now)
-            period = self.info_program['period']
-            if period in info_time_range:
-                df_ts = info_time_range[period]
-            else:
-                today = datetime.date(now.year, now.month, now.day)
-                tomorrow = today + datetime.timedelta(days=1)
-                df_ts = pd.date_range(
-                        today, tomorrow, freq=period, name='date', closed='left'
-                        )
-                info_time_range[period] = df_ts
-            # 检查: now在时间序列df_ts中
-            flag = now in df_ts
-        logger.debug(f'check_run_time(): ... flag: {flag}')
+            flag = self.obj_calendar.is_bar_closed(
+                    pd.Timestamp(s_now), PeriodType(period)
+                    )
+            info_closed[period] = flag
+        logger.debug(f'check_run_time(): ... period: {period}, flag: {flag}')
         return flag
 
+    def get_task(self):
+        ''' 任务 [(stock_code, period), ...] '''
+        arr_task = self.info_program.get('arr_task')
+        if arr_task is None:
+            arr_task = [
+                    (stock_code, period)
+                    for stock_code in self.info_program['arr_stock_code']
+                    for period in self.info_program['arr_period']
+                    ]
+        return arr_task
+
+    def get_period_long(self):
+        ''' 多个k线周期的算法，长周期: other_kwargs['period_long']
+            返回值: None(单个k线周期) or str
+        '''
+        other_kwargs = self.info_program['other_kwargs']
+        if isinstance(other_kwargs, dict):
+            return other_kwargs.get('period_long')
+        return None
+
+    def add_time_new(self, info, period):
+        ''' 批量接口的入口参数，增加每个股票的第一个新的k线的时间 (arr_time_new) '''
+        info_time_new = {
+                s_last_time: get_time_new(
+                    self.obj_calendar, info['index'], period, s_last_time
+                    )
+                for s_last_time in set(info['arr_last_time'])
+                }
+        info['arr_time_new'] = [
+                info_time_new[s_last_time] for s_last_time in info['arr_last_time']
+                ]
+
+    def add_period_long(self, info, period, period_long, info_long):
+        ''' 批量接口的入口参数，增加长周期的k线和as-of索引
+            k线周期的结束时间由交易日历确定，所有股票共用一个as-of索引。
+        '''
+        info['period_long'] = period_long
+        info['long'] = info_long
+        info['asof_index'] = self.obj_calendar.asof_index(
+                info['index'], PeriodType(period),
+                info_long['index'], PeriodType(period_long),
+                )
+
+
+class ScreeningProgram(SingleAlarmProgram):
+    ''' 全市场筛选 (单个报警程序)
+    alarm_program_info的arr_stock_code为股票范围(json字符串，不是list):
+        "*"                 stock_code_info中的全部股票
+        "type:stock"        stock_code_info中，type为stock的股票
+    k线数据来自CrossSectionStore(多个股票一次下载)，
+    报警算法必须提供批量接口alarm_algorithm_batch()。
+    info_program        在SingleAlarmProgram的基础上，增加:
+    {
+            'universe': '*',
+            'obj_CrossSection': KlineInfo.obj_CrossSection,
+            }
+    '''
+
+    def set_module(self, obj_module):
+        ''' 设置报警算法函数，必须提供批量接口
+            返回值: None or ValueError
+        '''
+        if getattr(obj_module, 'alarm_algorithm_batch', None) is None:
+            msg = f'全市场筛选{obj_module.__name__}中，没有报警函数alarm_algorithm_batch()'
+            logger.error(msg)
+            raise ValueError(msg)
+        super().set_module(obj_module)
+
+    def evaluate(self, s_now, only_once, arr_label=None):
+        ''' 执行报警算法，不修改运行状态 (返回值同SingleAlarmProgram.evaluate())
+            一个报警算法 ---> n个k线周期 ---> 全部股票(一次调用)
+            推送行情(arr_label不是None)时，不执行。
+        '''
+        info_state = {'info_last_time_run': {}, 'info_alarm_msg': {}}
+        if arr_label is not None:
+            return [], info_state
+        info_closed = {}
+        arr_alarm_msg = []
+        obj_store = self.info_program['obj_CrossSection']
+        arr_code = self.info_program['arr_stock_code']
+        period_long = self.get_period_long()
+        for period in self.info_program['arr_period']:
+            if not self.check_run_time(only_once, s_now, period, info_closed):
+                continue
+            info = obj_store.get_bars(period, arr_code, self.n_bars_batch)
+            if not info['index'].size:
+                continue
+            if period_long is not None:
+                self.add_period_long(
+                        info, period, period_long,
+                        obj_store.get_bars(
+                            period_long, arr_code, self.n_bars_batch
+                            ),
+                        )
+            info.update({
+                    'period': period,
+                    'other_kwargs': self.info_program['other_kwargs'],
+                    'remark': self.info_program['remark'],
+                    'arr_last_time': (
+                        [self.info_last_time_run.get(period)] * len(arr_code)
+                        ),
+                    's_now': s_now,
+                    })
+            self.add_time_new(info, period)
+            logger.debug(f'alarm_algorithm_batch: {self.info_program["algorithm"]}, universe: {self.info_program["universe"]}, period: {period}, n_stock: {len(arr_code)}, s_now: {s_now}')
+            try:
+                arr_cross = self.algorithm_batch(info)
+            except ValueError as e:
+                logger.info(f'{e}')
+                continue
+            # 按(stock_code, period)分组
+            info_cross = {}
+            for record in arr_cross:
+                info_cross.setdefault((record[1], record[2]), []).append(record)
+            for label, arr in info_cross.items():
+                if self.info_alarm_msg.get(label) != s_now:
+                    # 记录上次报警时间，防止重复报警
+                    info_state['info_alarm_msg'][label] = s_now
+                    arr_alarm_msg.extend(arr)
+            # 记录本次算法的运行时间 (所有股票相同)
+            info_state['info_last_time_run'][period] = s_now
+        logger.debug(f'arr_alarm_msg: {len(arr_alarm_msg)}')
+        return arr_alarm_msg, info_state
+
 
 def init_program():
     ''' 程序初始化 '''
@@ -1343,7 +4231,10 @@ def init_program():
 def main():
     logger.debug('main() ...')
     obj_TS = TimingStart()
-    obj_TS.event_timer()
+    try:
+        obj_TS.event_timer()
+    finally:
+        obj_TS.close()
 
 
 if __name__ == '__main__':
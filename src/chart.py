@@ -0,0 +1,140 @@
+# -*- encoding: utf-8 -*-
+''' k线图的缩略数据 (图形界面)
+k线数量远大于窗口宽度(像素)时，按min/max缩略: 每个像素一个k线，
+    open: 第一个k线的open, high: 最大值, low: 最小值, close: 最后一个k线的close
+    价格的极值不会丢失。
+多级缩略(LodCache):
+    第0级为原始k线，第k级每个k线由2^k个原始k线合并，从第0个原始k线开始对齐；
+    显示时选择k线数量不超过窗口宽度的最小级别，不需要每次重新计算。
+    新的k线 or 最后一个k线更新时，每一级仅重新计算最后的k线。
+'''
+
+import numpy as np
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+# k线的列名
+arr_name = ('open', 'high', 'low', 'close')
+
+
+def merge_level(info, start=0):
+    ''' 相邻的2个k线合并为1个 (下一级)
+    入口参数:
+        info        一级的k线, dict: time, open, high, low, close (numpy数组)
+        start       从第start个合并后的k线开始计算
+    返回值: dict (第start个合并后的k线开始)
+    '''
+    n = len(info['time'])
+    idx = np.arange(2 * start, n, 2)
+    if not len(idx):
+        return {name: info[name][:0] for name in ('time',) + arr_name}
+    idx_last = np.minimum(idx + 1, n - 1)
+    return {
+            'time': info['time'][idx],
+            'open': info['open'][idx],
+            'high': np.maximum.reduceat(info['high'][2 * start:], idx - 2 * start),
+            'low': np.minimum.reduceat(info['low'][2 * start:], idx - 2 * start),
+            'close': info['close'][idx_last],
+            }
+
+
+class LodCache:
+    ''' 一个股票、k线周期的多级缩略数据 '''
+    # 每一级的k线 [dict(time, open, high, low, close), ...]
+    arr_level = None
+    # 原始k线的数量
+    n_bars = None
+
+    def __init__(self):
+        self.arr_level = []
+        self.n_bars = 0
+
+    def update(self, df):
+        ''' 更新k线数据
+        入口参数:
+            df          k线数据 (SingleStockInfo.get_bar())，按时间排序
+        返回值: 第一个变化的原始k线的序号，None: 没有变化
+        '''
+        arr_time = df.index.values.astype('datetime64[m]').astype(np.int64)
+        n = len(arr_time)
+        info = {'time': arr_time}
+        for name in arr_name:
+            info[name] = df[name].values.astype(np.float64)
+        start = self.get_change(info)
+        if start is None:
+            return None
+        self.n_bars = n
+        if start == 0 or not self.arr_level:
+            self.arr_level = [info]
+        else:
+            self.arr_level[0] = info
+        level = 1
+        start_level = start
+        while len(self.arr_level[level - 1]['time']) > 1:
+            start_level //= 2
+            info_prev = self.arr_level[level - 1]
+            info_new = merge_level(info_prev, start_level)
+            if level < len(self.arr_level):
+                info_old = self.arr_level[level]
+                info_new = {
+                        name: np.concatenate((info_old[name][:start_level], info_new[name]))
+                        for name in info_new
+                        }
+                self.arr_level[level] = info_new
+            else:
+                # 新的一级，全部计算
+                self.arr_level.append(merge_level(info_prev))
+            level += 1
+        del self.arr_level[level:]
+        return start
+
+    def get_change(self, info):
+        ''' 第一个变化的原始k线的序号
+            只增加k线、最后一个k线更新时，为原来的最后一个k线；其它变化: 0
+        '''
+        if not self.arr_level:
+            return 0
+        info_old = self.arr_level[0]
+        n_old = len(info_old['time'])
+        n = len(info['time'])
+        if n < n_old or n_old == 0:
+            return 0
+        i = n_old - 1
+        if info['time'][i] != info_old['time'][i] or info['time'][0] != info_old['time'][0]:
+            return 0
+        if n == n_old and all(
+                info[name][i] == info_old[name][i] for name in arr_name
+                ):
+            return None
+        return i
+
+    def get_level(self, n_bars, width):
+        ''' k线数量不超过width的最小级别 '''
+        level = 0
+        while (
+                level + 1 < len(self.arr_level)
+                and width < -(-n_bars // (2 ** level))
+                ):
+            level += 1
+        return level
+
+    def get_view(self, width, n_bars=None):
+        ''' 显示的k线 (缩略后)
+        入口参数:
+            width       窗口宽度(像素)
+            n_bars      显示最近的n_bars个原始k线，None: 全部
+        返回值: (level, dict(time, open, high, low, close))
+        '''
+        if not self.arr_level:
+            return 0, None
+        if n_bars is None or self.n_bars < n_bars:
+            n_bars = self.n_bars
+        level = self.get_level(n_bars, max(1, int(width)))
+        # 与缩略的k线对齐
+        start = (self.n_bars - n_bars) >> level
+        info = self.arr_level[level]
+        return level, {name: info[name][start:] for name in info}
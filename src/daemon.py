@@ -0,0 +1,452 @@
+# -*- encoding: utf-8 -*-
+''' 监控服务 (后台运行)
+一个进程下载行情、运行报警程序，图形界面和脚本通过Unix socket访问，不重复计算:
+    $ python daemon.py                  # 启动监控服务
+    $ python daemon.py status           # 运行状态
+    $ python daemon.py programs         # 报警程序
+    $ python daemon.py bars 000300.XSHG 5m 10
+    $ python daemon.py reload           # 重新读取报警程序数据表
+    $ python daemon.py memory           # 内存报告 (每个股票的k线数据)
+    $ python daemon.py subscribe        # 接收报警信息
+地址: settings.daemon_address
+单实例: 读取k线数据之前获取单实例锁(settings.f_name_instance_lock)，
+    已经有监控服务(或本地模式的图形界面)在运行时，不启动，不写数据表、快照。
+协议: 每行一个json
+    请求        {"cmd": "status"}
+                {"cmd": "programs"}
+                {"cmd": "bars", "stock_code": "000300.XSHG", "period": "5m", "n_bars": 100}
+                {"cmd": "reload"}
+                {"cmd": "memory"}
+                {"cmd": "subscribe"}        连接保持，推送报警信息
+                {"cmd": "ping"}
+    应答        {"type": "response", "ok": true, "data": ...}
+                {"type": "response", "ok": false, "error": "..."}
+    推送        {"type": "alarm", "data": [[s_now, stock_code, period, message], ...]}
+'''
+
+import fcntl
+import json
+import os
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+# our apps
+import alarm_stock as a_s
+import notify
+import plugin_budget
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def dumps(info):
+    ''' 一行json (bytes) '''
+    return (
+            json.dumps(info, ensure_ascii=False, default=str) + '\n'
+            ).encode('utf-8')
+
+
+class InstanceLock:
+    ''' 单实例锁 (flock，进程退出时自动释放)
+        监控服务、图形界面的本地模式共用，只有一个进程下载行情、运行报警程序
+    '''
+    # 锁文件
+    f_name = None
+    # 打开的锁文件，None: 没有持有
+    f_lock = None
+
+    def __init__(self, f_name=None):
+        if f_name is None:
+            f_name = settings.f_name_instance_lock
+        self.f_name = f_name
+
+    def acquire(self):
+        ''' 获取锁，不等待
+            返回值: True: 成功，False: 其它进程持有
+        '''
+        if self.f_lock is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.f_name)), exist_ok=True)
+        f_lock = open(self.f_name, 'a+')
+        try:
+            fcntl.flock(f_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f_lock.close()
+            return False
+        f_lock.seek(0)
+        f_lock.truncate()
+        f_lock.write(f'{os.getpid()}\n')
+        f_lock.flush()
+        self.f_lock = f_lock
+        return True
+
+    def release(self):
+        ''' 释放锁 '''
+        if self.f_lock is None:
+            return
+        fcntl.flock(self.f_lock, fcntl.LOCK_UN)
+        self.f_lock.close()
+        self.f_lock = None
+
+
+class SubscriberSink(notify.Sink):
+    ''' 通知方式: 推送报警信息给订阅的客户端 '''
+    name = 'subscriber'
+    # 第一次运行的报警信息，客户端从数据表读取
+    flag_only_once = False
+    # 订阅的连接 set([RequestHandler(), ...])
+    set_handler = None
+    # 线程锁
+    lock = None
+
+    def __init__(self):
+        self.set_handler = set()
+        self.lock = threading.Lock()
+
+    def add(self, obj_handler):
+        with self.lock:
+            self.set_handler.add(obj_handler)
+
+    def remove(self, obj_handler):
+        with self.lock:
+            self.set_handler.discard(obj_handler)
+
+    def send(self, arr_record):
+        with self.lock:
+            arr_handler = list(self.set_handler)
+        info = {'type': 'alarm', 'data': [list(record) for record in arr_record]}
+        for obj_handler in arr_handler:
+            try:
+                obj_handler.write(info)
+            except OSError as e:
+                # 客户端断开 or 太慢，不影响其它客户端
+                logger.warning(f'推送报警信息失败，断开订阅: {e!r}')
+                self.remove(obj_handler)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    ''' 一个客户端连接 '''
+
+    def setup(self):
+        super().setup()
+        self.lock_write = threading.Lock()
+
+    def set_send_timeout(self, n_seconds):
+        ''' 发送超时 (SO_SNDTIMEO，只影响发送，订阅的连接可以长时间没有请求)
+            客户端太慢，发送缓冲区满时，n_seconds后write()抛出OSError
+        '''
+        n_sec = int(n_seconds)
+        n_usec = int((n_seconds - n_sec) * 1000000)
+        self.connection.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDTIMEO,
+                struct.pack('ll', n_sec, n_usec),
+                )
+
+    def write(self, info):
+        ''' 发送一行json (应答、推送共用连接) '''
+        with self.lock_write:
+            self.wfile.write(dumps(info))
+            self.wfile.flush()
+
+    def handle(self):
+        obj_daemon = self.server.obj_daemon
+        try:
+            for line in self.rfile:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    info = json.loads(line.decode('utf-8'))
+                    if not isinstance(info, dict):
+                        raise ValueError(f'请求格式错误: {info}')
+                    if info.get('cmd') == 'subscribe':
+                        # 推送不能阻塞: 太慢的客户端，发送超时后断开订阅
+                        self.set_send_timeout(settings.n_notify_timeout)
+                        obj_daemon.obj_Subscriber.add(self)
+                        data = None
+                    else:
+                        data = obj_daemon.execute(info)
+                    response = {'type': 'response', 'ok': True, 'data': data}
+                except ValueError as e:
+                    response = {'type': 'response', 'ok': False, 'error': str(e)}
+                except Exception as e:
+                    logger.exception(f'请求处理错误: {line}')
+                    response = {'type': 'response', 'ok': False, 'error': repr(e)}
+                self.write(response)
+        except OSError:
+            pass
+        finally:
+            obj_daemon.obj_Subscriber.remove(self)
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    ''' Unix socket服务 (每个连接一个线程) '''
+    daemon_threads = True
+    # 监控服务
+    obj_daemon = None
+
+
+class MonitorDaemon:
+    ''' 监控服务: 报警程序(TimingStart) + Unix socket服务 '''
+    # 定时任务
+    obj_TimingStart = None
+    # k线数据、报警程序
+    obj_KlineInfo = None
+    # 推送报警信息
+    obj_Subscriber = None
+    # Unix socket服务
+    obj_server = None
+    # 服务线程
+    thread = None
+    # 地址
+    address = None
+    # 启动时间
+    time_start = None
+
+    def __init__(self, obj_TimingStart, address=None):
+        if address is None:
+            address = settings.daemon_address
+        self.address = address
+        self.obj_TimingStart = obj_TimingStart
+        self.obj_KlineInfo = obj_TimingStart.obj_KlineInfo
+        self.obj_Subscriber = SubscriberSink()
+        obj_TimingStart.obj_Notify.add_sink(self.obj_Subscriber)
+
+    def start(self):
+        ''' 启动Unix socket服务 (调用者已持有单实例锁，InstanceLock)
+            已经有监控服务在运行: ValueError
+        '''
+        if os.path.exists(self.address):
+            if DaemonClient(self.address).is_available():
+                raise ValueError(f'监控服务已经在运行: {self.address}')
+            # 上次异常退出，残留的socket文件
+            os.unlink(self.address)
+        self.obj_server = DaemonServer(self.address, RequestHandler)
+        self.obj_server.obj_daemon = self
+        self.time_start = time.time()
+        self.thread = threading.Thread(
+                target=self.obj_server.serve_forever, name='MonitorDaemon',
+                daemon=True,
+                )
+        self.thread.start()
+        logger.info(f'监控服务已启动: {self.address}')
+
+    def stop(self):
+        ''' 停止Unix socket服务 '''
+        if self.obj_server is None:
+            return
+        self.obj_server.shutdown()
+        self.obj_server.server_close()
+        self.obj_server = None
+        try:
+            os.unlink(self.address)
+        except OSError:
+            pass
+        logger.info('监控服务已停止')
+
+    def execute(self, info):
+        ''' 执行请求
+            返回值: json数据 or ValueError
+        '''
+        cmd = info.get('cmd')
+        if cmd == 'ping':
+            return 'pong'
+        elif cmd == 'status':
+            return self.get_status()
+        elif cmd == 'programs':
+            return self.get_programs()
+        elif cmd == 'bars':
+            try:
+                stock_code, period = info['stock_code'], info['period']
+            except KeyError as e:
+                raise ValueError(f'缺少参数: {e}')
+            return self.get_bars(stock_code, period, info.get('n_bars', 100))
+        elif cmd == 'reload':
+            self.obj_KlineInfo.request_reload()
+            return True
+        elif cmd == 'memory':
+            return self.obj_KlineInfo.get_memory_report()
+        raise ValueError(f'命令不存在: {cmd}')
+
+    def get_status(self):
+        ''' 运行状态 '''
+        obj = self.obj_KlineInfo
+        obj_plan = obj.obj_ExecutionPlan
+        return {
+                'pid': os.getpid(),
+                'time_start': self.time_start,
+                'only_once': self.obj_TimingStart.only_once,
+                'n_program': len(obj.info_program),
+                'n_stock': len(obj.info_stock),
+                'n_task': obj_plan.count_task() if obj_plan is not None else 0,
+                'plugin': plugin_budget.get_stats(),
+                'notify': self.obj_TimingStart.obj_Notify.get_stats(),
+                'writer': obj.obj_Writer.get_stats(),
+                }
+
+    def get_programs(self):
+        ''' 报警程序 '''
+        arr_name = (
+                'algorithm', 'arr_stock_code', 'arr_period', 'other_kwargs',
+                'remark',
+                )
+        return [
+                {name: info.get(name) for name in arr_name}
+                for info in list(self.obj_KlineInfo.info_program.values())
+                ]
+
+    def get_bars(self, stock_code, period, n_bars=100):
+        ''' k线数据的快照 (最近n_bars个k线) '''
+        obj_stock = self.obj_KlineInfo.info_stock.get(stock_code)
+        if obj_stock is None:
+            raise ValueError(f'没有监控的股票: {stock_code}')
+        try:
+            df = obj_stock.get_bar(period)
+        except KeyError:
+            raise ValueError(f'没有k线周期: {stock_code}, {period}')
+        arr_name = ['open', 'high', 'low', 'close']
+        df = df[arr_name].iloc[-int(n_bars):]
+        return {
+                'columns': ['date'] + arr_name,
+                'data': [
+                    [date.strftime('%Y-%m-%d %H:%M')] + [float(v) for v in row]
+                    for date, row in zip(df.index, df.values)
+                    ],
+                }
+
+
+class DaemonClient:
+    ''' 监控服务的客户端 '''
+    # 地址
+    address = None
+    # 超时(秒)
+    timeout = None
+    # 订阅的线程
+    thread_subscribe = None
+    # 订阅的停止标志
+    event_stop = None
+
+    def __init__(self, address=None, timeout=5):
+        if address is None:
+            address = settings.daemon_address
+        self.address = address
+        self.timeout = timeout
+        self.event_stop = threading.Event()
+
+    def connect(self):
+        ''' 连接监控服务 '''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def is_available(self):
+        ''' 监控服务是否在运行 '''
+        try:
+            return self.request('ping') == 'pong'
+        except (OSError, ValueError):
+            return False
+
+    def request(self, cmd, **kwargs):
+        ''' 发送请求
+            返回值: 应答的数据 or ValueError(请求错误) or OSError(连接错误)
+        '''
+        info = dict(kwargs, cmd=cmd)
+        with self.connect() as sock, sock.makefile('rb') as f:
+            sock.sendall(dumps(info))
+            line = f.readline()
+        if not line:
+            raise OSError('监控服务断开连接')
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise ValueError(response.get('error'))
+        return response.get('data')
+
+    def subscribe(self, func_alarm):
+        ''' 接收报警信息 (后台线程，断开后重新连接)
+            func_alarm(arr_record)      在后台线程中调用
+                arr_record      [(s_now, stock_code, period, message), ...]
+        '''
+        self.event_stop.clear()
+        self.thread_subscribe = threading.Thread(
+                target=self.run_subscribe, args=(func_alarm,),
+                name='DaemonClient', daemon=True,
+                )
+        self.thread_subscribe.start()
+
+    def run_subscribe(self, func_alarm):
+        ''' 后台线程: 接收报警信息 '''
+        while not self.event_stop.is_set():
+            try:
+                sock = self.connect()
+                # 推送的间隔不确定，不设置超时
+                sock.settimeout(None)
+                with sock, sock.makefile('rb') as f:
+                    sock.sendall(dumps({'cmd': 'subscribe'}))
+                    for line in f:
+                        if self.event_stop.is_set():
+                            break
+                        info = json.loads(line.decode('utf-8'))
+                        if info.get('type') == 'alarm':
+                            func_alarm([tuple(record) for record in info['data']])
+            except (OSError, ValueError) as e:
+                logger.warning(f'订阅报警信息: {e!r}')
+            self.event_stop.wait(settings.n_sleep)
+
+    def close(self):
+        ''' 停止接收报警信息 '''
+        self.event_stop.set()
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        # 读取k线数据、写数据表之前，检查是否已经在运行
+        obj_lock = InstanceLock()
+        if not obj_lock.acquire():
+            logger.error(f'监控服务(或本地模式的图形界面)已经在运行: {obj_lock.f_name}')
+            sys.exit(1)
+        try:
+            obj_TS = a_s.TimingStart()
+            obj_daemon = MonitorDaemon(obj_TS)
+            obj_daemon.start()
+            try:
+                obj_TS.event_timer()
+            finally:
+                obj_daemon.stop()
+                obj_TS.close()
+        finally:
+            obj_lock.release()
+        return
+    obj_client = DaemonClient()
+    cmd = argv[0]
+    if cmd == 'subscribe':
+        obj_client.subscribe(
+                lambda arr_record: [print(*record, sep='\t') for record in arr_record]
+                )
+        try:
+            obj_client.thread_subscribe.join()
+        except KeyboardInterrupt:
+            obj_client.close()
+        return
+    kwargs = {}
+    if cmd == 'bars':
+        kwargs = dict(zip(('stock_code', 'period', 'n_bars'), argv[1:]))
+    print(json.dumps(
+            obj_client.request(cmd, **kwargs), ensure_ascii=False, indent=2,
+            default=str,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# -*- encoding: utf-8 -*-
+''' 推送行情 (流式数据源)
+行情适配器把k线或tick推送给KlineInfo.start_feed()，
+不需要等待HH:MM:03的定时下载，k线结束后立即执行报警程序。
+
+消息格式: dict
+    k线:
+        {'type': 'bar', 'stock_code': '000300.XSHG',
+         'date': '2020-10-14 09:30',          # k线的开始时间
+         'open': 4830.45, 'high': 4830.45, 'low': 4819.14, 'close': 4819.31}
+    tick:
+        {'type': 'tick', 'stock_code': '000300.XSHG',
+         'date': '2020-10-14 09:30:15', 'price': 4825.0}
+适配器:
+    QueueFeed       本地队列 (同一个进程内推送，测试或其它线程的数据源)
+    SocketFeed      socket，每行一个json消息
+        'host:port'         TCP
+        '/path/to/sock'     Unix socket
+'''
+
+import json
+import queue
+import socket
+import threading
+
+from abc import ABC, abstractmethod
+
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def parse_message(info):
+    ''' 消息格式检查、转换
+        raise ValueError()      消息格式错误
+    '''
+    try:
+        msg_type = info['type']
+        ret = {
+                'type': msg_type,
+                'stock_code': info['stock_code'],
+                'date': pd.Timestamp(info['date']),
+                }
+        if msg_type == 'bar':
+            for name in ('open', 'high', 'low', 'close'):
+                ret[name] = float(info[name])
+        elif msg_type == 'tick':
+            ret['price'] = float(info['price'])
+        else:
+            raise ValueError(f'消息类型错误: {msg_type}')
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'消息格式错误: {info}, {e}')
+    return ret
+
+
+class QuoteFeed(ABC):
+    ''' 推送行情的适配器 '''
+
+    @abstractmethod
+    def read(self, timeout=None):
+        ''' 读取一条消息
+        返回值:
+            dict                消息，见parse_message()
+            None                timeout秒内没有消息
+        '''
+        pass
+
+    def close(self):
+        ''' 关闭适配器 '''
+        pass
+
+
+class QueueFeed(QuoteFeed):
+    ''' 本地队列 '''
+    # 消息队列
+    queue = None
+
+    def __init__(self, maxsize=0):
+        self.queue = queue.Queue(maxsize)
+
+    def put(self, info):
+        ''' 推送一条消息 '''
+        self.queue.put(parse_message(info))
+
+    def put_bar(self, stock_code, date, open, high, low, close):
+        ''' 推送k线 '''
+        self.put({
+                'type': 'bar', 'stock_code': stock_code, 'date': date,
+                'open': open, 'high': high, 'low': low, 'close': close,
+                })
+
+    def put_tick(self, stock_code, date, price):
+        ''' 推送tick '''
+        self.put({
+                'type': 'tick', 'stock_code': stock_code, 'date': date,
+                'price': price,
+                })
+
+    def read(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SocketFeed(QueueFeed):
+    ''' socket，每行一个json消息
+        后台线程读取socket，消息放入队列；连接断开后，重新连接。
+    '''
+    # 地址: 'host:port' or Unix socket文件名
+    address = None
+    # 后台线程
+    thread = None
+    # 停止标志
+    event_stop = None
+
+    def __init__(self, address, maxsize=10000):
+        super().__init__(maxsize)
+        self.address = address
+        self.event_stop = threading.Event()
+        self.thread = threading.Thread(
+                target=self.run, name='SocketFeed', daemon=True
+                )
+        self.thread.start()
+
+    def connect(self):
+        ''' 连接服务器 '''
+        host, sep, port = self.address.rpartition(':')
+        if sep and port.isdigit():
+            sock = socket.create_connection((host, int(port)))
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.address)
+        return sock
+
+    def run(self):
+        ''' 后台线程: 读取socket '''
+        while not self.event_stop.is_set():
+            try:
+                sock = self.connect()
+            except OSError as e:
+                logger.error(f'SocketFeed连接失败: {self.address}, {e}')
+                self.event_stop.wait(settings.n_sleep)
+                continue
+            logger.info(f'SocketFeed已连接: {self.address}')
+            try:
+                with sock, sock.makefile('r', encoding='utf-8') as f:
+                    for line in f:
+                        if self.event_stop.is_set():
+                            break
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            self.put(json.loads(line))
+                        except ValueError as e:
+                            logger.error(f'SocketFeed: {e}')
+            except OSError as e:
+                # 连接被重置、超时: 等待后重新连接
+                logger.error(f'SocketFeed读取失败: {self.address}, {e}')
+                self.event_stop.wait(settings.n_sleep)
+                continue
+            logger.info(f'SocketFeed连接断开: {self.address}')
+
+    def close(self):
+        self.event_stop.set()
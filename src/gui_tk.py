@@ -3,15 +3,199 @@
 '''
 
 import datetime
+import numpy as np
 import os
 import pandas as pd
+import queue
+import threading
+import time
 import tkinter as tk
 import tkinter.ttk as ttk
 import vlc
 
 import alarm_stock as a_s
+import chart
+import daemon
 import settings as settings
 
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+class ChartPanel(ttk.Frame):
+    ''' k线图 (缩略显示，chart.LodCache)
+        每次刷新时，只有最后一个k线变化，仅重画最后一个k线
+    '''
+    # 画布
+    canvas = None
+    # 股票代码、k线周期
+    stock_code = None
+    period = None
+    # 读取k线数据的函数, func_bars(stock_code, period) ---> DataFrame or None
+    func_bars = None
+    # 读取报警信息的函数, func_alarm(stock_code, period, date_start) ---> [record, ...]
+    func_alarm = None
+    # 多级缩略数据
+    obj_Lod = None
+    # 已画的k线: (level, 缩略k线的数量, 价格的最小值, 最大值, 画布宽度, 第一个k线的时间)
+    info_draw = None
+    # 已画的k线的图形 [item_id, ...]
+    arr_item = None
+    # 说明文字
+    var_text = None
+    # 边距(像素)
+    n_margin = 20
+
+    def __init__(self, master, func_bars, func_alarm):
+        super().__init__(master)
+        self.func_bars = func_bars
+        self.func_alarm = func_alarm
+        self.arr_item = []
+        self.var_text = tk.StringVar(self)
+        self.canvas = tk.Canvas(
+                self, height=settings.n_chart_height, background='black',
+                highlightthickness=0,
+                )
+        ttk.Label(self, textvariable=self.var_text).grid(sticky='W')
+        self.canvas.grid(sticky='NSWE')
+        self.columnconfigure(0, weight=1)
+        self.canvas.bind('<Configure>', lambda event: self.redraw())
+
+    def show(self, stock_code, period):
+        ''' 显示股票的k线图 '''
+        self.stock_code = stock_code
+        self.period = period
+        self.obj_Lod = chart.LodCache()
+        self.info_draw = None
+        self.refresh()
+
+    def refresh(self):
+        ''' 读取k线数据，有变化时重画 (定时调用) '''
+        if self.stock_code is None:
+            return
+        df = self.func_bars(self.stock_code, self.period)
+        if df is None or not len(df):
+            self.var_text.set(f'{self.stock_code} {self.period}: 没有k线数据')
+            return
+        start = self.obj_Lod.update(df)
+        if start is None:
+            return
+        if not self.draw_last():
+            self.redraw()
+
+    def get_view(self):
+        ''' 显示的缩略k线、价格范围 '''
+        width = self.canvas.winfo_width() - 2 * self.n_margin
+        level, info = self.obj_Lod.get_view(width, settings.n_chart_bars)
+        if info is None or not len(info['time']):
+            return None
+        y_min = float(np.nanmin(info['low']))
+        y_max = float(np.nanmax(info['high']))
+        return level, info, y_min, y_max, self.canvas.winfo_width(), info['time'][0]
+
+    def draw_last(self):
+        ''' 只有最后一个k线变化时，仅重画最后一个k线
+            返回值: 是否完成 (False: 需要重画全部)
+        '''
+        if self.info_draw is None:
+            return False
+        view = self.get_view()
+        if view is None:
+            return False
+        level, info, y_min, y_max, width, time_first = view
+        if (level, len(info['time']), width, time_first) != (
+                self.info_draw[0], self.info_draw[1], self.info_draw[4],
+                self.info_draw[5],
+                ):
+            return False
+        if y_min < self.info_draw[2] or self.info_draw[3] < y_max:
+            # 价格范围改变
+            return False
+        i = len(info['time']) - 1
+        x, y_high, y_low, color = self.get_coords(info, i)
+        self.canvas.coords(self.arr_item[i], x, y_high, x, y_low)
+        self.canvas.itemconfigure(self.arr_item[i], fill=color)
+        self.set_text(info, level)
+        return True
+
+    def get_coords(self, info, i):
+        ''' 第i个缩略k线的坐标、颜色 '''
+        level, n, y_min, y_max, width, _ = self.info_draw
+        height = self.canvas.winfo_height() - 2 * self.n_margin
+        dx = (width - 2 * self.n_margin) / max(n, 1)
+        scale = height / (y_max - y_min) if y_max > y_min else 0
+        x = self.n_margin + (i + 0.5) * dx
+        y_high = self.n_margin + (y_max - info['high'][i]) * scale
+        y_low = self.n_margin + (y_max - info['low'][i]) * scale
+        if y_low - y_high < 1:
+            y_low = y_high + 1
+        color = 'red' if info['open'][i] <= info['close'][i] else 'green'
+        return x, y_high, y_low, color
+
+    def redraw(self):
+        ''' 重画全部 '''
+        canvas = self.canvas
+        canvas.delete('all')
+        self.arr_item = []
+        self.info_draw = None
+        if self.obj_Lod is None:
+            return
+        view = self.get_view()
+        if view is None:
+            return
+        level, info, y_min, y_max, width, time_first = view
+        n = len(info['time'])
+        self.info_draw = (level, n, y_min, y_max, width, time_first)
+        for i in range(n):
+            x, y_high, y_low, color = self.get_coords(info, i)
+            self.arr_item.append(canvas.create_line(
+                    x, y_high, x, y_low, fill=color,
+                    width=max(1, (width - 2 * self.n_margin) // max(n, 1) - 1),
+                    ))
+        canvas.create_text(
+                2, self.n_margin, text=f'{y_max:.2f}', anchor='sw', fill='white',
+                )
+        canvas.create_text(
+                2, canvas.winfo_height() - self.n_margin, text=f'{y_min:.2f}',
+                anchor='nw', fill='white',
+                )
+        self.draw_marker(info)
+        self.set_text(info, level)
+
+    def draw_marker(self, info):
+        ''' 报警信息的标记 (缩略k线的上方) '''
+        s_start = str(np.datetime64(int(info['time'][0]), 'm').astype('datetime64[D]'))
+        arr_record = self.func_alarm(self.stock_code, self.period, s_start)
+        if not arr_record:
+            return
+        arr_time = np.array(
+                [record[0] for record in arr_record], dtype='datetime64[m]'
+                ).astype(np.int64)
+        arr_i = np.searchsorted(info['time'], arr_time, side='right') - 1
+        for i, record in zip(arr_i, arr_record):
+            if i < 0:
+                continue
+            x, y_high, _, _ = self.get_coords(info, i)
+            item = self.canvas.create_polygon(
+                    x, y_high - 2, x - 4, y_high - 9, x + 4, y_high - 9,
+                    fill='orange',
+                    )
+            self.canvas.tag_bind(
+                    item, '<Enter>',
+                    lambda event, record=record: self.var_text.set(
+                        '    '.join(str(v) for v in record)
+                        ),
+                    )
+
+    def set_text(self, info, level):
+        ''' 说明文字 '''
+        s_first = np.datetime64(int(info['time'][0]), 'm')
+        s_last = np.datetime64(int(info['time'][-1]), 'm')
+        self.var_text.set(
+                f'{self.stock_code} {self.period}  {s_first} ~ {s_last}'
+                f'  收盘: {info["close"][-1]:.2f}  (每个k线合并{2 ** level}个)'
+                )
+
 
 class Application(ttk.Frame):
     # 闭市后，监控程序继续运行的时间
@@ -26,8 +210,32 @@ class Application(ttk.Frame):
     flag_run = None
     # 标识符: tk.after()
     id_after = None
-    # 股票代码表
-    df_stock_code = None
+    # 股票名称, stock_code ---> display_name
+    info_stock_name = None
+    # 报警信息的查询条件 (date_start, date_end, stock_code, period)
+    info_filter = None
+    # 报警信息: 已显示的最后一条记录的(s_now, stock_code, period)，None: 第一页
+    key_last_message = None
+    # 报警信息: 还有下一页
+    flag_more_message = None
+    # 数据表
+    obj_DataTable = None
+    # 监控服务的客户端，None: 本进程运行报警程序
+    obj_Client = None
+    # 单实例锁 (本地模式)，None: 客户端模式
+    obj_Lock = None
+    # 新的报警信息 (子线程放入，主线程读取): (arr_record, 是否播放声音)
+    queue_alarm = None
+    # 报警程序的工作线程 (本进程运行报警程序时)
+    thread_tick = None
+    # 工作线程的停止标志
+    event_stop = None
+    # 报警信息窗口的行 ---> (stock_code, period)
+    info_message_item = None
+    # k线图
+    obj_Chart = None
+    # k线图: 客户端读取的k线数据, (stock_code, period) ---> DataFrame
+    info_chart_bars = None
 
     def __init__(self, master=None):
         super().__init__(master)
@@ -44,6 +252,7 @@ class Application(ttk.Frame):
         self.gui_program()
         self.gui_split_h()
         self.gui_message()
+        self.gui_chart()
 
         self.grid(sticky='NSWE')
         self.rowconfigure(2, weight=1)
@@ -97,25 +306,108 @@ class Application(ttk.Frame):
                 ('message', '信息'),
                 )
         self.frame_message = frame = ttk.Frame(self)
+        # 查询条件
+        self.frame_filter = frame_f = ttk.Frame(frame)
+        self.var_date_start = tk.StringVar(frame_f)
+        self.var_date_end = tk.StringVar(frame_f)
+        self.var_stock_code = tk.StringVar(frame_f)
+        self.var_period = tk.StringVar(frame_f)
+        arr_filter = (
+                ('开始日期', self.var_date_start, 12),
+                ('结束日期', self.var_date_end, 12),
+                ('股票代码', self.var_stock_code, 14),
+                ('k线周期', self.var_period, 6),
+                )
+        for i, (text, var, width) in enumerate(arr_filter):
+            ttk.Label(frame_f, text=text).grid(row=0, column=2 * i, padx=2)
+            ttk.Entry(frame_f, textvariable=var, width=width).grid(
+                    row=0, column=2 * i + 1, padx=2,
+                    )
+        self.btn_filter = ttk.Button(
+                frame_f, text='查询', command=self.update_alarm_message,
+                )
+        self.btn_filter.grid(row=0, column=2 * len(arr_filter), padx=2)
+        frame_f.grid(row=0, column=0, columnspan=2, pady=2, sticky='W')
         self.y_table_message = y_tm= ttk.Scrollbar(frame, orient=tk.VERTICAL)
         self.table_message = tm = ttk.Treeview(
-                frame, yscrollcommand=y_tm.set,
+                frame, yscrollcommand=self.scroll_alarm_message,
                 columns=('stock_code', 'period', 'message'),
                 )
         y_tm.configure(command=tm.yview)
         for k, v in arr_text:
             tm.heading(k, text=v, anchor='w')
             tm.column(k, anchor='w')
-        y_tm.grid(row=0, column=0, sticky='NS')
-        tm.grid(row=0, column=1, sticky='NSWE')
-        frame.rowconfigure(0, weight=1)
+        y_tm.grid(row=1, column=0, sticky='NS')
+        tm.grid(row=1, column=1, sticky='NSWE')
+        frame.rowconfigure(1, weight=1)
         frame.columnconfigure(1, weight=1)
         frame.grid(padx=5, stick='NSWE')
  
+    def gui_chart(self):
+        ''' 界面: k线图 (选择报警信息时显示) '''
+        self.obj_Chart = ChartPanel(self, self.get_chart_bars, self.get_chart_alarm)
+        self.obj_Chart.grid(padx=5, pady=5, stick='NSWE')
+        self.table_message.bind('<<TreeviewSelect>>', self.select_alarm_message)
+        self.after(settings.n_chart_refresh_ms, self.refresh_chart)
+
+    def get_chart_bars(self, stock_code, period):
+        ''' k线图: k线数据, DataFrame or None '''
+        if self.obj_Client is not None:
+            # 第一次读取全部，以后只读取最近的k线
+            label = (stock_code, period)
+            if self.info_chart_bars is None:
+                self.info_chart_bars = {}
+            df_old = self.info_chart_bars.get(label)
+            n_bars = settings.n_chart_bars if df_old is None else 10
+            try:
+                info = self.obj_Client.request(
+                        'bars', stock_code=stock_code, period=period,
+                        n_bars=n_bars,
+                        )
+            except (OSError, ValueError) as e:
+                logger.error(f'k线图: {e}')
+                return df_old
+            df = pd.DataFrame(info['data'], columns=info['columns'])
+            df['date'] = pd.to_datetime(df['date'])
+            df.set_index('date', inplace=True)
+            if df_old is not None and len(df):
+                df = pd.concat((df_old[df_old.index < df.index[0]], df))
+                df = df.iloc[-settings.n_chart_bars:]
+            self.info_chart_bars = {label: df}
+            return df
+        obj_stock = self.obj_KlineInfo.info_stock.get(stock_code)
+        if obj_stock is None:
+            return None
+        try:
+            return obj_stock.get_bar(period)
+        except KeyError:
+            return None
+
+    def get_chart_alarm(self, stock_code, period, date_start):
+        ''' k线图: 报警信息 '''
+        return self.obj_DataTable.read_db__alarm_message__page(
+                settings.n_chart_markers, None, date_start, None,
+                stock_code, period,
+                )
+
+    def select_alarm_message(self, event=None):
+        ''' 选择报警信息，显示k线图 '''
+        arr_item = self.table_message.selection()
+        if not arr_item:
+            return
+        label = self.info_message_item.get(arr_item[0])
+        if label is not None:
+            self.obj_Chart.show(*label)
+
+    def refresh_chart(self):
+        ''' 定时刷新k线图 '''
+        try:
+            self.obj_Chart.refresh()
+        finally:
+            self.after(settings.n_chart_refresh_ms, self.refresh_chart)
+
     def load_data(self):
-        ''' 读取数据表
-            only_today          仅显示今天的报警信息
-        '''
+        ''' 读取数据表 '''
         info_period = {
                 '1m': '1分钟',
                 '5m': '5分钟',
@@ -123,13 +415,20 @@ class Application(ttk.Frame):
         # 报警程序
         self.load_alarm_program()
         # 报警信息
-        self.load_alarm_message(False)
+        self.update_alarm_message()
 
     def load_alarm_program(self):
         ''' 读取数据表: 报警程序 '''
         tp = self.tree_program
-        for _, obj_program in self.obj_KlineInfo.info_program.items():
-            info = obj_program.info_program
+        if self.obj_Client is not None:
+            try:
+                arr_info = self.obj_Client.request('programs')
+            except (OSError, ValueError) as e:
+                logger.error(f'读取报警程序: {e}')
+                arr_info = []
+        else:
+            arr_info = self.obj_KlineInfo.info_program.values()
+        for info in arr_info:
             # 文件名
             program_name = tp.insert(
                     '', 'end', text=info['algorithm'], values=info['remark'],
@@ -137,7 +436,7 @@ class Application(ttk.Frame):
             # 监控的股票
             stock_info = tp.insert(program_name, 'end', text='股票信息')
             for stock_code in info['arr_stock_code']:
-                stock_code_zh = self.df_stock_code.loc[stock_code].display_name
+                stock_code_zh = self.get_stock_name(stock_code)
                 tp.insert(
                         stock_info, 'end', text=stock_code,
                         values=stock_code_zh,
@@ -152,46 +451,156 @@ class Application(ttk.Frame):
                 for key, value in info['other_kwargs'].items():
                     tp.insert(other_info, 'end', text=key, values=value)
 
-    def load_alarm_message(self, only_today=True):
-        ''' 读取数据表: 报警信息 '''
+    def get_stock_name(self, stock_code):
+        ''' 股票名称 (没有时: 股票代码) '''
+        return self.info_stock_name.get(stock_code, stock_code)
+
+    def get_filter(self):
+        ''' 报警信息的查询条件 (date_start, date_end, stock_code, period)
+            日期格式错误时，忽略该条件
+        '''
+        arr_date = []
+        for var in (self.var_date_start, self.var_date_end):
+            s_date = var.get().strip()
+            try:
+                arr_date.append(pd.Timestamp(s_date).date() if s_date else None)
+            except ValueError:
+                logger.error(f'日期格式错误: {s_date}')
+                arr_date.append(None)
+        stock_code = self.var_stock_code.get().strip() or None
+        period = self.var_period.get().strip() or None
+        return (arr_date[0], arr_date[1], stock_code, period)
+
+    def check_filter(self, record):
+        ''' 报警信息是否符合查询条件 '''
+        date_start, date_end, stock_code, period = self.info_filter
+        s_now = record[0]
+        if date_start is not None and s_now < str(date_start):
+            return False
+        if date_end is not None and str(date_end + datetime.timedelta(days=1)) <= s_now:
+            return False
+        if stock_code is not None and record[1] != stock_code:
+            return False
+        if period is not None and record[2] != period:
+            return False
+        return True
+
+    def load_alarm_message(self):
+        ''' 读取数据表: 报警信息的下一页 (按时间倒序，追加到窗口的最后) '''
+        if not self.flag_more_message:
+            return
+        date_start, date_end, stock_code, period = self.info_filter
+        n_rows = settings.n_gui_page_rows
+        arr_record = self.obj_DataTable.read_db__alarm_message__page(
+                n_rows, self.key_last_message, date_start, date_end, stock_code, period,
+                )
+        tm = self.table_message
+        for s_now, stock_code, period, message in arr_record:
+            item = tm.insert(
+                    '', 'end', text=s_now,
+                    values=(self.get_stock_name(stock_code), period, message),
+                    )
+            self.info_message_item[item] = (stock_code, period)
+        self.flag_more_message = n_rows <= len(arr_record)
+        if arr_record:
+            self.key_last_message = arr_record[-1][:3]
+
+    def scroll_alarm_message(self, first, last):
+        ''' 报警信息滚动到最后时，读取下一页 '''
+        self.y_table_message.set(first, last)
+        if self.flag_more_message and 0.9 <= float(last):
+            self.load_alarm_message()
+
+    def insert_alarm_message(self, arr_record):
+        ''' 增加新的报警信息 (不读取数据表，仅符合查询条件的)
+            arr_record      [(s_now, stock_code, period, message), ...]
+        '''
         tm = self.table_message
-        today = datetime.date.today()
-        df = self.obj_KlineInfo.obj_DataTable.read_db__alarm_message()
-        df.sort_index(inplace=True)
-        for (s_now, stock_code, period), v in df.iterrows():
-            message = v.message
-            if only_today and pd.Timestamp(s_now).date() != today:
-                # 仅显示今天的报警信息
+        for s_now, stock_code, period, message in sorted(arr_record):
+            if not self.check_filter((s_now, stock_code, period)):
                 continue
-            stock_code_zh = self.df_stock_code.loc[stock_code].display_name
-            tm.insert(
-                    '', 0, text=s_now, values=(stock_code_zh, period, message),
+            item = tm.insert(
+                    '', 0, text=s_now,
+                    values=(self.get_stock_name(stock_code), period, message),
                     )
+            self.info_message_item[item] = (stock_code, period)
 
     def update_alarm_message(self):
-        ''' 刷新"报警信息"窗口的内容 '''
+        ''' 按查询条件，刷新"报警信息"窗口的内容 (第一页) '''
         tm = self.table_message
         tm.delete(*tm.get_children())
+        self.info_message_item = {}
+        self.info_filter = self.get_filter()
+        # 第一页
+        self.key_last_message = None
+        self.flag_more_message = True
         self.load_alarm_message()
 
     def run_select(self):
         s_now = datetime.datetime.now().isoformat()
         if self.flag_run.get():
             print(f'报警程序开始运行 ... {s_now}')
-            self.update_clock()
-            # 每次点击"运行"时，都需要刷新"报警信息"窗口的内容
-            self.only_once = True
+            if self.obj_Client is None:
+                # 每次点击"运行"时，第一次运行的报警信息不播放声音
+                # (启动时从快照恢复了运行状态，第一次点击不需要第一次运行)
+                self.only_once = not self.obj_KlineInfo.flag_warm_start
+                self.obj_KlineInfo.flag_warm_start = False
+                self.start_tick()
+            self.poll_alarm()
         else:
             print(f'报警程序停止运行 ... {s_now}')
-            self.master.after_cancel(self.id_after)
-            self.id_after = None
-            self.only_once = False
+            self.stop_tick()
+            if self.id_after is not None:
+                self.master.after_cancel(self.id_after)
+                self.id_after = None
 
     def init_alarm_program(self):
-        ''' 初始报警程序 '''
+        ''' 初始报警程序
+            监控服务(daemon.py)在运行时，作为客户端，不下载行情、不运行报警程序
+            本地模式需要单实例锁(daemon.InstanceLock)；
+            锁被持有(监控服务正在启动)时，等待监控服务开始服务，作为客户端
+        '''
         self.only_once = True
-        self.obj_KlineInfo = a_s.KlineInfo()
-        self.df_stock_code = self.obj_KlineInfo.obj_DataTable.read_db__stock_code()
+        self.queue_alarm = queue.Queue()
+        obj_client = daemon.DaemonClient()
+        flag_client = obj_client.is_available()
+        if not flag_client:
+            self.obj_Lock = daemon.InstanceLock()
+            if not self.obj_Lock.acquire():
+                self.obj_Lock = None
+                flag_client = True
+                logger.info(f'监控服务正在启动，等待: {obj_client.address}')
+                time_end = time.time() + settings.n_daemon_start_wait
+                while not obj_client.is_available() and time.time() < time_end:
+                    time.sleep(1)
+        if flag_client:
+            logger.info(f'连接监控服务: {obj_client.address}')
+            self.obj_Client = obj_client
+            self.obj_DataTable = a_s.DataTable()
+            obj_client.subscribe(
+                    lambda arr_record: self.queue_alarm.put((arr_record, True))
+                    )
+        else:
+            self.obj_KlineInfo = a_s.KlineInfo()
+            self.obj_DataTable = self.obj_KlineInfo.obj_DataTable
+        self.info_stock_name = self.obj_DataTable.read_db__stock_name()
+
+    def poll_alarm(self):
+        ''' 读取新的报警信息 (子线程放入队列，主线程定时读取、显示) '''
+        arr_record = []
+        flag_audio = False
+        while True:
+            try:
+                arr, flag = self.queue_alarm.get_nowait()
+            except queue.Empty:
+                break
+            arr_record.extend(arr)
+            flag_audio = flag_audio or flag
+        if arr_record:
+            self.insert_alarm_message(arr_record)
+        if flag_audio:
+            self.play_audio()
+        self.id_after = self.master.after(settings.n_gui_poll_ms, self.poll_alarm)
 
     def init_audio(self):
         ''' 初始化声音系统 '''
@@ -205,65 +614,65 @@ class Application(ttk.Frame):
         self.obj_sound.stop()
         self.obj_sound.play()
 
-    def update_clock(self):
-        ''' 更新定时器 '''
-        self.job()
-        now = datetime.datetime.now()
-        delta_seconds, delta_microseconds = self.calc_delta_time(now)
-        delta_time = int(delta_seconds * 1000 + delta_microseconds / 1000.0)
-        self.id_after = self.master.after(delta_time, self.update_clock)
+    def start_tick(self):
+        ''' 启动报警程序的工作线程 '''
+        self.stop_tick()
+        self.event_stop = threading.Event()
+        self.thread_tick = threading.Thread(
+                target=self.run_tick, args=(self.event_stop,),
+                name='gui_tick', daemon=True,
+                )
+        self.thread_tick.start()
+
+    def stop_tick(self):
+        ''' 停止报警程序的工作线程 (正在运行的任务结束后) '''
+        if self.event_stop is not None:
+            self.event_stop.set()
+        self.event_stop = None
+        self.thread_tick = None
+
+    def run_tick(self, event_stop):
+        ''' 工作线程: 定时执行报警程序 (不访问tk控件，新的报警信息放入队列) '''
+        while not event_stop.is_set():
+            self.job()
+            now = datetime.datetime.now()
+            market_opening, _ = self.obj_KlineInfo.calc_session(
+                    now, self.t_continue_run
+                    )
+            if not market_opening:
+                # 闭市后，补充k线数据的缺口
+                self.obj_KlineInfo.check_after_close(now)
+            delta_seconds, delta_microseconds = self.calc_delta_time(
+                    datetime.datetime.now()
+                    )
+            event_stop.wait(delta_seconds + delta_microseconds / 1000000.0)
 
     def job(self):
-        ''' 定时执行的任务 '''
+        ''' 定时执行的任务 (工作线程) '''
         obj = self.obj_KlineInfo
+        only_once = self.only_once
         try:
-            flag = obj.run_cron(self)
-            if flag and not self.only_once:
-                self.play_audio()
+            flag = obj.run_cron(only_once)
         except ValueError as e:
             logger.error(f'{e}')
         else:
-            if self.only_once:
-                self.only_once = False
-                self.update_alarm_message()
+            if flag:
+                # 第一次运行的报警信息不播放声音
+                self.queue_alarm.put((list(obj.arr_alarm_msg), not only_once))
+            self.only_once = False
 
     def calc_delta_time(self, now):
-        ''' 计算休眠时间 '''
-        market_opening = False
-        now_weekday = now.date().weekday()
-        t_am_begin = datetime.datetime(now.year, now.month, now.day, 9, 30)
-        t_am_end = datetime.datetime(now.year, now.month, now.day, 11, 30)
-        t_pm_begin = datetime.datetime(now.year, now.month, now.day, 13)
-        t_pm_end = datetime.datetime(now.year, now.month, now.day, 15, 0)
-        if now_weekday < 5:
-            if now < t_am_begin:
-                # 早市之前
-                next_time = t_am_begin
-            elif t_am_end < now < t_pm_begin:
-                # 中午休市时间
-                next_time = t_pm_begin
-            elif (
-                    t_am_begin <= now <= t_am_end + self.t_continue_run
-                    or t_pm_begin <= now <= t_pm_end + self.t_continue_run
-                    ):
-                # 早上开市期间 or 下午开市期间
-                next_time = datetime.datetime(
-                        now.year, now.month, now.day, now.hour, now.minute, 3,
-                        ) + datetime.timedelta(minutes=1)
-                market_opening = True
-            else:
-                # 下午闭市之后
-                if now_weekday == 4:
-                    # 周五
-                    wait_day = datetime.timedelta(days=3)
-                else:
-                    # 周一..周四
-                    wait_day = datetime.timedelta(days=1)
-                next_time = t_am_begin + wait_day
-        else:
-            # 周末
-            wait_day = datetime.timedelta(days=7 - now_weekday)
-            next_time = t_am_begin + wait_day
+        ''' 计算休眠时间
+            开市期间: 下一分钟的第3秒 (HH:MM:03)
+            其它时间(午休、闭市、周末、节假日): 下一个开市时间
+        '''
+        market_opening, next_time = self.obj_KlineInfo.calc_session(
+                now, self.t_continue_run
+                )
+        if market_opening:
+            next_time = datetime.datetime(
+                    now.year, now.month, now.day, now.hour, now.minute, 3,
+                    ) + datetime.timedelta(minutes=1)
         delta_time = next_time - now
         return (delta_time.seconds, delta_time.microseconds)
 
@@ -272,6 +681,12 @@ def main():
     root = tk.Tk()
     app = Application(root)
     root.mainloop()
+    if app.obj_KlineInfo is not None:
+        # 关闭窗口: 待写入的数据写入数据表
+        app.stop_tick()
+        app.obj_KlineInfo.close(settings.n_persist_timeout)
+    if app.obj_Lock is not None:
+        app.obj_Lock.release()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,268 @@
+# -*- encoding: utf-8 -*-
+''' 技术指标的缓存 (所有报警程序共用)
+多个报警程序监控相同的股票、k线周期，使用相同的指标时，
+同一个k线数据只计算一次指标。
+    键值: (stock_code, period, indicator, params, last_time)
+        stock_code      股票代码
+        period          k线周期
+        indicator       指标名称，例如: 'MACD'
+        params          指标参数，tuple，例如: ('open', 26, 12, 9)
+        last_time       最后一个k线的时间
+新的k线数据到达时，删除该股票的缓存(invalidate)；
+缓存占用的内存超过限制时，删除最久未使用的指标(LRU)。
+指标在线程锁之外计算，同一个键值同时只计算一次(其它调用等待)，不同的键值不互相等待。
+报警插件的用法:
+    >>> import indicator_cache
+    >>> df_macd = indicator_cache.get_indicator(
+    ...         info, 'MACD', ('open', 26, 12, 9), lambda: calc_macd(price),
+    ...         )
+批量接口(2维数组，每行一个股票)，按股票缓存，与其它报警程序、k线周期共用:
+    >>> bar, = indicator_cache.get_indicator_batch(
+    ...         info, 'open', 'MACD.BAR', (26, 12, 9),
+    ...         lambda arr: kernel.macd(arr, 26, 12, 9)[2:],
+    ...         )
+    键值的params增加价格的名称、每行第一个有效k线的时间(递推指标与起点有关)，
+    缓存的是每个股票的有效k线(跳过nan)的指标，与其它股票的k线时间无关。
+注意: 缓存的指标由多个报警程序共用，不能修改。
+'''
+
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def calc_nbytes(obj):
+    ''' 估算指标占用的内存 '''
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        nbytes = obj.memory_usage(index=True, deep=False)
+        return int(np.sum(nbytes))
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    if isinstance(obj, (tuple, list)):
+        return sum(calc_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(calc_nbytes(o) for o in obj.values())
+    return 64
+
+
+class IndicatorCache:
+    ''' 技术指标的缓存 (LRU，限制内存) '''
+    # 缓存的指标, OrderedDict: key ---> (value, nbytes)
+    info_value = None
+    # (stock_code, period) ---> set([key, ...])
+    info_label = None
+    # 正在计算的指标, key ---> threading.Event (计算完成)
+    info_pending = None
+    # 内存限制 (字节)
+    n_limit_bytes = None
+    # 占用的内存 (字节)
+    n_bytes = None
+    # 统计: 命中、未命中、删除
+    n_hit = None
+    n_miss = None
+    n_evict = None
+    # 线程锁
+    lock = None
+
+    def __init__(self, n_limit_mb=settings.n_indicator_cache_mb):
+        self.info_value = OrderedDict()
+        self.info_label = {}
+        self.info_pending = {}
+        self.n_limit_bytes = int(n_limit_mb * 1024 * 1024)
+        self.n_bytes = 0
+        self.n_hit = self.n_miss = self.n_evict = 0
+        self.lock = threading.RLock()
+
+    def get(self, stock_code, period, indicator, params, last_time, func):
+        ''' 读取指标，缓存中不存在时，调用func()计算 '''
+        key = (stock_code, period, indicator, params, last_time)
+        while True:
+            with self.lock:
+                item = self.info_value.get(key)
+                if item is not None:
+                    self.info_value.move_to_end(key)
+                    self.n_hit += 1
+                    return item[0]
+                event = self.info_pending.get(key)
+                if event is None:
+                    # 本线程计算
+                    event = threading.Event()
+                    self.info_pending[key] = event
+                    self.n_miss += 1
+                    break
+            # 其它线程正在计算相同的指标，完成后重新读取
+            event.wait()
+        try:
+            value = func()
+            self.put(key, value)
+        finally:
+            with self.lock:
+                del self.info_pending[key]
+            event.set()
+        return value
+
+    def peek(self, key):
+        ''' 读取缓存的指标，不计算 (批量接口)
+            返回值: 指标 or None(不存在)
+        '''
+        with self.lock:
+            item = self.info_value.get(key)
+            if item is None:
+                self.n_miss += 1
+                return None
+            self.info_value.move_to_end(key)
+            self.n_hit += 1
+            return item[0]
+
+    def put(self, key, value):
+        ''' 写入缓存 '''
+        nbytes = calc_nbytes(value)
+        if self.n_limit_bytes < nbytes:
+            # 超过内存限制，不缓存
+            return
+        with self.lock:
+            self.remove(key)
+            self.info_value[key] = (value, nbytes)
+            self.info_label.setdefault(key[:2], set()).add(key)
+            self.n_bytes += nbytes
+            while self.n_limit_bytes < self.n_bytes:
+                key_old = next(iter(self.info_value))
+                self.remove(key_old)
+                self.n_evict += 1
+
+    def remove(self, key):
+        ''' 删除缓存的指标 '''
+        item = self.info_value.pop(key, None)
+        if item is None:
+            return
+        self.n_bytes -= item[1]
+        arr_key = self.info_label.get(key[:2])
+        if arr_key is not None:
+            arr_key.discard(key)
+            if not arr_key:
+                del self.info_label[key[:2]]
+
+    def invalidate(self, stock_code, period=None):
+        ''' 新的k线数据到达，删除股票(k线周期)的缓存 '''
+        with self.lock:
+            arr_label = [
+                    label for label in self.info_label
+                    if label[0] == stock_code
+                    and (period is None or label[1] == period)
+                    ]
+            for label in arr_label:
+                for key in list(self.info_label.get(label, ())):
+                    self.remove(key)
+
+    def clear(self):
+        ''' 清空缓存 '''
+        with self.lock:
+            self.info_value.clear()
+            self.info_label.clear()
+            self.n_bytes = 0
+
+    def get_stats(self):
+        ''' 缓存的统计信息 '''
+        with self.lock:
+            return {
+                    'count': len(self.info_value),
+                    'bytes': self.n_bytes,
+                    'limit_bytes': self.n_limit_bytes,
+                    'hit': self.n_hit,
+                    'miss': self.n_miss,
+                    'evict': self.n_evict,
+                    }
+
+
+# 所有报警程序共用的缓存
+obj_cache = IndicatorCache()
+
+
+def get_indicator(info, indicator, params, func, period=None):
+    ''' 报警插件读取指标
+    入口参数:
+        info            报警算法的入口参数(alarm_algorithm(info))
+        indicator       指标名称
+        params          指标参数，tuple (可以作为dict的键值)
+        func            计算指标的函数，func()
+        period          k线周期，None: info['period']
+    '''
+    if period is None:
+        period = info['period']
+    df = info['data_kline'][period]
+    last_time = df.index[-1] if df.index.size else None
+    return obj_cache.get(
+            info['stock_code'], period, indicator, params, last_time, func
+            )
+
+
+def get_indicator_batch(info, name, indicator, params, func, period=None):
+    ''' 报警插件的批量接口读取指标 (每个股票一行，按股票缓存)
+    入口参数:
+        info            k线数据(get_aligned_bars()的返回值)，批量接口的入口参数 or info['long']
+        name            价格的名称，例如: 'open'
+        indicator       指标名称
+        params          指标参数，tuple
+        func            计算指标的函数，func(arr_2d) ---> (2维数组, ...)
+                        计算时跳过nan(kernel的函数)，每行的结果只与该行的有效值有关
+        period          k线周期，None: info['period']
+    返回值: (2维数组, ...)，与info[name]对齐，没有k线的位置为nan
+        只计算缓存中不存在的股票(一次调用func())。
+    '''
+    if period is None:
+        period = info['period']
+    arr = info[name]
+    index = info['index']
+    valid = ~np.isnan(arr)
+    flag_any = valid.any(axis=1)
+    pos_first = np.argmax(valid, axis=1)
+    pos_last = arr.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    arr_key = []
+    arr_value = []
+    for i, stock_code in enumerate(info['arr_stock_code']):
+        if not flag_any[i]:
+            arr_key.append(None)
+            arr_value.append(None)
+            continue
+        key = (
+                stock_code, period, indicator,
+                (name,) + params + (index[pos_first[i]],), index[pos_last[i]],
+                )
+        arr_key.append(key)
+        arr_value.append(obj_cache.peek(key))
+    arr_row = [
+            i for i, key in enumerate(arr_key)
+            if key is not None and arr_value[i] is None
+            ]
+    if arr_row:
+        arr_out = func(arr[arr_row])
+        for k, i in enumerate(arr_row):
+            value = tuple(out[k, valid[i]] for out in arr_out)
+            obj_cache.put(arr_key[i], value)
+            arr_value[i] = value
+    arr_ret = None
+    for i, value in enumerate(arr_value):
+        if value is None:
+            continue
+        if arr_ret is None:
+            arr_ret = tuple(np.full(arr.shape, np.nan) for _ in value)
+        for out, row in zip(arr_ret, value):
+            out[i, valid[i]] = row
+    if arr_ret is None:
+        # 所有股票都没有k线
+        return tuple(func(arr))
+    return arr_ret
+
+
+def invalidate(stock_code, period=None):
+    ''' 新的k线数据到达，删除股票(k线周期)的缓存 '''
+    obj_cache.invalidate(stock_code, period)
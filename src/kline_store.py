@@ -0,0 +1,409 @@
+# -*- encoding: utf-8 -*-
+''' k线数据的存储 (紧凑模式、内存预算)
+SingleStockInfo.data_kline为KlineStore(): period ---> DataFrame，接口同dict，报警插件不需要修改。
+紧凑模式 (settings.kline_dtype):
+    None        float64 DataFrame (原来的方式)
+    'float32'   基础周期的k线另外保存为紧凑数组(PackedBars):
+                    时间: int32, 相对于epoch(第一个k线的日期)的分钟数
+                    价格: float32 (约7位有效数字)
+    'int32'     价格: int32 (价格 x settings.n_kline_price_scale)，超出范围时使用float32
+    float64 DataFrame(报警插件使用)是紧凑数组的缓存，内存不够时删除，读取时重建。
+    只使用无损的紧凑数组: 重建的价格与原来的价格完全相同，报警信息不变；
+    价格无法无损保存时(float32的有效数字、小数位数超过int32的倍数)，记录日志，
+    该股票不使用紧凑模式(基础周期的DataFrame不删除)。
+内存预算 (settings.n_kline_budget_mb，所有股票共用，0: 不限制):
+    超出时按LRU删除最久没有读取的DataFrame:
+        其它k线周期 ---> 读取时由基础周期重新计算 (SingleStockInfo.build_period())
+        基础周期 ---> 紧凑模式时，读取时由紧凑数组重建；否则不删除
+    删除的k线周期不再增量更新(period_update)，读取时全部计算。
+内存报告: KlineStore.get_report()、get_stats()，k线数量、DataFrame和紧凑数组的字节数、删除和重建的次数。
+'''
+
+import os
+import threading
+import weakref
+
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+import numpy as np
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def calc_nbytes(df):
+    ''' DataFrame占用的内存 (包含index) '''
+    return int(df.memory_usage(index=True, deep=False).sum())
+
+
+def get_rss():
+    ''' 进程占用的物理内存(字节)，无法读取: None '''
+    try:
+        with open('/proc/self/statm') as f:
+            n_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return n_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class PackedBars:
+    ''' 紧凑数组: 一个股票的基础周期k线 '''
+    # 价格的类型: 'float32' or 'int32'
+    dtype = None
+    # int32价格的倍数，float32: None
+    scale = None
+    # 时间的起点, numpy.datetime64[m]
+    epoch = None
+    # 时间: epoch之后的分钟数 (int32，预留空间)
+    arr_offset = None
+    # 价格: (k线 x 列)，预留空间
+    arr_value = None
+    # k线数量
+    n = None
+    # 列名
+    columns = None
+    # index的名称
+    index_name = None
+
+    def __init__(self, dtype):
+        if dtype not in ('float32', 'int32'):
+            raise ValueError(f'k线的存储方式错误: {dtype}')
+        self.dtype = dtype
+        if dtype == 'int32':
+            self.scale = settings.n_kline_price_scale
+        self.n = 0
+
+    @property
+    def nbytes(self):
+        if self.arr_offset is None:
+            return 0
+        return self.arr_offset.nbytes + self.arr_value.nbytes
+
+    def get_time(self, i):
+        ''' 第i个k线的时间 '''
+        return pd.Timestamp(self.epoch + np.timedelta64(int(self.arr_offset[i]), 'm'))
+
+    def update(self, df):
+        ''' 保存k线数据
+            前面的k线不变时(增加k线)，仅保存新的k线，其它: 全部保存
+            无法保存(时间不是整分钟、价格超出int32的范围、价格无法无损保存): ValueError
+        '''
+        n = df.index.size
+        start = 0
+        if (
+                self.n and self.n <= n
+                and list(df.columns) == self.columns
+                and df.index[0] == self.get_time(0)
+                and df.index[self.n - 1] == self.get_time(self.n - 1)
+                ):
+            start = self.n
+        elif n:
+            self.columns = list(df.columns)
+            self.index_name = df.index.name
+            self.epoch = df.index[0].to_datetime64().astype('datetime64[D]').astype('datetime64[m]')
+        self.write(df.iloc[start:], start)
+
+    def write(self, df, start):
+        ''' 从第start个k线开始写入 '''
+        n_new = df.index.size
+        if n_new:
+            arr_time = df.index.values
+            arr_minute = arr_time.astype('datetime64[m]')
+            if (arr_minute != arr_time).any():
+                raise ValueError('k线的时间不是整分钟')
+            arr_offset = (arr_minute - self.epoch).astype(np.int64)
+            if arr_offset[0] < 0 or np.iinfo(np.int32).max < arr_offset[-1]:
+                raise ValueError('k线的时间超出int32的范围')
+            values_raw = df[self.columns].values.astype(np.float64)
+            values = values_raw
+            if self.scale is not None:
+                values = np.round(values_raw * self.scale)
+                if not np.isfinite(values).all() or np.iinfo(np.int32).max < np.abs(values).max():
+                    raise ValueError('k线的价格超出int32的范围')
+            # 重建的价格(to_frame())必须与原来的价格相同
+            values_back = values.astype(self.dtype).astype(np.float64)
+            if self.scale is not None:
+                values_back /= self.scale
+            if not np.array_equal(values_back, values_raw, equal_nan=True):
+                raise ValueError(f'k线的价格无法无损保存为{self.dtype}')
+            self.reserve(start + n_new)
+            self.arr_offset[start:start + n_new] = arr_offset
+            self.arr_value[start:start + n_new] = values
+        self.n = start + n_new
+
+    def reserve(self, n):
+        ''' 预留空间 (增加时1.5倍，减少复制的次数) '''
+        n_cap = 0 if self.arr_offset is None else self.arr_offset.size
+        if n <= n_cap:
+            return
+        n_cap = max(n, n_cap + n_cap // 2, 256)
+        arr_offset = np.empty(n_cap, dtype=np.int32)
+        arr_value = np.empty((n_cap, len(self.columns)), dtype=self.dtype)
+        if self.n:
+            arr_offset[:self.n] = self.arr_offset[:self.n]
+            arr_value[:self.n] = self.arr_value[:self.n]
+        self.arr_offset, self.arr_value = arr_offset, arr_value
+
+    def to_frame(self):
+        ''' 重建float64 DataFrame '''
+        n = self.n
+        index = pd.DatetimeIndex(
+                (self.epoch + self.arr_offset[:n].astype('timedelta64[m]')).astype('datetime64[ns]'),
+                name=self.index_name,
+                )
+        values = self.arr_value[:n].astype(np.float64)
+        if self.scale is not None:
+            values /= self.scale
+        return pd.DataFrame(values, index=index, columns=self.columns, copy=False)
+
+
+class KlineStore(MutableMapping):
+    ''' 一个股票的k线数据: period ---> DataFrame '''
+    # 股票代码
+    stock_code = None
+    # 基础周期
+    period_base = None
+    # 重新计算其它k线周期的函数, func_build(period) ---> DataFrame
+    func_build = None
+    # period ---> DataFrame，None: 已删除(内存预算)
+    info_frame = None
+    # 基础周期的紧凑数组，None: 没有使用紧凑模式
+    obj_packed = None
+    # 统计: 重建的次数
+    n_rebuild = None
+
+    def __init__(self, stock_code, period_base, func_build, info=None):
+        self.stock_code = stock_code
+        self.period_base = period_base
+        self.func_build = func_build
+        self.info_frame = {}
+        self.n_rebuild = 0
+        if settings.kline_dtype is not None:
+            self.obj_packed = PackedBars(settings.kline_dtype)
+        if info:
+            for period, df in info.items():
+                self[period] = df
+
+    def __getitem__(self, period):
+        df = self.info_frame[period]
+        if df is None:
+            df = self.rebuild(period)
+        else:
+            obj_budget.touch(self, period)
+        return df
+
+    def __setitem__(self, period, df):
+        self.info_frame[period] = df
+        flag_evict = period != self.period_base
+        if period == self.period_base and self.obj_packed is not None:
+            try:
+                self.obj_packed.update(df)
+            except ValueError as e:
+                self.obj_packed = None
+                if settings.kline_dtype == 'int32':
+                    # int32无法保存，使用float32
+                    obj_packed = PackedBars('float32')
+                    try:
+                        obj_packed.update(df)
+                        self.obj_packed = obj_packed
+                    except ValueError:
+                        pass
+                if self.obj_packed is None:
+                    logger.warning(f'{self.stock_code}: {e}, 不使用紧凑模式(基础周期不删除)')
+                else:
+                    logger.warning(f'{self.stock_code}: {e}, 使用float32')
+            flag_evict = self.obj_packed is not None
+            obj_budget.set_packed(
+                    self, self.obj_packed.nbytes if self.obj_packed else 0
+                    )
+        obj_budget.set_frame(self, period, calc_nbytes(df), flag_evict)
+
+    def __delitem__(self, period):
+        del self.info_frame[period]
+        obj_budget.remove(self, period)
+
+    def __contains__(self, period):
+        return period in self.info_frame
+
+    def __iter__(self):
+        return iter(list(self.info_frame))
+
+    def __len__(self):
+        return len(self.info_frame)
+
+    def rebuild(self, period):
+        ''' 读取已删除的k线周期: 重建 '''
+        if period == self.period_base:
+            df = self.obj_packed.to_frame()
+        else:
+            df = self.func_build(period)
+        self.n_rebuild += 1
+        self.info_frame[period] = df
+        obj_budget.set_frame(self, period, calc_nbytes(df), True)
+        return df
+
+    def evict(self, period):
+        ''' 删除DataFrame (内存预算)，读取时重建 '''
+        if self.info_frame.get(period) is not None:
+            self.info_frame[period] = None
+
+    def is_loaded(self, period):
+        ''' DataFrame在内存中 (没有删除) '''
+        return self.info_frame.get(period) is not None
+
+    def get_loaded(self):
+        ''' 在内存中的k线周期 (增量更新时，只更新这些k线周期) '''
+        return [period for period, df in self.info_frame.items() if df is not None]
+
+    def get_last_time(self, period):
+        ''' 最后一个k线的时间 (基础周期已删除时，不重建) '''
+        df = self.info_frame[period]
+        if df is None and period == self.period_base:
+            return self.obj_packed.get_time(self.obj_packed.n - 1)
+        return self[period].index[-1]
+
+    def get_n_bars(self, period):
+        ''' k线数量 (基础周期已删除时，不重建) '''
+        df = self.info_frame[period]
+        if df is None and period == self.period_base:
+            return self.obj_packed.n
+        return self[period].index.size
+
+    def release(self):
+        ''' 不再使用 (删除股票)，释放内存预算 '''
+        obj_budget.release(self)
+
+    def get_report(self):
+        ''' 内存报告: period ---> dict '''
+        info = {}
+        for period, df in list(self.info_frame.items()):
+            info[period] = {
+                    'n_bars': None if df is None else df.index.size,
+                    'loaded': df is not None,
+                    'frame_bytes': 0 if df is None else calc_nbytes(df),
+                    }
+        if self.obj_packed is not None and self.period_base in info:
+            info[self.period_base].update({
+                    'n_bars': self.obj_packed.n,
+                    'packed_bytes': self.obj_packed.nbytes,
+                    'dtype': self.obj_packed.dtype,
+                    })
+        return info
+
+
+class KlineBudget:
+    ''' 所有股票的k线数据的内存预算 (LRU) '''
+    # DataFrame, OrderedDict: (id(store), period) ---> (weakref(store), nbytes, 是否可以删除)
+    info_frame = None
+    # 紧凑数组, id(store) ---> (weakref(store), nbytes)
+    info_packed = None
+    # 占用的内存 (字节)
+    n_bytes_frame = None
+    n_bytes_packed = None
+    # 统计: 删除的次数
+    n_evict = None
+    # 线程锁
+    lock = None
+
+    def __init__(self):
+        self.info_frame = OrderedDict()
+        self.info_packed = {}
+        self.n_bytes_frame = self.n_bytes_packed = 0
+        self.n_evict = 0
+        self.lock = threading.RLock()
+
+    def get_limit(self):
+        ''' 内存预算(字节)，0: 不限制 '''
+        return int(settings.n_kline_budget_mb * 1024 * 1024)
+
+    def set_frame(self, obj_store, period, nbytes, flag_evict):
+        ''' 增加 or 更新DataFrame，超出预算时删除最久没有读取的 '''
+        key = (id(obj_store), period)
+        with self.lock:
+            item = self.info_frame.pop(key, None)
+            if item is not None:
+                self.n_bytes_frame -= item[1]
+            self.info_frame[key] = (weakref.ref(obj_store), nbytes, flag_evict)
+            self.n_bytes_frame += nbytes
+            self.check(key)
+
+    def set_packed(self, obj_store, nbytes):
+        ''' 更新紧凑数组的字节数 '''
+        key = id(obj_store)
+        with self.lock:
+            item = self.info_packed.pop(key, None)
+            if item is not None:
+                self.n_bytes_packed -= item[1]
+            if nbytes:
+                self.info_packed[key] = (weakref.ref(obj_store), nbytes)
+                self.n_bytes_packed += nbytes
+
+    def touch(self, obj_store, period):
+        ''' 读取: 最近使用 '''
+        key = (id(obj_store), period)
+        with self.lock:
+            if key in self.info_frame:
+                self.info_frame.move_to_end(key)
+
+    def remove(self, obj_store, period):
+        with self.lock:
+            item = self.info_frame.pop((id(obj_store), period), None)
+            if item is not None:
+                self.n_bytes_frame -= item[1]
+
+    def release(self, obj_store):
+        ''' 删除股票的所有k线数据 '''
+        key_store = id(obj_store)
+        with self.lock:
+            for key in [key for key in self.info_frame if key[0] == key_store]:
+                self.n_bytes_frame -= self.info_frame.pop(key)[1]
+            self.set_packed(obj_store, 0)
+
+    def check(self, key_keep=None):
+        ''' 超出预算时，按LRU删除DataFrame (key_keep: 正在使用的，不删除) '''
+        n_limit = self.get_limit()
+        if n_limit <= 0 or self.n_bytes_frame + self.n_bytes_packed <= n_limit:
+            return
+        for key, (ref, nbytes, flag_evict) in list(self.info_frame.items()):
+            if self.n_bytes_frame + self.n_bytes_packed <= n_limit:
+                break
+            obj_store = ref()
+            if obj_store is None:
+                # 已经删除的股票
+                del self.info_frame[key]
+                self.n_bytes_frame -= nbytes
+                continue
+            if key == key_keep or not flag_evict:
+                continue
+            obj_store.evict(key[1])
+            del self.info_frame[key]
+            self.n_bytes_frame -= nbytes
+            self.n_evict += 1
+
+    def get_stats(self):
+        ''' 统计信息 '''
+        with self.lock:
+            return {
+                    'frame_bytes': self.n_bytes_frame,
+                    'packed_bytes': self.n_bytes_packed,
+                    'limit_bytes': self.get_limit(),
+                    'n_frame': len(self.info_frame),
+                    'evict': self.n_evict,
+                    'dtype': settings.kline_dtype,
+                    }
+
+
+# 所有股票共用的内存预算
+obj_budget = KlineBudget()
+
+
+def get_stats():
+    ''' k线数据的内存统计 '''
+    info = obj_budget.get_stats()
+    info['rss_bytes'] = get_rss()
+    return info
@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+''' 报警信息的通知 (异步)
+报警程序运行结束后，KlineInfo.output_alarm_msg()把本次的报警信息(一批)放入队列，
+不等待通知完成；每个通知方式(sink)一个工作线程，从自己的队列中取出发送:
+    >>> import notify
+    >>> obj_Notify = notify.create_dispatcher(func_audio=play_audio)
+    >>> obj_Notify.publish(arr_alarm_msg, only_once)
+    >>> obj_Notify.get_stats()
+    >>> obj_Notify.stop()
+通知方式 (settings.arr_notify_sink):
+    console     打印报警信息
+    audio       播放声音 (第一次运行的报警信息不播放)
+    file        追加到文件 settings.f_name_notify
+    webhook     HTTP POST json 到 settings.notify_webhook_url
+    desktop     桌面通知 (notify-send)
+队列长度有限制(settings.n_notify_queue)，队列满时丢弃最早的一批；
+发送失败时重试(settings.n_notify_retry)，重试间隔按指数增加(settings.n_notify_backoff)。
+统计: 每个通知方式的发送、失败、丢弃的数量，延迟(放入队列 ---> 发送完成)的p50/p99(毫秒)。
+'''
+
+import collections
+import json
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import urllib.request
+
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+# 报警信息的列名
+arr_column = ['s_now', 'stock_code', 'period', 'message']
+
+
+def format_record(record):
+    ''' 一条报警信息的文字 '''
+    return '\t'.join(str(value) for value in record)
+
+
+class Sink(ABC):
+    ''' 通知方式 '''
+    # 名称
+    name = None
+    # 第一次运行的报警信息是否通知
+    flag_only_once = True
+
+    @abstractmethod
+    def send(self, arr_record):
+        ''' 发送一批报警信息
+            arr_record      [(s_now, stock_code, period, message), ...]
+            发送失败: raise Exception
+        '''
+        pass
+
+
+class ConsoleSink(Sink):
+    ''' 打印报警信息 '''
+    name = 'console'
+
+    def send(self, arr_record):
+        df = pd.DataFrame(list(arr_record), columns=arr_column)
+        df.set_index(arr_column[:3], inplace=True)
+        df.sort_index(inplace=True)
+        print(df)
+
+
+class AudioSink(Sink):
+    ''' 播放声音 (一批报警信息播放一次) '''
+    name = 'audio'
+    flag_only_once = False
+    # 播放声音的函数
+    func_audio = None
+
+    def __init__(self, func_audio):
+        self.func_audio = func_audio
+
+    def send(self, arr_record):
+        self.func_audio()
+
+
+class FileSink(Sink):
+    ''' 追加到文件，每条报警信息一行 '''
+    name = 'file'
+    # 文件名
+    f_name = None
+
+    def __init__(self, f_name=None):
+        if f_name is None:
+            f_name = settings.f_name_notify
+        self.f_name = f_name
+
+    def send(self, arr_record):
+        with open(self.f_name, 'a', encoding='utf-8') as f:
+            for record in arr_record:
+                f.write(format_record(record) + '\n')
+
+
+class WebhookSink(Sink):
+    ''' HTTP POST json: {"alarm": [{"s_now":..., "stock_code":..., ...}, ...]} '''
+    name = 'webhook'
+    # 地址
+    url = None
+
+    def __init__(self, url=None):
+        if url is None:
+            url = settings.notify_webhook_url
+        if not url:
+            raise ValueError('webhook的地址(settings.notify_webhook_url)没有设置')
+        self.url = url
+
+    def send(self, arr_record):
+        data = json.dumps(
+                {'alarm': [dict(zip(arr_column, record)) for record in arr_record]},
+                ensure_ascii=False,
+                ).encode('utf-8')
+        request = urllib.request.Request(
+                self.url, data=data,
+                headers={'Content-Type': 'application/json; charset=utf-8'},
+                )
+        with urllib.request.urlopen(
+                request, timeout=settings.n_notify_timeout
+                ) as response:
+            response.read()
+
+
+class DesktopSink(Sink):
+    ''' 桌面通知 (notify-send) '''
+    name = 'desktop'
+    # notify-send的路径
+    f_name_command = None
+
+    def __init__(self):
+        self.f_name_command = shutil.which('notify-send')
+        if self.f_name_command is None:
+            raise ValueError('桌面通知: 没有找到notify-send')
+
+    def send(self, arr_record):
+        body = '\n'.join(format_record(record[1:]) for record in arr_record)
+        subprocess.run(
+                [self.f_name_command, f'股票报警 {arr_record[0][0]}', body],
+                check=True, timeout=settings.n_notify_timeout,
+                )
+
+
+class SinkWorker:
+    ''' 一个通知方式的队列和工作线程 '''
+    # 通知方式
+    obj_sink = None
+    # 队列, 每项: (放入队列的时间, arr_record) or None(停止)
+    obj_queue = None
+    # 工作线程
+    thread = None
+    # 延迟(秒)
+    arr_latency = None
+    # 统计: 发送、失败、丢弃、重试的次数
+    n_sent = None
+    n_failed = None
+    n_dropped = None
+    n_retry = None
+    # 线程锁
+    lock = None
+
+    def __init__(self, obj_sink):
+        self.obj_sink = obj_sink
+        self.obj_queue = queue.Queue(maxsize=settings.n_notify_queue)
+        self.arr_latency = collections.deque(maxlen=1000)
+        self.n_sent = self.n_failed = self.n_dropped = self.n_retry = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(
+                target=self.run, name=f'notify_{obj_sink.name}', daemon=True,
+                )
+        self.thread.start()
+
+    def put(self, arr_record):
+        ''' 放入队列 (不等待)，队列满时丢弃最早的一批 '''
+        item = (time.time(), arr_record)
+        while True:
+            try:
+                self.obj_queue.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.obj_queue.get_nowait()
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.n_dropped += 1
+            logger.warning(f'通知{self.obj_sink.name}的队列已满，丢弃最早的一批报警信息')
+
+    def stop(self):
+        ''' 停止工作线程 (队列中的报警信息发送完成后) '''
+        while True:
+            try:
+                self.obj_queue.put(None, timeout=1)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    return
+
+    def run(self):
+        ''' 工作线程 '''
+        while True:
+            item = self.obj_queue.get()
+            if item is None:
+                return
+            time_put, arr_record = item
+            if self.send(arr_record):
+                with self.lock:
+                    self.n_sent += 1
+                    self.arr_latency.append(time.time() - time_put)
+            else:
+                with self.lock:
+                    self.n_failed += 1
+
+    def send(self, arr_record):
+        ''' 发送，失败时重试
+            返回值: 是否成功
+        '''
+        n_retry = settings.n_notify_retry
+        for i in range(n_retry + 1):
+            try:
+                self.obj_sink.send(arr_record)
+                return True
+            except Exception as e:
+                if n_retry <= i:
+                    logger.error(f'通知{self.obj_sink.name}发送失败: {e!r}')
+                    return False
+                logger.warning(f'通知{self.obj_sink.name}发送失败，第{i + 1}次重试: {e!r}')
+                with self.lock:
+                    self.n_retry += 1
+                time.sleep(settings.n_notify_backoff * 2 ** i)
+
+    def get_stats(self):
+        ''' 统计信息，延迟的单位: 毫秒 '''
+        with self.lock:
+            arr = np.array(self.arr_latency) * 1000
+            info = {
+                    'n_sent': self.n_sent,
+                    'n_failed': self.n_failed,
+                    'n_dropped': self.n_dropped,
+                    'n_retry': self.n_retry,
+                    'n_queue': self.obj_queue.qsize(),
+                    'p50_ms': None,
+                    'p99_ms': None,
+                    }
+        if arr.size:
+            info['p50_ms'] = float(np.percentile(arr, 50))
+            info['p99_ms'] = float(np.percentile(arr, 99))
+        return info
+
+
+class NotifyDispatcher:
+    ''' 报警信息的通知 (异步) '''
+    # 通知方式的工作线程 [SinkWorker(), ...]
+    arr_worker = None
+
+    def __init__(self, arr_sink):
+        self.arr_worker = [SinkWorker(obj_sink) for obj_sink in arr_sink]
+
+    def add_sink(self, obj_sink):
+        ''' 增加通知方式 '''
+        self.arr_worker.append(SinkWorker(obj_sink))
+
+    def publish(self, arr_record, only_once=False):
+        ''' 一批报警信息放入所有通知方式的队列 (不等待)
+            arr_record      [(s_now, stock_code, period, message), ...]
+            only_once       第一次运行的报警信息
+        '''
+        if not arr_record:
+            return
+        arr_record = tuple(arr_record)
+        for obj_worker in self.arr_worker:
+            if only_once and not obj_worker.obj_sink.flag_only_once:
+                continue
+            obj_worker.put(arr_record)
+
+    def stop(self, timeout=None):
+        ''' 停止所有工作线程，最多等待timeout秒 '''
+        for obj_worker in self.arr_worker:
+            obj_worker.stop()
+        if timeout is not None:
+            time_end = time.time() + timeout
+        for obj_worker in self.arr_worker:
+            if timeout is None:
+                obj_worker.thread.join()
+            else:
+                obj_worker.thread.join(max(0.0, time_end - time.time()))
+
+    def get_stats(self):
+        ''' 所有通知方式的统计信息: name ---> dict '''
+        return {
+                obj_worker.obj_sink.name: obj_worker.get_stats()
+                for obj_worker in self.arr_worker
+                }
+
+
+def create_dispatcher(arr_name=None, func_audio=None):
+    ''' 按名称创建通知方式 (settings.arr_notify_sink)
+        无法创建的通知方式，记录错误日志后忽略
+    '''
+    if arr_name is None:
+        arr_name = settings.arr_notify_sink
+    info_sink = {
+            'console': ConsoleSink,
+            'audio': lambda: AudioSink(func_audio),
+            'file': FileSink,
+            'webhook': WebhookSink,
+            'desktop': DesktopSink,
+            }
+    arr_sink = []
+    for name in arr_name:
+        if name not in info_sink:
+            logger.error(f'通知方式{name}不存在')
+            continue
+        if name == 'audio' and func_audio is None:
+            continue
+        try:
+            arr_sink.append(info_sink[name]())
+        except ValueError as e:
+            logger.error(f'{e}')
+    logger.info(f'通知方式: {[obj_sink.name for obj_sink in arr_sink]}')
+    return NotifyDispatcher(arr_sink)
@@ -0,0 +1,276 @@
+# -*- encoding: utf-8 -*-
+''' 报警插件的执行预算
+每个报警程序的分组(key，执行计划的runner_key: (algorithm, kwargs[, universe]))一个工作线程，
+报警程序在工作线程中执行，主线程等待到截止时间:
+    截止时间 = 本次运行的开始时间 + 插件的预算(秒)
+        插件模块的n_budget_seconds，缺省为settings.n_plugin_budget_seconds
+超时:
+    还没有开始的任务取消，正在运行的任务，结果丢弃(线程无法强制结束)；
+    任务不修改运行状态，返回值被接受后由调用者更新(ExecutionPlan.run())，丢弃的结果不影响运行状态；
+    上一次超时的任务还没有结束时，跳过本次运行，同一个分组不会同时运行；
+    跳过也计为超时(连续超时的次数增加)，卡住的插件达到次数后隔离。
+隔离:
+    连续超时settings.n_plugin_overrun_max次，分组被隔离(不再运行)，记录错误日志；
+    插件重新加载(plugin_registry)或release()后，解除该插件所有分组的隔离。
+统计:
+    get_stats()，每个分组的运行次数、超时次数、运行时间的p50/p99(毫秒)，
+    包含正在运行的任务已经运行的时间(running_ms)。
+'''
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import numpy as np
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def get_algorithm(key):
+    ''' 分组的插件名称 '''
+    if isinstance(key, tuple):
+        return key[0]
+    return key
+
+
+def get_name(key):
+    ''' 分组的名称 (日志、统计)，例如: 'macd_cross {"period_long": "30m"}' '''
+    if not isinstance(key, tuple):
+        return key
+    return ' '.join(str(item) for item in key if item not in (None, 'null'))
+
+
+class PluginBudget:
+    ''' 单个分组的执行预算 '''
+    # 分组 (runner_key)
+    key = None
+    # 插件名称
+    algorithm = None
+    # 分组的名称
+    name = None
+    # 工作线程
+    executor = None
+    # 本次运行提交的任务
+    arr_future = None
+    # 最近的运行时间(秒)
+    arr_runtime = None
+    # 正在运行的任务的开始时间(time.perf_counter())，None: 没有运行
+    t_begin_running = None
+    # 统计: 运行、超时、错误、跳过的次数
+    n_run = None
+    n_overrun = None
+    n_error = None
+    n_skip = None
+    # 连续超时的次数
+    n_overrun_continuous = None
+    # 隔离标志
+    flag_quarantine = None
+    # 线程锁
+    lock = None
+
+    def __init__(self, key):
+        self.key = key
+        self.algorithm = get_algorithm(key)
+        self.name = get_name(key)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f'plugin_{self.algorithm}',
+                )
+        self.arr_future = []
+        self.arr_runtime = collections.deque(maxlen=1000)
+        self.n_run = self.n_overrun = self.n_error = self.n_skip = 0
+        self.n_overrun_continuous = 0
+        self.flag_quarantine = False
+        self.lock = threading.Lock()
+
+    def is_busy(self):
+        ''' 上一次超时的任务还没有结束 '''
+        self.arr_future = [
+                future for future in self.arr_future if not future.done()
+                ]
+        return bool(self.arr_future)
+
+    def submit(self, func, *args):
+        ''' 提交任务
+            返回值: Future or None(隔离、上一次的任务还没有结束)
+        '''
+        if self.flag_quarantine:
+            return None
+        future = self.executor.submit(self.run_timed, func, *args)
+        self.arr_future.append(future)
+        return future
+
+    def run_timed(self, func, *args):
+        ''' 工作线程: 执行任务，记录运行时间 '''
+        t_begin = time.perf_counter()
+        with self.lock:
+            self.t_begin_running = t_begin
+        try:
+            return func(*args)
+        finally:
+            with self.lock:
+                self.arr_runtime.append(time.perf_counter() - t_begin)
+                self.n_run += 1
+                self.t_begin_running = None
+
+    def get_running_time(self):
+        ''' 正在运行的任务已经运行的时间(秒)，None: 没有运行 '''
+        with self.lock:
+            if self.t_begin_running is None:
+                return None
+            return time.perf_counter() - self.t_begin_running
+
+    def on_skip(self):
+        ''' 上一次超时的任务还没有结束，跳过本次运行: 计为连续超时 '''
+        self.n_skip += 1
+        n_running = self.get_running_time()
+        if n_running is not None:
+            logger.warning(f'插件{self.name}上一次的任务还没有结束(已运行{n_running:.1f}秒)，跳过')
+        self.on_overrun()
+
+    def wait(self, future, t_deadline):
+        ''' 等待任务结束，最多到截止时间
+            返回值: 任务的返回值，超时、错误: None
+        '''
+        if future is None:
+            return None
+        try:
+            ret = future.result(timeout=max(0.0, t_deadline - time.time()))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.on_overrun()
+            return None
+        except concurrent.futures.CancelledError:
+            return None
+        except Exception as e:
+            self.n_error += 1
+            logger.exception(f'插件{self.name}运行错误: {e!r}')
+            return None
+        self.n_overrun_continuous = 0
+        return ret
+
+    def on_overrun(self):
+        ''' 超时: 计数，连续超时时隔离 '''
+        self.n_overrun += 1
+        self.n_overrun_continuous += 1
+        logger.warning(f'插件{self.name}超时, 连续{self.n_overrun_continuous}次')
+        if settings.n_plugin_overrun_max <= self.n_overrun_continuous:
+            self.flag_quarantine = True
+            logger.error(f'插件{self.name}连续{self.n_overrun_continuous}次超时，已隔离')
+
+    def release(self):
+        ''' 解除隔离 '''
+        if self.flag_quarantine:
+            logger.info(f'插件{self.name}解除隔离')
+        self.flag_quarantine = False
+        self.n_overrun_continuous = 0
+
+    def get_stats(self):
+        ''' 统计信息，运行时间的单位: 毫秒 '''
+        n_running = self.get_running_time()
+        with self.lock:
+            arr_runtime = list(self.arr_runtime)
+        if n_running is not None:
+            # 正在运行的任务(可能已经卡住)，计入运行时间
+            arr_runtime.append(n_running)
+        arr = np.array(arr_runtime) * 1000
+        info = {
+                'n_run': self.n_run,
+                'n_overrun': self.n_overrun,
+                'n_error': self.n_error,
+                'n_skip': self.n_skip,
+                'quarantine': self.flag_quarantine,
+                'running_ms': None if n_running is None else n_running * 1000,
+                'p50_ms': None,
+                'p99_ms': None,
+                'max_ms': None,
+                }
+        if arr.size:
+            info['p50_ms'] = float(np.percentile(arr, 50))
+            info['p99_ms'] = float(np.percentile(arr, 99))
+            info['max_ms'] = float(arr.max())
+        return info
+
+
+class PluginSupervisor:
+    ''' 所有分组的执行预算 '''
+    # key ---> PluginBudget()
+    info_budget = None
+    # 线程锁
+    lock = None
+
+    def __init__(self):
+        self.info_budget = {}
+        self.lock = threading.Lock()
+
+    def get_budget(self, key):
+        ''' 分组的执行预算 (第一次使用时创建) '''
+        with self.lock:
+            obj = self.info_budget.get(key)
+            if obj is None:
+                obj = PluginBudget(key)
+                self.info_budget[key] = obj
+            return obj
+
+    def run(self, arr_task, budget_seconds=None):
+        ''' 执行一次(一个tick)的所有任务
+        入口参数:
+            arr_task        [(key, n_budget_seconds, func, args), ...]
+                            key为分组(runner_key)，n_budget_seconds为None时，使用budget_seconds
+            budget_seconds  缺省的预算，None: settings.n_plugin_budget_seconds
+        返回值: [返回值, ...]，与arr_task对应，超时、错误、跳过: None
+        '''
+        if budget_seconds is None:
+            budget_seconds = settings.n_plugin_budget_seconds
+        t_begin = time.time()
+        # 上一次超时的任务还没有结束，跳过本次运行
+        set_busy = set()
+        for key in {task[0] for task in arr_task}:
+            obj = self.get_budget(key)
+            if obj.flag_quarantine:
+                # 已隔离，submit()不执行
+                continue
+            if obj.is_busy():
+                set_busy.add(key)
+                obj.on_skip()
+        arr_future = []
+        for key, n_budget_seconds, func, args in arr_task:
+            future = None
+            if key not in set_busy:
+                future = self.get_budget(key).submit(func, *args)
+            if n_budget_seconds is None:
+                n_budget_seconds = budget_seconds
+            arr_future.append((key, future, t_begin + n_budget_seconds))
+        return [
+                self.get_budget(key).wait(future, t_deadline)
+                for key, future, t_deadline in arr_future
+                ]
+
+    def release(self, algorithm):
+        ''' 解除插件(所有分组)的隔离 '''
+        with self.lock:
+            arr = [
+                    obj for key, obj in self.info_budget.items()
+                    if get_algorithm(key) == algorithm
+                    ]
+        for obj in arr:
+            obj.release()
+
+    def get_stats(self):
+        ''' 所有分组的统计信息: 分组的名称 ---> dict '''
+        with self.lock:
+            arr = list(self.info_budget.values())
+        return {obj.name: obj.get_stats() for obj in arr}
+
+
+# 所有报警程序共用
+obj_supervisor = PluginSupervisor()
+
+
+def get_stats():
+    ''' 所有插件的统计信息 '''
+    return obj_supervisor.get_stats()
@@ -0,0 +1,154 @@
+# -*- encoding: utf-8 -*-
+''' 报警插件的注册表
+每个插件模块只加载一次，所有报警程序共用:
+    >>> import plugin_registry
+    >>> obj_module = plugin_registry.get_module('macd_cross')
+热更新:
+    check_reload()检查插件文件(settings.dir_plugin目录)的修改时间，
+    变化时重新加载，加载成功后替换注册表中的模块；加载失败时，继续使用原来的模块。
+    插件引用的辅助模块(例如: plugins.kernel)变化时，重新加载所有插件。
+    由KlineInfo.run_cron()在两次运行之间调用，k线数据保持不变。
+'''
+
+import importlib
+import importlib.util
+import os
+import sys
+import threading
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+
+def get_mtime(f_name):
+    ''' 文件的修改时间，文件不存在: None '''
+    try:
+        return os.stat(f_name).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+class PluginRegistry:
+    ''' 报警插件的注册表 '''
+    # 插件的包名
+    package = None
+    # 插件模块, algorithm ---> (module, 文件名, 修改时间)
+    info_module = None
+    # 辅助模块的修改时间, module_name ---> 修改时间
+    info_helper = None
+    # 插件的版本(重新加载的次数), algorithm ---> int
+    info_version = None
+    # 线程锁
+    lock = None
+
+    def __init__(self, package=settings.dir_plugin):
+        self.package = package
+        self.info_module = {}
+        self.info_helper = {}
+        self.info_version = {}
+        self.lock = threading.RLock()
+
+    def load(self, algorithm):
+        ''' 加载插件模块 (不修改注册表)
+            返回值: (module, 文件名) or ValueError
+        '''
+        module_name = f'{self.package}.{algorithm}'
+        spec = importlib.util.find_spec(module_name)
+        if spec is None:
+            raise ValueError(f'报警程序{module_name}不存在')
+        obj_module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(obj_module)
+        except Exception as e:
+            raise ValueError(f'报警程序{module_name}加载失败: {e!r}')
+        return obj_module, spec.origin
+
+    def get_module(self, algorithm):
+        ''' 读取插件模块，第一次读取时加载
+            返回值: module or ValueError
+        '''
+        with self.lock:
+            item = self.info_module.get(algorithm)
+            if item is None:
+                obj_module, f_name = self.load(algorithm)
+                item = (obj_module, f_name, get_mtime(f_name))
+                self.info_module[algorithm] = item
+                self.info_version.setdefault(algorithm, 0)
+                self.scan_helper()
+                logger.info(f'加载报警插件: {algorithm}, {f_name}')
+            return item[0]
+
+    def get_version(self, algorithm):
+        ''' 插件的版本 (重新加载的次数) '''
+        return self.info_version.get(algorithm, 0)
+
+    def scan_helper(self):
+        ''' 记录辅助模块的修改时间
+            返回值: 修改时间变化的辅助模块 [module_name, ...]
+        '''
+        prefix = f'{self.package}.'
+        arr_changed = []
+        for module_name, obj_module in list(sys.modules.items()):
+            if not module_name.startswith(prefix):
+                continue
+            mtime = get_mtime(getattr(obj_module, '__file__', None))
+            mtime_old = self.info_helper.get(module_name)
+            if mtime_old is not None and mtime_old != mtime:
+                arr_changed.append(module_name)
+            self.info_helper[module_name] = mtime
+        return arr_changed
+
+    def check_reload(self):
+        ''' 检查插件文件的修改时间，变化时重新加载
+            返回值: 重新加载的插件 [algorithm, ...]
+        '''
+        with self.lock:
+            arr_algorithm = [
+                    algorithm
+                    for algorithm, (_, f_name, mtime) in self.info_module.items()
+                    if get_mtime(f_name) != mtime
+                    ]
+            arr_helper = self.scan_helper()
+            for module_name in arr_helper:
+                try:
+                    importlib.reload(sys.modules[module_name])
+                except Exception as e:
+                    logger.error(f'辅助模块{module_name}重新加载失败: {e!r}')
+                    continue
+                logger.info(f'辅助模块重新加载: {module_name}')
+                # 插件引用了原来的辅助模块，全部重新加载
+                arr_algorithm = list(self.info_module)
+            arr_reload = []
+            for algorithm in arr_algorithm:
+                f_name = self.info_module[algorithm][1]
+                mtime = get_mtime(f_name)
+                try:
+                    obj_module, f_name = self.load(algorithm)
+                except ValueError as e:
+                    logger.error(f'{e}, 继续使用原来的模块')
+                    # 文件修改前，不再重复加载
+                    obj_module_old = self.info_module[algorithm][0]
+                    self.info_module[algorithm] = (obj_module_old, f_name, mtime)
+                    continue
+                self.info_module[algorithm] = (obj_module, f_name, mtime)
+                self.info_version[algorithm] = self.get_version(algorithm) + 1
+                arr_reload.append(algorithm)
+                logger.info(f'报警插件重新加载: {algorithm}, 版本: {self.info_version[algorithm]}')
+            return arr_reload
+
+
+# 所有报警程序共用的注册表
+obj_registry = PluginRegistry()
+
+
+def get_module(algorithm):
+    ''' 读取插件模块 '''
+    return obj_registry.get_module(algorithm)
+
+
+def check_reload():
+    ''' 检查插件文件的修改时间，变化时重新加载 '''
+    return obj_registry.check_reload()
@@ -0,0 +1,666 @@
+# -*- encoding: utf-8 -*-
+''' 技术指标的计算核心 (报警插件共用，本身不是报警程序)
+批量计算: (函数，与talib的结果一致，误差在浮点数精度之内)
+    ema, sma, macd, rsi, kdj, bbands, atr
+    入口参数为1维数组(单个股票)，或者2维数组(股票 x k线，每行一个股票)。
+    nan表示没有k线(停牌等)，计算时跳过，对应的结果为nan。
+增量计算: (类，每个k线O(1))
+    EMA, SMA, MACD, RSI, KDJ, BBANDS, ATR
+    seed()      用历史数据初始化状态，返回历史数据的批量计算结果
+    update()    新的k线，更新状态，返回新的指标值
+    get_state() / set_state()       指标的状态 (dict，可以保存)
+例子:
+    >>> from plugins import kernel
+    >>> obj = kernel.MACD(12, 26, 9)
+    >>> diff, dea, bar = obj.seed(df.close.values)
+    >>> diff_1, dea_1, bar_1 = obj.update(close_new)
+注意:
+    talib.MACD(price, 26, 12, 9)，快慢周期颠倒时自动交换，这里同样处理。
+    KDJ为国内常用的算法(K、D的初始值为50)，talib中没有对应的指标。
+'''
+
+import math
+
+from abc import ABC, abstractmethod
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+nan = float('nan')
+
+
+def as_2d(arr):
+    ''' 转为2维数组 (股票 x k线)
+    返回值: (arr_2d, flag_1d)
+    '''
+    arr = np.asarray(arr, dtype=np.float64)
+    if arr.ndim == 1:
+        return arr[None, :], True
+    return arr, False
+
+
+def as_result(arr, flag_1d):
+    ''' 还原为入口参数的维数 '''
+    return arr[0] if flag_1d else arr
+
+
+def calc_ema(arr, n, alpha=None, seed_count=None):
+    ''' 指数移动平均 (2维数组，跳过nan)
+        arr             2维数组
+        n               周期
+        alpha           平滑系数，None: 2 / (n + 1)
+        seed_count      第seed_count个有效值处开始计算，None: n
+            初始值为该处之前(包含)n个有效值的简单平均。
+    '''
+    if alpha is None:
+        alpha = 2.0 / (n + 1)
+    if seed_count is None:
+        seed_count = n
+    out = np.full(arr.shape, nan)
+    if arr.shape[1] == 0:
+        return out
+    valid = ~np.isnan(arr)
+    cnt = np.cumsum(valid, axis=1)
+    rows = np.flatnonzero(seed_count <= cnt[:, -1])
+    if not rows.size:
+        return out
+    csum = np.cumsum(np.where(valid, arr, 0.0), axis=1)[rows]
+    cnt = cnt[rows]
+    pos = np.argmax(seed_count <= cnt, axis=1)
+    i_row = np.arange(rows.size)
+    seed = csum[i_row, pos]
+    if n < seed_count:
+        pos_before = np.argmax(seed_count - n <= cnt, axis=1)
+        seed = seed - csum[i_row, pos_before]
+    seed = seed / n
+    before = np.arange(arr.shape[1])[None, :] < pos[:, None]
+    y = arr[rows].copy()
+    y[before] = nan
+    y[i_row, pos] = seed
+    res = np.array(pd.DataFrame(y.T).ewm(
+            alpha=alpha, adjust=False, ignore_na=True
+            ).mean().values.T)
+    res[before | ~valid[rows]] = nan
+    out[rows] = res
+    return out
+
+
+def calc_sma_cn(arr, m, init=50.0):
+    ''' 国内的SMA(X, M, 1): Y = (X + (M - 1) * Y') / M，Y的初始值为init
+        arr         2维数组，跳过nan
+    '''
+    y = np.hstack([np.full((arr.shape[0], 1), init), arr])
+    res = np.array(pd.DataFrame(y.T).ewm(
+            alpha=1.0 / m, adjust=False, ignore_na=True
+            ).mean().values.T[:, 1:])
+    res[np.isnan(arr)] = nan
+    return res
+
+
+def calc_rolling(arr, n, func_name, **kwargs):
+    ''' 滚动窗口 (2维数组，窗口只包含有效值)
+        func_name       pandas.Rolling的函数名: 'mean', 'std', 'max', 'min'
+    '''
+    valid = ~np.isnan(arr)
+    if valid.all():
+        df = pd.DataFrame(arr.T).rolling(n)
+        return np.array(getattr(df, func_name)(**kwargs).values.T)
+    out = np.full(arr.shape, nan)
+    for i in range(arr.shape[0]):
+        v = arr[i, valid[i]]
+        if n <= v.size:
+            obj = pd.Series(v).rolling(n)
+            out[i, valid[i]] = getattr(obj, func_name)(**kwargs).values
+    return out
+
+
+def calc_prev(arr):
+    ''' 每个k线的上一个有效值 '''
+    prev = np.full(arr.shape, nan)
+    prev[:, 1:] = pd.DataFrame(arr.T).ffill().values.T[:, :-1]
+    return prev
+
+
+def ema(arr, n=30):
+    ''' 指数移动平均，同 talib.EMA() '''
+    arr, flag_1d = as_2d(arr)
+    return as_result(calc_ema(arr, n), flag_1d)
+
+
+def sma(arr, n=30):
+    ''' 简单移动平均，同 talib.SMA() '''
+    arr, flag_1d = as_2d(arr)
+    return as_result(calc_rolling(arr, n, 'mean'), flag_1d)
+
+
+def calc_macd(arr, fast=12, slow=26, signal=9):
+    ''' macd的中间结果 (2维数组)
+    返回值: (ema_fast, ema_slow, diff, dea)
+        diff、dea       与talib相同，只保留dea有效的部分
+    '''
+    if slow < fast:
+        fast, slow = slow, fast
+    ema_slow = calc_ema(arr, slow)
+    # 快线与慢线在同一个k线处开始计算
+    ema_fast = calc_ema(arr, fast, seed_count=slow)
+    diff = ema_fast - ema_slow
+    dea = calc_ema(diff, signal)
+    return ema_fast, ema_slow, diff, dea
+
+
+def macd(arr, fast=12, slow=26, signal=9):
+    ''' macd，同 talib.MACD()
+    返回值: (diff, dea, bar)
+    '''
+    arr, flag_1d = as_2d(arr)
+    _, _, diff, dea = calc_macd(arr, fast, slow, signal)
+    diff = np.where(np.isnan(dea), nan, diff)
+    bar = diff - dea
+    return tuple(as_result(o, flag_1d) for o in (diff, dea, bar))
+
+
+def calc_rsi(arr, n=14):
+    ''' rsi的中间结果 (2维数组)
+    返回值: (avg_gain, avg_loss, rsi)
+    '''
+    delta = arr - calc_prev(arr)
+    gain = np.where(np.isnan(delta), nan, np.maximum(delta, 0.0))
+    loss = np.where(np.isnan(delta), nan, np.maximum(-delta, 0.0))
+    avg_gain = calc_ema(gain, n, alpha=1.0 / n)
+    avg_loss = calc_ema(loss, n, alpha=1.0 / n)
+    total = avg_gain + avg_loss
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = np.where(0 < total, 100.0 * avg_gain / total, 0.0)
+    out[np.isnan(total)] = nan
+    return avg_gain, avg_loss, out
+
+
+def rsi(arr, n=14):
+    ''' 相对强弱指标，同 talib.RSI() '''
+    arr, flag_1d = as_2d(arr)
+    return as_result(calc_rsi(arr, n)[2], flag_1d)
+
+
+def calc_true_range(high, low, close):
+    ''' 真实波幅 (2维数组)，第一个有效k线为nan '''
+    prev = calc_prev(close)
+    tr = np.fmax(high - low, np.fmax(np.abs(high - prev), np.abs(low - prev)))
+    tr[np.isnan(prev) | np.isnan(close)] = nan
+    return tr
+
+
+def atr(high, low, close, n=14):
+    ''' 平均真实波幅，同 talib.ATR() '''
+    high, flag_1d = as_2d(high)
+    low, _ = as_2d(low)
+    close, _ = as_2d(close)
+    tr = calc_true_range(high, low, close)
+    return as_result(calc_ema(tr, n, alpha=1.0 / n), flag_1d)
+
+
+def bbands(arr, n=5, nbdevup=2.0, nbdevdn=2.0):
+    ''' 布林带，同 talib.BBANDS(matype=0)
+    返回值: (upper, middle, lower)
+    '''
+    arr, flag_1d = as_2d(arr)
+    middle = calc_rolling(arr, n, 'mean')
+    std = calc_rolling(arr, n, 'std', ddof=0)
+    upper = middle + nbdevup * std
+    lower = middle - nbdevdn * std
+    return tuple(as_result(o, flag_1d) for o in (upper, middle, lower))
+
+
+def calc_rsv(high, low, close, n=9):
+    ''' 未成熟随机值 (2维数组)
+        最高价 == 最低价时，RSV = 50
+    '''
+    valid = ~(np.isnan(high) | np.isnan(low) | np.isnan(close))
+    high = np.where(valid, high, nan)
+    low = np.where(valid, low, nan)
+    hh = calc_rolling(high, n, 'max')
+    ll = calc_rolling(low, n, 'min')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rsv = np.where(hh == ll, 50.0, (close - ll) / (hh - ll) * 100.0)
+    rsv[np.isnan(hh)] = nan
+    return rsv
+
+
+def kdj(high, low, close, n=9, m1=3, m2=3):
+    ''' KDJ (国内的算法，K、D的初始值为50)
+    返回值: (k, d, j)
+    '''
+    high, flag_1d = as_2d(high)
+    low, _ = as_2d(low)
+    close, _ = as_2d(close)
+    rsv = calc_rsv(high, low, close, n)
+    k = calc_sma_cn(rsv, m1)
+    d = calc_sma_cn(k, m2)
+    j = 3.0 * k - 2.0 * d
+    return tuple(as_result(o, flag_1d) for o in (k, d, j))
+
+
+def last_valid(arr):
+    ''' 最后一个有效值，没有时为nan '''
+    arr = arr[~np.isnan(arr)]
+    return float(arr[-1]) if arr.size else nan
+
+
+class Kernel(ABC):
+    ''' 增量计算的指标 '''
+    # 状态的属性名
+    arr_state = ()
+
+    def reset(self):
+        ''' 清空状态 '''
+        pass
+
+    @abstractmethod
+    def seed(self, *arr):
+        ''' 用历史数据初始化状态
+        返回值:
+            历史数据的批量计算结果
+        '''
+        pass
+
+    @abstractmethod
+    def update(self, *value):
+        ''' 新的k线，更新状态
+        返回值:
+            新的指标值
+        '''
+        pass
+
+    def seed_by_update(self, *arr):
+        ''' 历史数据较短时(预热期内)，逐个k线更新状态 '''
+        self.reset()
+        for value in zip(*arr):
+            self.update(*value)
+
+    def get_state(self):
+        ''' 指标的状态 (dict) '''
+        info = {}
+        for name in self.arr_state:
+            value = getattr(self, name)
+            if isinstance(value, Kernel):
+                value = value.get_state()
+            elif isinstance(value, deque):
+                value = list(value)
+            info[name] = value
+        return info
+
+    def set_state(self, info):
+        ''' 恢复指标的状态 '''
+        for name in self.arr_state:
+            value = getattr(self, name)
+            if isinstance(value, Kernel):
+                value.set_state(info[name])
+            elif isinstance(value, deque):
+                setattr(self, name, deque(info[name], maxlen=value.maxlen))
+            else:
+                setattr(self, name, info[name])
+
+
+def valid_values(*arr):
+    ''' 去除nan (多个数组的同一位置有nan时，全部去除) '''
+    arr = [np.asarray(o, dtype=np.float64) for o in arr]
+    valid = np.ones(arr[0].shape, dtype=bool)
+    for o in arr:
+        valid &= ~np.isnan(o)
+    return [o[valid] for o in arr]
+
+
+def is_nan(*value):
+    ''' 入口参数中有nan '''
+    return any(math.isnan(v) for v in value)
+
+
+class EMA(Kernel):
+    ''' 指数移动平均 '''
+    arr_state = ('count', 'total', 'value')
+
+    def __init__(self, n=30, alpha=None):
+        self.n = n
+        self.alpha = 2.0 / (n + 1) if alpha is None else alpha
+        self.reset()
+
+    def reset(self):
+        # 有效值的数量
+        self.count = 0
+        # 预热期内，有效值的和
+        self.total = 0.0
+        self.value = nan
+
+    def seed(self, arr):
+        out = as_result(calc_ema(as_2d(arr)[0], self.n, self.alpha), True)
+        (valid,) = valid_values(arr)
+        if valid.size <= self.n:
+            self.seed_by_update(valid)
+        else:
+            self.count = valid.size
+            self.value = last_valid(out)
+        return out
+
+    def update(self, x):
+        if is_nan(x):
+            return nan
+        self.count += 1
+        if self.count < self.n:
+            self.total += x
+            return nan
+        if self.count == self.n:
+            self.value = (self.total + x) / self.n
+        else:
+            self.value += self.alpha * (x - self.value)
+        return self.value
+
+
+class SMA(Kernel):
+    ''' 简单移动平均 (滑动窗口的和) '''
+    arr_state = ('window', 'total')
+    # 每更新n_refresh次，重新求和，防止累计误差
+    n_refresh = 10000
+
+    def __init__(self, n=30):
+        self.n = n
+        self.reset()
+
+    def reset(self):
+        self.window = deque(maxlen=self.n)
+        self.total = 0.0
+        self.n_update = 0
+
+    def seed(self, arr):
+        out = sma(arr, self.n)
+        (valid,) = valid_values(arr)
+        self.reset()
+        self.window.extend(valid[-self.n:].tolist())
+        self.total = math.fsum(self.window)
+        return out
+
+    def push(self, x):
+        ''' 滑动窗口增加一个值 '''
+        if len(self.window) == self.n:
+            self.total -= self.window[0]
+        self.window.append(x)
+        self.total += x
+        self.n_update += 1
+        if self.n_refresh <= self.n_update:
+            self.total = math.fsum(self.window)
+            self.n_update = 0
+
+    def update(self, x):
+        if is_nan(x):
+            return nan
+        self.push(x)
+        if len(self.window) < self.n:
+            return nan
+        return self.total / self.n
+
+
+class MACD(Kernel):
+    ''' macd (同talib: 快线与慢线在同一个k线处开始计算) '''
+    arr_state = ('window', 'ema_fast', 'ema_slow', 'ema_signal')
+
+    def __init__(self, fast=12, slow=26, signal=9):
+        if slow < fast:
+            fast, slow = slow, fast
+        self.fast, self.slow, self.signal = fast, slow, signal
+        self.ema_fast = EMA(fast)
+        self.ema_slow = EMA(slow)
+        self.ema_signal = EMA(signal)
+        self.reset()
+
+    def reset(self):
+        # 慢线开始计算之前，最近fast个值
+        self.window = deque(maxlen=self.fast)
+        self.ema_fast.reset()
+        self.ema_slow.reset()
+        self.ema_signal.reset()
+
+    def seed(self, arr):
+        arr_2d, _ = as_2d(arr)
+        ema_fast, ema_slow, diff, dea = calc_macd(
+                arr_2d, self.fast, self.slow, self.signal
+                )
+        (valid,) = valid_values(arr)
+        if valid.size <= self.slow + self.signal:
+            self.seed_by_update(valid)
+        else:
+            self.reset()
+            self.window.extend(valid[:self.slow][-self.fast:].tolist())
+            self.ema_fast.count = self.ema_slow.count = valid.size
+            self.ema_fast.value = last_valid(ema_fast[0])
+            self.ema_slow.value = last_valid(ema_slow[0])
+            self.ema_signal.count = valid.size - self.slow + 1
+            self.ema_signal.value = last_valid(dea[0])
+        diff = np.where(np.isnan(dea), nan, diff)
+        return diff[0], dea[0], diff[0] - dea[0]
+
+    def update(self, x):
+        if is_nan(x):
+            return (nan, nan, nan)
+        slow = self.ema_slow.update(x)
+        if self.ema_slow.count < self.slow:
+            self.window.append(x)
+            return (nan, nan, nan)
+        if self.ema_slow.count == self.slow:
+            self.window.append(x)
+            self.ema_fast.count = self.fast
+            self.ema_fast.value = math.fsum(self.window) / self.fast
+            fast = self.ema_fast.value
+        else:
+            fast = self.ema_fast.update(x)
+        diff = fast - slow
+        dea = self.ema_signal.update(diff)
+        if math.isnan(dea):
+            return (nan, nan, nan)
+        return (diff, dea, diff - dea)
+
+
+class RSI(Kernel):
+    ''' 相对强弱指标 (Wilder平滑) '''
+    arr_state = ('prev', 'ema_gain', 'ema_loss')
+
+    def __init__(self, n=14):
+        self.n = n
+        self.ema_gain = EMA(n, alpha=1.0 / n)
+        self.ema_loss = EMA(n, alpha=1.0 / n)
+        self.reset()
+
+    def reset(self):
+        self.prev = nan
+        self.ema_gain.reset()
+        self.ema_loss.reset()
+
+    def seed(self, arr):
+        arr_2d, _ = as_2d(arr)
+        avg_gain, avg_loss, out = calc_rsi(arr_2d, self.n)
+        (valid,) = valid_values(arr)
+        if valid.size <= self.n + 1:
+            self.seed_by_update(valid)
+        else:
+            self.prev = float(valid[-1])
+            self.ema_gain.count = self.ema_loss.count = valid.size - 1
+            self.ema_gain.value = last_valid(avg_gain[0])
+            self.ema_loss.value = last_valid(avg_loss[0])
+        return out[0]
+
+    def update(self, x):
+        if is_nan(x):
+            return nan
+        prev, self.prev = self.prev, x
+        if math.isnan(prev):
+            return nan
+        delta = x - prev
+        gain = self.ema_gain.update(max(delta, 0.0))
+        loss = self.ema_loss.update(max(-delta, 0.0))
+        if math.isnan(gain):
+            return nan
+        total = gain + loss
+        return 100.0 * gain / total if 0 < total else 0.0
+
+
+class MonotonicWindow(Kernel):
+    ''' 滑动窗口的最大值(or最小值)，单调队列，每次更新平均O(1) '''
+    arr_state = ('queue', 'count')
+
+    def __init__(self, n, flag_max=True):
+        self.n = n
+        self.flag_max = flag_max
+        self.reset()
+
+    def reset(self):
+        # [(序号, 值), ...]
+        self.queue = deque()
+        self.count = 0
+
+    def seed(self, arr):
+        self.reset()
+        return np.array([self.update(float(x)) for x in arr])
+
+    def update(self, x):
+        queue = self.queue
+        if self.flag_max:
+            while queue and queue[-1][1] <= x:
+                queue.pop()
+        else:
+            while queue and x <= queue[-1][1]:
+                queue.pop()
+        queue.append((self.count, x))
+        if queue[0][0] <= self.count - self.n:
+            queue.popleft()
+        self.count += 1
+        return queue[0][1]
+
+    def set_state(self, info):
+        self.queue = deque(tuple(o) for o in info['queue'])
+        self.count = info['count']
+
+
+class KDJ(Kernel):
+    ''' KDJ (国内的算法，K、D的初始值为50) '''
+    arr_state = ('window_high', 'window_low', 'count', 'k', 'd')
+
+    def __init__(self, n=9, m1=3, m2=3):
+        self.n, self.m1, self.m2 = n, m1, m2
+        self.window_high = MonotonicWindow(n, True)
+        self.window_low = MonotonicWindow(n, False)
+        self.reset()
+
+    def reset(self):
+        self.window_high.reset()
+        self.window_low.reset()
+        self.count = 0
+        self.k = self.d = 50.0
+
+    def seed(self, high, low, close):
+        k, d, j = kdj(high, low, close, self.n, self.m1, self.m2)
+        high, low, close = valid_values(high, low, close)
+        self.reset()
+        for h, l in zip(high[-self.n:], low[-self.n:]):
+            self.window_high.update(float(h))
+            self.window_low.update(float(l))
+        self.count = high.size
+        if self.n <= high.size:
+            self.k, self.d = last_valid(k), last_valid(d)
+        return k, d, j
+
+    def update(self, high, low, close):
+        if is_nan(high, low, close):
+            return (nan, nan, nan)
+        hh = self.window_high.update(high)
+        ll = self.window_low.update(low)
+        self.count += 1
+        if self.count < self.n:
+            return (nan, nan, nan)
+        rsv = 50.0 if hh == ll else (close - ll) / (hh - ll) * 100.0
+        self.k = (rsv + (self.m1 - 1) * self.k) / self.m1
+        self.d = (self.k + (self.m2 - 1) * self.d) / self.m2
+        return (self.k, self.d, 3.0 * self.k - 2.0 * self.d)
+
+
+class BBANDS(Kernel):
+    ''' 布林带 (滑动窗口的和、平方和) '''
+    arr_state = ('window', 'total', 'total_sq')
+    # 每更新n_refresh次，重新求和，防止累计误差
+    n_refresh = 10000
+
+    def __init__(self, n=5, nbdevup=2.0, nbdevdn=2.0):
+        self.n, self.nbdevup, self.nbdevdn = n, nbdevup, nbdevdn
+        self.reset()
+
+    def reset(self):
+        self.window = deque(maxlen=self.n)
+        self.total = self.total_sq = 0.0
+        self.n_update = 0
+
+    def refresh(self):
+        ''' 重新求和 '''
+        self.total = math.fsum(self.window)
+        self.total_sq = math.fsum(x * x for x in self.window)
+        self.n_update = 0
+
+    def seed(self, arr):
+        out = bbands(arr, self.n, self.nbdevup, self.nbdevdn)
+        (valid,) = valid_values(arr)
+        self.reset()
+        self.window.extend(valid[-self.n:].tolist())
+        self.refresh()
+        return out
+
+    def update(self, x):
+        if is_nan(x):
+            return (nan, nan, nan)
+        if len(self.window) == self.n:
+            old = self.window[0]
+            self.total -= old
+            self.total_sq -= old * old
+        self.window.append(x)
+        self.total += x
+        self.total_sq += x * x
+        self.n_update += 1
+        if self.n_refresh <= self.n_update:
+            self.refresh()
+        if len(self.window) < self.n:
+            return (nan, nan, nan)
+        middle = self.total / self.n
+        std = math.sqrt(max(self.total_sq / self.n - middle * middle, 0.0))
+        return (
+                middle + self.nbdevup * std, middle,
+                middle - self.nbdevdn * std,
+                )
+
+
+class ATR(Kernel):
+    ''' 平均真实波幅 (Wilder平滑) '''
+    arr_state = ('prev_close', 'ema_tr')
+
+    def __init__(self, n=14):
+        self.n = n
+        self.ema_tr = EMA(n, alpha=1.0 / n)
+        self.reset()
+
+    def reset(self):
+        self.prev_close = nan
+        self.ema_tr.reset()
+
+    def seed(self, high, low, close):
+        out = atr(high, low, close, self.n)
+        high, low, close = valid_values(high, low, close)
+        if high.size <= self.n + 1:
+            self.seed_by_update(high, low, close)
+        else:
+            self.prev_close = float(close[-1])
+            self.ema_tr.count = high.size - 1
+            self.ema_tr.value = last_valid(out)
+        return out
+
+    def update(self, high, low, close):
+        if is_nan(high, low, close):
+            return nan
+        prev, self.prev_close = self.prev_close, close
+        if math.isnan(prev):
+            return nan
+        tr = max(high - low, abs(high - prev), abs(low - prev))
+        return self.ema_tr.update(tr)
@@ -1,14 +1,26 @@
 # -*- encoding: utf-8 -*-
 ''' 报警条件：macd的diff和dea交叉 
 算法使用多个k线周期: 
-    other_kwargs is None 为 False，忽略 period。
+    other_kwargs['period_long']: 长周期
+        长周期的0 < diff，短周期(period)的diff上穿dea
+        长周期的diff < 0，短周期(period)的diff下穿dea
 算法使用单个k线周期:
     other_kwargs is None 为 True，使用 period。
+批量接口: alarm_algorithm_batch()，n个股票一次计算。
+    macd按股票缓存(indicator_cache.get_indicator_batch())，参数不同的报警程序共用，
+    只计算缓存中不存在的股票。
 '''
 
+import numpy as np
 import pandas as pd
 import talib
 
+import indicator_cache
+from . import kernel
+
+# 预热需要的k线数量(每个k线周期): macd(26, 12, 9)的ema已经收敛，与批量接口的k线数量相同
+n_lookback = 1000
+
 
 class MacdCross:
     ''' 报警条件：macd的diff和dea交叉 '''
@@ -19,6 +31,8 @@ class MacdCross:
     data_kline = None
     s_last_time = None
     s_now = None
+    # 报警算法的入口参数
+    info = None
 
     def __init__(self, info):
         ''' 报警条件：macd的diff和dea交叉
@@ -32,6 +46,8 @@ class MacdCross:
                 "2020-11-14 21:16"
             s_now                   本次运行时间，str
                 "2020-11-14 21:17"
+            time_new                第一个新的k线的时间(上次运行之后结束的k线)，None: 全部k线
+            asof_index              多个k线周期: 短周期k线 ---> 已结束的长周期k线的序号
         '''
         self.stock_code = info['stock_code']
         self.period = info['period']
@@ -40,6 +56,7 @@ class MacdCross:
         self.data_kline = info['data_kline']
         self.s_last_time = info['s_last_time']
         self.s_now = info['s_now']
+        self.info = info
 
     def run(self):
         ''' 报警算法
@@ -50,46 +67,90 @@ class MacdCross:
                     ]
         '''
         # 获取参数
-        price = self.get_price()
-        # 计算macd
-        df_macd = self.calc_macd(price)
+        price_type = self.get_price_type()
+        # 计算macd (多个报警程序共用)
+        df = indicator_cache.get_indicator(
+                self.info, 'MACD', (price_type, 26, 12, 9),
+                lambda: self.calc_macd_all(self.get_price(price_type)),
+                )
+        df_macd = self.select_new(df)
         # 检查交叉
         arr_cross = self.check_cross(df_macd)
+        # 多个k线周期
+        period_long = self.get_period_long()
+        if period_long is not None:
+            arr_cross = self.check_period_long(arr_cross, price_type, period_long)
         return arr_cross
 
-    def get_price(self):
-        ''' 获取价格 '''
-        df = self.data_kline[self.period]
+    def get_price_type(self):
+        ''' 价格类型，缺省使用 "开盘价"，减少计算量 '''
+        return get_price_type(self.other_kwargs)
+
+    def get_period_long(self):
+        ''' 长周期，None: 单个k线周期 '''
         if isinstance(self.other_kwargs, dict):
-            price_type = self.other_kwargs.get('price_type')
-        else:
-            price_type = None
-        if price_type is None:
-            # 缺省使用 "开盘价"，减少计算量
-            price = df['open']
-        else:
-            price = df[price_type]
-        return price
-
-    def calc_macd(self, price):
-        ''' 计算macd '''
+            return self.other_kwargs.get('period_long')
+        return None
+
+    def get_price(self, price_type, period=None):
+        ''' 获取价格 '''
+        if period is None:
+            period = self.period
+        df = self.data_kline[period]
+        return df[price_type]
+
+    def check_period_long(self, arr_cross, price_type, period_long):
+        ''' 多个k线周期: 按交叉时已结束的长周期k线的diff过滤
+            长周期的macd由多个报警程序、短周期共用；
+            短周期k线 ---> 长周期k线，使用info['asof_index']，不按时间查找。
+        '''
+        if not arr_cross:
+            return arr_cross
+        df_long = indicator_cache.get_indicator(
+                self.info, 'MACD', (price_type, 26, 12, 9),
+                lambda: self.calc_macd_all(self.get_price(price_type, period_long)),
+                period=period_long,
+                )
+        # calc_macd_all()去除了开头的nan
+        n_offset = self.data_kline[period_long].index.size - df_long.index.size
+        arr_diff = df_long['DIFF'].values
+        arr_asof = self.info['asof_index']
+        index_short = self.data_kline[self.period].index
+        arr_pos = index_short.get_indexer(
+                [pd.Timestamp(record[0]) for record in arr_cross]
+                )
+        arr_ret = []
+        for record, pos in zip(arr_cross, arr_pos):
+            i = arr_asof[pos] - n_offset if 0 <= pos else -1
+            if i < 0:
+                continue
+            diff = arr_diff[i]
+            if (
+                    (record[3] == '上交叉' and 0 < diff)
+                    or (record[3] == '下交叉' and diff < 0)
+                    ):
+                arr_ret.append(record)
+        return arr_ret
+
+    def calc_macd_all(self, price):
+        ''' 计算macd (全部k线) '''
         arr_name = ['DIFF', 'DEA', 'BAR']
         arr_data = talib.MACD(price.values, 26, 12, 9)
         df = pd.DataFrame(
                 dict(zip(arr_name, arr_data)), index=price.index, columns=arr_name
                 )
         df.dropna(inplace=True)
-        if self.s_last_time:
-            df_2 = df.loc[pd.Timestamp(self.s_last_time) < df.index]
-            if df_2.empty:
-                raise ValueError(f"数据未更新. s_now: {self.s_now}, {self.stock_code}, {self.period}")
-            elif df_2.index.size == 1:
-                df_macd = df[-2:]
-            else:
-                df_macd = df_2
-        else:
-            df_macd = df
-        return df_macd
+        return df
+
+    def select_new(self, df):
+        ''' 上次运行之后结束的k线的macd，包含前一个k线 (与第一个新的k线比较交叉) '''
+        time_new = self.info.get('time_new')
+        if time_new is None:
+            return df
+        pos = df.index.searchsorted(time_new)
+        if df.index.size <= pos:
+            raise ValueError(f"数据未更新. s_now: {self.s_now}, {self.stock_code}, {self.period}")
+        return df[max(pos - 1, 0):]
 
     def check_cross(self, df_macd):
         ''' 检查diff、dea的交叉 '''
@@ -125,6 +186,7 @@ def alarm_algorithm(info):
             "2020-11-14 21:16"
         s_now                   本次运行时间，str
             "2020-11-14 21:17"
+        time_new                第一个新的k线的时间，None: 全部k线
     返回值, ValueError or list
         [
                 (s_now, stock_code, period, message),
@@ -135,3 +197,85 @@ def alarm_algorithm(info):
     arr_cross = obj.run()
     return arr_cross
 
+
+
+def get_price_type(other_kwargs):
+    ''' 价格类型，缺省使用 "开盘价" '''
+    if isinstance(other_kwargs, dict):
+        price_type = other_kwargs.get('price_type')
+    else:
+        price_type = None
+    if price_type is None:
+        price_type = 'open'
+    return price_type
+
+
+def alarm_algorithm_batch(info):
+    ''' 报警算法 (批量接口)
+    入口参数, dict
+        arr_stock_code          股票代码 [stock_code, ...]
+        period                  k线周期
+        other_kwargs            算法的参数
+        remark                  算法的备注
+        index                   k线时间, pandas.DatetimeIndex
+        open, high, low, close  2维数组 (股票 x k线)，没有k线的位置为nan
+        arr_last_time           每个股票的上次运行时间 [None or str, ...]
+        arr_time_new            每个股票的第一个新的k线的时间 [None or pandas.Timestamp, ...]
+        s_now                   本次运行时间，str
+        long                    多个k线周期: 长周期的k线
+        asof_index              多个k线周期: 短周期k线 ---> 已结束的长周期k线的序号
+    返回值, list
+        [
+                (s_now, stock_code, period, message),
+                ...
+                ]
+    '''
+    price_type = get_price_type(info['other_kwargs'])
+    # macd的bar (多个报警程序共用)
+    bar, = indicator_cache.get_indicator_batch(
+            info, price_type, 'MACD.BAR', (26, 12, 9),
+            lambda arr: kernel.macd(arr, 26, 12, 9)[2:],
+            )
+    # 上一个有效的bar (跳过没有k线的位置)
+    bar_prev = np.full(bar.shape, np.nan)
+    bar_prev[:, 1:] = pd.DataFrame(bar.T).ffill().values.T[:, :-1]
+    # 上次运行之后结束的k线 (k线时间 >= 第一个新的k线的时间)
+    arr_time = info['index'].values
+    arr_new = np.array(
+            [
+                np.datetime64('NaT') if t is None else pd.Timestamp(t).to_datetime64()
+                for t in info['arr_time_new']
+                ],
+            dtype=arr_time.dtype,
+            )
+    mask_new = (arr_time[None, :] >= arr_new[:, None]) \
+        | np.isnat(arr_new)[:, None]
+    with np.errstate(invalid='ignore'):
+        cross_up = (bar_prev < 0) & (0 < bar) & mask_new
+        cross_down = (0 < bar_prev) & (bar < 0) & mask_new
+        if 'asof_index' in info:
+            # 多个k线周期: 长周期的macd每个k线只计算一次(缓存，多个短周期、报警程序共用)，
+            # 按as-of索引对齐到短周期
+            diff_long, = indicator_cache.get_indicator_batch(
+                    info['long'], price_type, 'MACD.DIFF', (26, 12, 9),
+                    lambda arr: kernel.macd(arr, 26, 12, 9)[:1],
+                    period=info['period_long'],
+                    )
+            arr_asof = info['asof_index']
+            diff_long = np.where(
+                    0 <= arr_asof, diff_long[:, np.maximum(arr_asof, 0)], np.nan
+                    )
+            cross_up &= 0 < diff_long
+            cross_down &= diff_long < 0
+    arr_cross = []
+    for mask, msg in ((cross_up, '上交叉'), (cross_down, '下交叉')):
+        for i, j in zip(*np.nonzero(mask)):
+            record = (
+                    info['index'][j].strftime('%Y-%m-%d %H:%M'),
+                    info['arr_stock_code'][i],
+                    info['period'],
+                    msg,
+                    )
+            arr_cross.append(record)
+    arr_cross.sort()
+    return arr_cross
@@ -0,0 +1,413 @@
+# -*- encoding: utf-8 -*-
+''' 报警程序的历史回放 (回测)
+修改插件后，不等待实时报警，用历史数据表({stock_code}_{year})的k线检查插件的报警信息:
+    $ python replay.py macd_cross 2020-01-01 2020-12-31 -c 000300.XSHG,000905.XSHG -p 1m,5m
+    $ python replay.py macd_cross 2020-01-01 2020-12-31 -c 000300.XSHG -p 5m -k '{"period_long": "30m"}'
+    $ python replay.py macd_cross 2020-06-01 2020-06-03 -c 000300.XSHG -p 5m --verify
+向量化:
+    实时运行每分钟调用一次SingleAlarmProgram.run()，每次只检查新的k线；
+    回放时每个股票读取全部k线(预热 + 回放的日期范围)，k线周期转换一次，
+    SingleAlarmProgram.run()只调用一次(第一次运行，s_last_time为None)，插件一次计算整个序列。
+    插件的指标只使用已结束的k线(ema等递推计算)时，与实时运行的报警信息相同:
+        报警时间在回放的日期范围内，按(s_now, stock_code, period)去除重复(check_repeat())。
+    预热: 插件声明的n_lookback(换算为基础周期)，没有声明时SingleStockInfo.limit_size，与实时运行相同。
+    每个k线在结束时检查一次(数据没有延迟)，与实时运行相同(上次运行之后结束的k线，get_time_new())。
+    --verify: 第一个股票逐分钟回放(replay_stepwise())，比较两种方式的报警信息(较慢，用于检查插件)。
+并行: 股票分组(settings.n_replay_chunk)，进程池(settings.n_replay_workers)，每个进程读取自己的k线数据。
+结果: 数据表replay_run(运行记录)、replay_message(报警信息，run_id区分每次回放)。
+'''
+
+import argparse
+import datetime
+import json
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from pandas.tseries.offsets import Minute
+
+# our apps
+import alarm_stock as a_s
+import indicator_cache
+import kline_store
+import settings as settings
+import trading_calendar
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+# 报警信息的列名
+arr_column = ['s_now', 'stock_code', 'period', 'message']
+
+
+class ReplayStock(a_s.SingleStockInfo):
+    ''' 回放的单个股票
+        k线数据来自历史数据表，不从数据源下载、不截取，
+        周期转换、as-of索引与实时运行(SingleStockInfo)相同。
+    '''
+
+    def __init__(self, stock_code, df, arr_period, period_base='1m'):
+        self.period_base = period_base
+        self.stock_code = stock_code
+        self.table_name = f'{stock_code}_today'
+        self.obj_calendar = trading_calendar.get_calendar(stock_code)
+        self.info_asof = {}
+        self.set_data(df, arr_period)
+
+    def set_data(self, df, arr_period):
+        ''' 替换k线数据，重新计算其它的k线周期 '''
+        if self.data_kline is not None:
+            self.data_kline.release()
+        self.data_kline = kline_store.KlineStore(
+                self.stock_code, self.period_base, self.build_period,
+                {self.period_base: df},
+                )
+        self.info_asof.clear()
+        indicator_cache.invalidate(self.stock_code)
+        for period in arr_period:
+            self.period_add(period)
+
+
+def get_warmup(obj_program, obj_calendar, arr_period, period_base='1m'):
+    ''' 预热需要的基础周期k线数量 (所有k线周期的最大值)
+        插件没有声明n_lookback or 无法换算: SingleStockInfo.limit_size
+    '''
+    n_max = 0
+    for period in arr_period:
+        n_bars = obj_program.get_lookback(period)
+        if n_bars is None:
+            return a_s.SingleStockInfo.limit_size
+        n_base = a_s.calc_base_bars(obj_calendar, period, n_bars, period_base)
+        if n_base is None:
+            return a_s.SingleStockInfo.limit_size
+        n_max = max(n_max, n_base)
+    return n_max
+
+
+def read_history(obj_db, stock_code, date_start, date_end, n_warmup):
+    ''' 从历史数据表({stock_code}_{year})读取k线数据
+    入口参数:
+        date_start, date_end    回放的日期范围 (包含date_end)
+        n_warmup                date_start之前的k线数量 (预热)
+    返回值: DataFrame，没有数据时为空
+    '''
+    time_start = pd.Timestamp(date_start)
+    time_end = pd.Timestamp(date_end) + pd.Timedelta(days=1)
+    arr_df = []
+    for year in range(time_start.year, time_end.year + 1):
+        try:
+            arr_df.append(obj_db.read_db__kline(
+                    f'{stock_code}_{year}',
+                    end_time=time_end, start_time=time_start,
+                    ))
+        except ValueError:
+            continue
+    # 预热: 向前读取，直到k线数量足够 or 数据表不存在
+    year = time_start.year
+    n_more = n_warmup
+    while 0 < n_more:
+        try:
+            df = obj_db.read_db__kline(f'{stock_code}_{year}', n_more, time_start)
+        except ValueError:
+            break
+        arr_df.insert(0, df)
+        n_more -= df.index.size
+        year -= 1
+    arr_df = [df for df in arr_df if not df.empty]
+    if not arr_df:
+        return pd.DataFrame(columns=['open', 'high', 'low', 'close'])
+    df = pd.concat(arr_df)
+    df = df[~df.index.duplicated(keep='last')].sort_index()
+    df.index.rename('date', inplace=True)
+    return df[['open', 'high', 'low', 'close']].astype(float)
+
+
+def select_record(arr_record, date_start, date_end):
+    ''' 报警时间在回放的日期范围内，去除重复 (同check_repeat())，按时间排序 '''
+    s_start = pd.Timestamp(date_start).strftime('%Y-%m-%d')
+    s_end = (pd.Timestamp(date_end) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    info = {}
+    for record in arr_record:
+        s_now, stock_code, period, message = record
+        if s_start <= s_now < s_end:
+            info.setdefault((s_now, stock_code, period), tuple(record))
+    return sorted(info.values())
+
+
+def create_program(info_program, arr_stock_code, info_stock, flag_all_bars=True):
+    ''' 回放的报警程序
+        flag_all_bars       批量接口使用全部k线，False: 插件的n_bars_batch (同实时运行)
+    '''
+    info = dict(info_program)
+    info['arr_stock_code'] = arr_stock_code
+    info['info_stock'] = info_stock
+    obj_program = a_s.SingleAlarmProgram(info)
+    if flag_all_bars:
+        obj_program.n_bars_batch = None
+    return obj_program
+
+
+def get_arr_period(info_program):
+    ''' 需要的k线周期 (包含长周期，不包含基础周期) '''
+    arr_period = list(info_program['arr_period'])
+    other_kwargs = info_program['other_kwargs']
+    if isinstance(other_kwargs, dict) and other_kwargs.get('period_long'):
+        arr_period.append(other_kwargs['period_long'])
+    return arr_period
+
+
+def replay_chunk(db_name, info_program, arr_stock_code, date_start, date_end):
+    ''' 回放一组股票 (进程池中运行)
+        返回值: (报警信息 [(s_now, stock_code, period, message), ...], {stock_code: k线数量})
+    '''
+    obj_db = a_s.DataTable(db_name)
+    info_stock = {}
+    obj_program = create_program(info_program, arr_stock_code, info_stock)
+    arr_period = get_arr_period(info_program)
+    info_n_bars = {}
+    last_time = None
+    for stock_code in arr_stock_code:
+        obj_calendar = trading_calendar.get_calendar(stock_code)
+        n_warmup = get_warmup(obj_program, obj_calendar, arr_period)
+        df = read_history(obj_db, stock_code, date_start, date_end, n_warmup)
+        info_n_bars[stock_code] = df.index.size
+        if df.empty:
+            logger.warning(f'{stock_code}: 没有历史数据 {date_start} ~ {date_end}')
+            continue
+        info_stock[stock_code] = ReplayStock(stock_code, df, arr_period)
+        if last_time is None or last_time < df.index[-1]:
+            last_time = df.index[-1]
+    obj_db.engine.dispose()
+    if not info_stock:
+        return [], info_n_bars
+    obj_program.info_program['arr_task'] = [
+            (stock_code, period)
+            for stock_code in info_stock
+            for period in info_program['arr_period']
+            ]
+    # 最后一个k线结束时运行一次，插件计算全部k线
+    s_now = (last_time + Minute(1)).strftime('%Y-%m-%d %H:%M')
+    arr_record = obj_program.run(s_now, True)
+    for stock_code in info_stock:
+        indicator_cache.invalidate(stock_code)
+    return select_record(arr_record, date_start, date_end), info_n_bars
+
+
+def replay(
+        algorithm, arr_stock_code, arr_period, date_start, date_end,
+        other_kwargs=None, remark=None, n_workers=None, db_name=None,
+        flag_save=True,
+        ):
+    ''' 历史回放
+    入口参数:
+        algorithm           插件名称 (plugins/xxx.py)
+        arr_stock_code      股票代码 [stock_code, ...]
+        arr_period          k线周期 [period, ...]
+        date_start, date_end
+                            回放的日期范围 (包含date_end)
+        other_kwargs        算法的参数
+        n_workers           进程数量，None: settings.n_replay_workers，1: 不使用进程池
+        db_name             数据库，None: settings.sql_url
+        flag_save           结果写入数据表 (replay_run、replay_message)
+    返回值: (run_id, DataFrame(报警信息))
+    '''
+    t_begin = time.time()
+    if db_name is None:
+        db_name = settings.sql_url
+    if n_workers is None:
+        n_workers = settings.n_replay_workers or os.cpu_count()
+    info_program = {
+            'algorithm': algorithm,
+            'arr_stock_code': list(arr_stock_code),
+            'arr_period': list(arr_period),
+            'other_kwargs': other_kwargs,
+            'remark': remark,
+            }
+    n_chunk = settings.n_replay_chunk
+    arr_chunk = [
+            arr_stock_code[i:i + n_chunk]
+            for i in range(0, len(arr_stock_code), n_chunk)
+            ]
+    arr_record = []
+    info_n_bars = {}
+    if n_workers <= 1 or len(arr_chunk) <= 1:
+        for arr_code in arr_chunk:
+            arr, info = replay_chunk(
+                    db_name, info_program, arr_code, date_start, date_end
+                    )
+            arr_record.extend(arr)
+            info_n_bars.update(info)
+    else:
+        with ProcessPoolExecutor(min(n_workers, len(arr_chunk))) as executor:
+            arr_future = [
+                    executor.submit(
+                        replay_chunk,
+                        db_name, info_program, arr_code, date_start, date_end,
+                        )
+                    for arr_code in arr_chunk
+                    ]
+            for i, future in enumerate(as_completed(arr_future)):
+                arr, info = future.result()
+                arr_record.extend(arr)
+                info_n_bars.update(info)
+                logger.info(f'回放: {i + 1}/{len(arr_chunk)}组, 报警信息{len(arr)}条')
+    arr_record.sort()
+    run_time = time.time() - t_begin
+    now = datetime.datetime.now()
+    run_id = f'{algorithm}_{now:%Y%m%d%H%M%S%f}'
+    logger.info(f'回放{run_id}: {len(arr_stock_code)}个股票, k线{sum(info_n_bars.values())}个, 报警信息{len(arr_record)}条, run time: {run_time:.3f}s')
+    if flag_save:
+        obj_db = a_s.DataTable(db_name)
+        obj_db.save_db__replay({
+                'run_id': run_id,
+                'algorithm': algorithm,
+                'arr_stock_code': json.dumps(list(arr_stock_code)),
+                'arr_period': json.dumps(list(arr_period)),
+                'other_kwargs': json.dumps(other_kwargs) if other_kwargs else None,
+                'date_start': str(date_start),
+                'date_end': str(date_end),
+                'n_alarm': len(arr_record),
+                'run_time': run_time,
+                'time_create': now.strftime('%Y-%m-%d %H:%M:%S'),
+                }, arr_record)
+    df = pd.DataFrame(arr_record, columns=arr_column)
+    df.set_index(arr_column[:3], inplace=True)
+    return run_id, df
+
+
+def replay_stepwise(
+        algorithm, stock_code, arr_period, date_start, date_end,
+        other_kwargs=None, db_name=None,
+        ):
+    ''' 逐分钟回放一个股票 (检查向量化的结果)
+        同实时运行: 每分钟k线数据截止到当前分钟，调用SingleAlarmProgram.run()，
+        第一次运行(only_once)之后，只在k线结束时运行，保留运行状态(info_last_time_run)；
+        批量接口的k线数量同实时运行(n_bars_batch)。
+        检查插件是否使用了未来的k线、按上次运行时间选择新k线、预热和k线数量的限制是否影响报警信息。
+    返回值: 报警信息 [(s_now, stock_code, period, message), ...]
+    '''
+    if db_name is None:
+        db_name = settings.sql_url
+    info_program = {
+            'algorithm': algorithm,
+            'arr_stock_code': [stock_code],
+            'arr_period': list(arr_period),
+            'other_kwargs': other_kwargs,
+            'remark': None,
+            }
+    obj_db = a_s.DataTable(db_name)
+    info_stock = {}
+    obj_program = create_program(info_program, [stock_code], info_stock, False)
+    arr_period_all = get_arr_period(info_program)
+    obj_calendar = trading_calendar.get_calendar(stock_code)
+    n_warmup = get_warmup(obj_program, obj_calendar, arr_period_all)
+    df = read_history(obj_db, stock_code, date_start, date_end, n_warmup)
+    obj_db.engine.dispose()
+    if df.empty:
+        return []
+    n_begin = df.index.searchsorted(pd.Timestamp(date_start))
+    obj_stock = ReplayStock(stock_code, df.iloc[:n_begin + 1], arr_period_all)
+    info_stock[stock_code] = obj_stock
+    arr_record = []
+    for i in range(n_begin, df.index.size):
+        # 第i个基础周期k线结束时 (第一次运行之后，没有结束的k线周期时不运行)
+        now = df.index[i] + Minute(1)
+        flag_first = i == n_begin
+        if not flag_first and not any(
+                obj_calendar.is_bar_closed(now, a_s.PeriodType(period))
+                for period in arr_period
+                ):
+            continue
+        obj_stock.set_data(df.iloc[:i + 1], arr_period_all)
+        s_now = now.strftime('%Y-%m-%d %H:%M')
+        arr_record.extend(obj_program.run(s_now, flag_first) or ())
+    indicator_cache.invalidate(stock_code)
+    return select_record(arr_record, date_start, date_end)
+
+
+def verify(
+        algorithm, stock_code, arr_period, date_start, date_end,
+        other_kwargs=None, db_name=None,
+        ):
+    ''' 比较向量化回放与逐分钟回放的报警信息
+        返回值: (仅向量化的报警信息, 仅逐分钟回放的报警信息)
+    '''
+    info_program = {
+            'algorithm': algorithm,
+            'arr_stock_code': [stock_code],
+            'arr_period': list(arr_period),
+            'other_kwargs': other_kwargs,
+            'remark': None,
+            }
+    arr_vector, _ = replay_chunk(
+            db_name or settings.sql_url, info_program, [stock_code],
+            date_start, date_end,
+            )
+    arr_step = replay_stepwise(
+            algorithm, stock_code, arr_period, date_start, date_end,
+            other_kwargs, db_name,
+            )
+    set_vector, set_step = set(arr_vector), set(arr_step)
+    arr_only_vector = sorted(set_vector - set_step)
+    arr_only_step = sorted(set_step - set_vector)
+    logger.info(f'检查{stock_code}: 向量化{len(set_vector)}条, 逐分钟回放{len(set_step)}条, 不同: {len(arr_only_vector)} / {len(arr_only_step)}')
+    return arr_only_vector, arr_only_step
+
+
+def proc_parser():
+    parser = argparse.ArgumentParser(description='报警程序的历史回放')
+    parser.add_argument('algorithm', type=str, help='插件名称 (plugins/xxx.py)')
+    parser.add_argument('date_start', type=str, metavar='YYYY-MM-DD', help='开始日期')
+    parser.add_argument('date_end', type=str, metavar='YYYY-MM-DD', help='结束日期（包含）')
+    parser.add_argument(
+            '-c', '--code', type=str, required=True,
+            help='股票代码，逗号分隔',
+            )
+    parser.add_argument(
+            '-p', '--period', type=str, default='1m',
+            help='k线周期，逗号分隔（缺省值1m）',
+            )
+    parser.add_argument(
+            '-k', '--kwargs', type=str, default=None,
+            help='算法的参数，json',
+            )
+    parser.add_argument(
+            '-w', '--workers', type=int, default=None,
+            help='进程数量（缺省值settings.n_replay_workers）',
+            )
+    parser.add_argument(
+            '--verify', action='store_true',
+            help='第一个股票逐分钟回放，比较报警信息',
+            )
+    res = parser.parse_args()
+    return res
+
+
+def main():
+    res = proc_parser()
+    arr_stock_code = [code for code in res.code.split(',') if code]
+    arr_period = [period for period in res.period.split(',') if period]
+    other_kwargs = json.loads(res.kwargs) if res.kwargs else None
+    if res.verify:
+        arr_only_vector, arr_only_step = verify(
+                res.algorithm, arr_stock_code[0], arr_period,
+                res.date_start, res.date_end, other_kwargs,
+                )
+        for title, arr in (('仅向量化', arr_only_vector), ('仅逐分钟回放', arr_only_step)):
+            for record in arr:
+                print(title, *record, sep='\t')
+        return
+    run_id, df = replay(
+            res.algorithm, arr_stock_code, arr_period,
+            res.date_start, res.date_end, other_kwargs,
+            n_workers=res.workers,
+            )
+    print(df)
+    print(f'run_id: {run_id}')
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,8 @@ f_name_audio = os.path.join(dir_data, 'Ron Korb-Todaiji.mp3')
 # SQLite3文件
 f_name_database = os.path.join(dir_data, 'alarm_stock.db')
 sql_url = f'sqlite:///{f_name_database}'
+# 节假日文件
+f_name_holiday = os.path.join(dir_data, 'holiday.txt')
 # 工作日志
 if DEBUG:
     log_level = logging.DEBUG
@@ -47,3 +49,83 @@ n_sleep = 20
 n_continue_run = 30
 # 插件目录名
 dir_plugin = 'plugins'
+# k线缺口检测的交易日数量，0: 数据表中保存的全部k线
+n_gap_scan_days = 0
+# 技术指标缓存的内存限制 (MB)
+n_indicator_cache_mb = 64
+# 推送行情的地址 ('host:port' or Unix socket文件名)，None: 仅定时下载
+feed_address = None
+# 报警算法的批量接口，每个股票的k线数量
+n_batch_bars = 1000
+# 定时检查报警程序数据表的间隔(分钟)，变化时增量更新，0: 不检查
+n_program_check_minutes = 1
+# 全市场筛选: 每个股票保留的k线数量的最小值 (基础周期)，
+# 插件声明了n_lookback时，按筛选的k线周期换算(取最大值)；没有声明时使用此值
+n_screen_bars = 500
+# 全市场筛选: 每次get_price()下载的股票数量
+n_screen_batch = 500
+# 全市场筛选: 每次下载时重新下载最近的k线数量 (补齐部分股票迟到的k线)
+n_screen_late_bars = 5
+# 报警插件每次运行的执行预算(秒)，超时的结果丢弃
+n_plugin_budget_seconds = 20
+# 报警插件连续超时的次数，达到后隔离(不再运行，插件重新加载后解除)
+n_plugin_overrun_max = 3
+# 报警信息的通知方式: console, audio, file, webhook, desktop
+arr_notify_sink = ('console', 'audio')
+# 通知方式file: 文件名
+f_name_notify = os.path.join(dir_data, 'alarm_notify.txt')
+# 通知方式webhook: 地址 (HTTP POST json)
+notify_webhook_url = None
+# 通知: 每个通知方式的队列长度(批)，队列满时丢弃最早的一批
+n_notify_queue = 100
+# 通知: 发送失败的重试次数
+n_notify_retry = 3
+# 通知: 第一次重试的间隔(秒)，以后每次加倍
+n_notify_backoff = 0.5
+# 通知: webhook、desktop的超时(秒)
+n_notify_timeout = 5
+# 监控服务(daemon.py)的地址 (Unix socket文件名)
+daemon_address = os.path.join(dir_data, 'alarm_stock.sock')
+# 单实例锁 (flock): 监控服务、图形界面的本地模式，只有一个进程下载行情、运行报警程序
+f_name_instance_lock = os.path.join(dir_data, 'alarm_stock.lock')
+# 图形界面: 监控服务正在启动(持有单实例锁，还没有开始服务)时，等待的时间(秒)
+n_daemon_start_wait = 120
+# 图形界面: 读取新的报警信息的间隔(毫秒)
+n_gui_poll_ms = 500
+# 图形界面: 报警信息每页的记录数量 (滚动到最后时读取下一页)
+n_gui_page_rows = 200
+# 图形界面: k线图显示最近的k线数量 (缩略到窗口宽度)
+n_chart_bars = 62400
+# 图形界面: k线图的高度(像素)
+n_chart_height = 250
+# 图形界面: k线图的刷新间隔(毫秒)
+n_chart_refresh_ms = 3000
+# 图形界面: k线图显示的报警信息的最大数量
+n_chart_markers = 500
+# 报警信息: 数据表中保留的月数(按月分区)，更早的分区压缩保存到文件，0: 不归档
+n_alarm_hot_months = 12
+# 报警信息: 归档文件的目录
+dir_alarm_archive = os.path.join(dir_data, 'alarm_archive')
+# 数据写入(后台线程): 队列长度(批)，队列满时数据保留到下一次
+n_persist_queue = 100
+# 数据写入: 失败时第一次重试的间隔(秒)，以后每次加倍
+n_persist_backoff = 0.5
+# 数据写入: 退出时等待写入完成的时间(秒)
+n_persist_timeout = 30
+# 快照(快速重启)的目录
+dir_snapshot = os.path.join(dir_data, 'snapshot')
+# 快照: 定时保存的间隔(分钟)，0: 仅退出时保存
+n_snapshot_minutes = 10
+# k线数据的紧凑存储: None: float64, 'float32': 价格float32, 'int32': 价格 x n_kline_price_scale 保存为int32
+# 只使用无损的紧凑数组，价格无法无损保存的股票不使用紧凑模式 (报警信息不变)
+kline_dtype = None
+# k线数据的紧凑存储: int32价格的倍数 (4位小数)
+n_kline_price_scale = 10000
+# k线数据的内存预算(MB，所有股票)，超出时删除最久没有使用的k线周期，读取时重新计算，0: 不限制
+n_kline_budget_mb = 0
+# 历史回放(replay.py): 进程数量，0: cpu数量
+n_replay_workers = 0
+# 历史回放: 每个进程一次处理的股票数量
+n_replay_chunk = 20
+# 缺省的交易市场 (股票代码的后缀无法识别时)
+market_default = 'XSHG'
@@ -0,0 +1,273 @@
+# -*- encoding: utf-8 -*-
+''' k线数据、报警程序运行状态的快照 (快速重启)
+退出时、定时(settings.n_snapshot_minutes)，KlineInfo的状态保存到settings.dir_snapshot:
+    meta.json               版本、数据库、每个股票的k线周期和水位、报警程序的运行状态
+    snap_<时间>/            k线数据，每个(股票, k线周期)两个文件:
+        <n>_index.npy           时间 (int64, ns)
+        <n>_values.npy          价格 (float64, n_bars x 列)
+    meta.json最后写入(os.replace)，中途退出时，上一个快照仍然有效。
+启动时读取快照，k线数据np.load(mmap_mode='c')，不读入内存、不从数据表读取、不重新计算周期转换:
+    版本、数据库、k线基础周期不同 ---> 快照无效
+    水位: 快照中股票的最后一个k线，晚于数据表的最后一个k线(没有写入数据表) ---> 该股票从数据表读取
+快照是今天的，恢复报警程序的运行状态(info_last_time_run、info_alarm_msg、价格报警的最后k线时间)，
+不需要第一次运行(only_once)，不会重复第一次运行的报警信息。
+技术指标的缓存(indicator_cache)不保存，第一次使用时计算。
+'''
+
+import datetime
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+# 快照的格式版本，格式改变时加1 (旧的快照无效)
+VERSION = 1
+
+
+def to_json_label(label):
+    ''' 运行状态的键值: (stock_code, period) or period ---> json '''
+    if isinstance(label, tuple):
+        return list(label)
+    return label
+
+
+def from_json_label(label):
+    ''' 运行状态的键值: json ---> (stock_code, period) or period '''
+    if isinstance(label, list):
+        return tuple(label)
+    return label
+
+
+class StateSnapshot:
+    ''' KlineInfo的快照 '''
+    # 快照的目录
+    dir_snapshot = None
+    # 快照的信息 (meta.json)，None: 没有快照 or 无效
+    info_meta = None
+
+    def __init__(self, dir_snapshot=None):
+        if dir_snapshot is None:
+            dir_snapshot = settings.dir_snapshot
+        self.dir_snapshot = dir_snapshot
+
+    def get_f_name_meta(self):
+        return os.path.join(self.dir_snapshot, 'meta.json')
+
+    def save(self, obj_KlineInfo):
+        ''' 保存快照
+            返回值: 快照的字节数
+        '''
+        t_begin = time.time()
+        now = datetime.datetime.now()
+        name = f'snap_{now:%Y%m%d%H%M%S%f}'
+        dir_data = os.path.join(self.dir_snapshot, name)
+        os.makedirs(dir_data)
+        info_stock = {}
+        n = nbytes = 0
+        for stock_code, obj_stock in list(obj_KlineInfo.info_stock.items()):
+            info_period = {}
+            for period in list(obj_stock.data_kline):
+                # 内存预算删除的k线周期不保存 (启动后period_add()重新计算)
+                if (
+                        period != obj_stock.period_base
+                        and not obj_stock.data_kline.is_loaded(period)
+                        ):
+                    continue
+                df = obj_stock.data_kline[period]
+                arr_index = df.index.values.astype('datetime64[ns]').view(np.int64)
+                arr_value = df.values.astype(np.float64)
+                np.save(os.path.join(dir_data, f'{n}_index.npy'), arr_index)
+                np.save(os.path.join(dir_data, f'{n}_values.npy'), arr_value)
+                info_period[period] = {
+                        'file': n,
+                        'n_bars': len(df),
+                        'columns': list(df.columns),
+                        'index_name': df.index.name,
+                        }
+                n += 1
+                nbytes += arr_index.nbytes + arr_value.nbytes
+            df_base = obj_stock.data_kline[obj_stock.period_base]
+            info_stock[stock_code] = {
+                    'table_name': obj_stock.table_name,
+                    # 水位: 基础周期的最后一个k线
+                    'last_time': str(df_base.index[-1]) if len(df_base) else None,
+                    'period': info_period,
+                    }
+        info_meta = {
+                'version': VERSION,
+                'time': now.strftime('%Y-%m-%d %H:%M:%S'),
+                'db_name': obj_KlineInfo.obj_DataTable.get_database_name(),
+                'period_base': obj_KlineInfo.period_base,
+                'dir_data': name,
+                'stock': info_stock,
+                'program': self.get_program_state(obj_KlineInfo),
+                'price_level': self.get_price_level_state(obj_KlineInfo),
+                }
+        f_name = self.get_f_name_meta()
+        with open(f_name + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(info_meta, f, ensure_ascii=False)
+        os.replace(f_name + '.tmp', f_name)
+        self.remove_old(name)
+        logger.info(f'保存快照: {len(info_stock)}个股票, {n}个k线周期, {nbytes / 1024 / 1024:.1f}MB, run time: {time.time() - t_begin:.3f}s')
+        return nbytes
+
+    def remove_old(self, name):
+        ''' 删除以前的快照数据 (已经mmap的文件，删除后仍然可以访问) '''
+        for name_old in os.listdir(self.dir_snapshot):
+            if name_old.startswith('snap_') and name_old != name:
+                shutil.rmtree(
+                        os.path.join(self.dir_snapshot, name_old),
+                        ignore_errors=True,
+                        )
+
+    @staticmethod
+    def get_program_state(obj_KlineInfo):
+        ''' 报警程序的运行状态 (执行计划的每组任务) '''
+        obj_plan = obj_KlineInfo.obj_ExecutionPlan
+        if obj_plan is None:
+            return []
+        return [
+                {
+                    'runner_key': list(runner_key),
+                    'info_last_time_run': [
+                        [to_json_label(label), s_time]
+                        for label, s_time in obj_program.info_last_time_run.items()
+                        ],
+                    'info_alarm_msg': [
+                        [to_json_label(label), s_time]
+                        for label, s_time in obj_program.info_alarm_msg.items()
+                        ],
+                    }
+                for runner_key, obj_program in obj_plan.info_runner.items()
+                ]
+
+    @staticmethod
+    def get_price_level_state(obj_KlineInfo):
+        ''' 价格报警的运行状态: [[stock_code, price_type, 最后k线时间], ...] '''
+        obj_PriceLevel = obj_KlineInfo.obj_PriceLevel
+        if obj_PriceLevel is None:
+            return []
+        return [
+                list(key) + [str(last_time)]
+                for key, last_time in obj_PriceLevel.info_last_time.items()
+                ]
+
+    def load(self, obj_DataTable, period_base):
+        ''' 读取快照的信息 (meta.json)
+            返回值: 是否有效
+        '''
+        self.info_meta = None
+        f_name = self.get_f_name_meta()
+        if not os.path.exists(f_name):
+            return False
+        try:
+            with open(f_name, encoding='utf-8') as f:
+                info_meta = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f'快照读取失败: {e!r}')
+            return False
+        if info_meta.get('version') != VERSION:
+            logger.info(f'快照的版本不同: {info_meta.get("version")}, 不使用')
+        elif info_meta.get('db_name') != obj_DataTable.get_database_name():
+            logger.info(f'快照的数据库不同: {info_meta.get("db_name")}, 不使用')
+        elif info_meta.get('period_base') != period_base:
+            logger.info(f'快照的k线基础周期不同: {info_meta.get("period_base")}, 不使用')
+        else:
+            self.info_meta = info_meta
+            logger.info(f'快照: {info_meta["time"]}, {len(info_meta["stock"])}个股票')
+            return True
+        return False
+
+    def release(self):
+        ''' 启动完成，不再使用快照 (以后增加的股票从数据表读取) '''
+        self.info_meta = None
+
+    def get_kline(self, stock_code, obj_DataTable):
+        ''' 快照中股票的k线数据 (mmap)
+            返回值: {period: DataFrame, ...}，None: 没有 or 无效(水位)
+        '''
+        if self.info_meta is None:
+            return None
+        info = self.info_meta['stock'].get(stock_code)
+        if info is None:
+            return None
+        if info['last_time'] is not None:
+            # 快照中的k线必须已经写入数据表，否则数据表的缺口不会再补充
+            last_time = obj_DataTable.read_db__kline__last_time(info['table_name'])
+            if last_time is None or last_time < pd.Timestamp(info['last_time']):
+                logger.info(f'{stock_code}: 快照的水位{info["last_time"]}晚于数据表({last_time})，从数据表读取')
+                return None
+        dir_data = os.path.join(self.dir_snapshot, self.info_meta['dir_data'])
+        data_kline = {}
+        try:
+            for period, info_period in info['period'].items():
+                n = info_period['file']
+                # 没有数据时不能mmap
+                mmap_mode = 'c' if info_period['n_bars'] else None
+                arr_index = np.load(
+                        os.path.join(dir_data, f'{n}_index.npy'),
+                        mmap_mode=mmap_mode,
+                        )
+                arr_value = np.load(
+                        os.path.join(dir_data, f'{n}_values.npy'),
+                        mmap_mode=mmap_mode,
+                        )
+                shape = (info_period['n_bars'], len(info_period['columns']))
+                if arr_index.shape != shape[:1] or arr_value.shape != shape:
+                    raise ValueError(f'{period}: 数据的大小不同 {arr_value.shape}')
+                index = pd.DatetimeIndex(
+                        arr_index.view('datetime64[ns]'),
+                        name=info_period['index_name'],
+                        )
+                data_kline[period] = pd.DataFrame(
+                        arr_value, index=index, columns=info_period['columns'],
+                        copy=False,
+                        )
+        except (OSError, ValueError) as e:
+            logger.warning(f'{stock_code}: 快照的k线数据读取失败: {e!r}')
+            return None
+        return data_kline
+
+    def restore_program(self, obj_KlineInfo, today=None):
+        ''' 恢复报警程序的运行状态 (今天的快照)
+            返回值: 是否全部恢复 (True: 不需要第一次运行)
+        '''
+        if self.info_meta is None:
+            return False
+        if today is None:
+            today = datetime.date.today()
+        if self.info_meta['time'][:10] != f'{today:%Y-%m-%d}':
+            logger.info(f'快照不是今天的，报警程序第一次运行: {self.info_meta["time"]}')
+            return False
+        info_runner = obj_KlineInfo.obj_ExecutionPlan.info_runner
+        set_restore = set()
+        for info in self.info_meta['program']:
+            runner_key = tuple(info['runner_key'])
+            obj_program = info_runner.get(runner_key)
+            if obj_program is None:
+                continue
+            obj_program.info_last_time_run.update(
+                    (from_json_label(label), s_time)
+                    for label, s_time in info['info_last_time_run']
+                    )
+            obj_program.info_alarm_msg.update(
+                    (from_json_label(label), s_time)
+                    for label, s_time in info['info_alarm_msg']
+                    )
+            set_restore.add(runner_key)
+        obj_PriceLevel = obj_KlineInfo.obj_PriceLevel
+        if obj_PriceLevel is not None:
+            for stock_code, price_type, last_time in self.info_meta['price_level']:
+                obj_PriceLevel.info_last_time[(stock_code, price_type)] = pd.Timestamp(last_time)
+        n_missing = len(set(info_runner) - set_restore)
+        logger.info(f'快照: 恢复{len(set_restore)}组报警程序的运行状态, 没有状态的{n_missing}组')
+        return n_missing == 0
@@ -0,0 +1,21 @@
+# -*- encoding: utf-8 -*-
+''' pytest的公共设置
+    settings.py的数据目录为'../datas'(相对于当前目录)，
+    测试在临时目录中运行，不使用实际的数据库、日志文件。
+'''
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+dir_src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if dir_src not in sys.path:
+    sys.path.insert(0, dir_src)
+
+dir_test = tempfile.mkdtemp(prefix='alarm_stock_test_')
+atexit.register(shutil.rmtree, dir_test, True)
+os.makedirs(os.path.join(dir_test, 'datas'))
+os.makedirs(os.path.join(dir_test, 'work'))
+os.chdir(os.path.join(dir_test, 'work'))
@@ -0,0 +1,82 @@
+# -*- encoding: utf-8 -*-
+''' chart.LodCache: 多级缩略数据，增量更新与重新计算的结果一致 '''
+
+import numpy as np
+import pandas as pd
+
+import chart
+
+
+def make_bars(n, seed=0):
+    rs = np.random.RandomState(seed)
+    close = 100.0 + np.cumsum(rs.randn(n))
+    return pd.DataFrame(
+            {
+                'open': close + rs.randn(n), 'high': close + 2 + rs.rand(n),
+                'low': close - 2 - rs.rand(n), 'close': close,
+                },
+            index=pd.date_range('2020-10-14 09:30', periods=n, freq='min', name='date'),
+            )
+
+
+def assert_same_levels(obj, obj_expected):
+    assert len(obj.arr_level) == len(obj_expected.arr_level)
+    for info, info_expected in zip(obj.arr_level, obj_expected.arr_level):
+        for name in ('time',) + chart.arr_name:
+            np.testing.assert_array_equal(info[name], info_expected[name])
+
+
+def rebuild(df):
+    obj = chart.LodCache()
+    obj.update(df)
+    return obj
+
+
+def test_levels():
+    df = make_bars(37)
+    obj = rebuild(df)
+    assert [len(info['time']) for info in obj.arr_level] == [37, 19, 10, 5, 3, 2, 1]
+    # 第k级的每个k线由2^k个原始k线合并: 极值不丢失
+    for level, info in enumerate(obj.arr_level):
+        n = 2 ** level
+        for i in range(len(info['time'])):
+            df_part = df.iloc[i * n:(i + 1) * n]
+            assert info['open'][i] == df_part['open'].iloc[0]
+            assert info['high'][i] == df_part['high'].max()
+            assert info['low'][i] == df_part['low'].min()
+            assert info['close'][i] == df_part['close'].iloc[-1]
+
+
+def test_incremental_update():
+    ''' 增加k线、最后一个k线更新: 只重新计算最后的k线 '''
+    df = make_bars(300)
+    obj = chart.LodCache()
+    assert obj.update(df.iloc[:100]) == 0
+    for n in (101, 102, 150, 151, 256, 257, 300):
+        assert obj.update(df.iloc[:n]) is not None
+        assert_same_levels(obj, rebuild(df.iloc[:n]))
+    # 没有变化
+    assert obj.update(df) is None
+    # 最后一个k线更新
+    df_last = df.copy()
+    df_last.iloc[-1, df_last.columns.get_loc('high')] += 10
+    assert obj.update(df_last) == 299
+    assert_same_levels(obj, rebuild(df_last))
+    # 截取开头的k线: 全部重新计算
+    assert obj.update(df_last.iloc[50:]) == 0
+    assert_same_levels(obj, rebuild(df_last.iloc[50:]))
+
+
+def test_get_view():
+    df = make_bars(1000)
+    obj = rebuild(df)
+    level, info = obj.get_view(1200)
+    assert level == 0 and len(info['time']) == 1000
+    level, info = obj.get_view(300)
+    assert level == 2 and len(info['time']) <= 300
+    assert info['high'].max() == df['high'].max()
+    assert info['low'].min() == df['low'].min()
+    # 最近的n_bars个k线
+    level, info = obj.get_view(100, 400)
+    assert level == 2 and len(info['time']) <= 101
+    assert info['close'][-1] == df['close'].iloc[-1]
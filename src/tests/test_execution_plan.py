@@ -0,0 +1,89 @@
+# -*- encoding: utf-8 -*-
+''' ExecutionPlan: 相同的(algorithm, kwargs)合并为一组，任务去除重复，报警信息分发 '''
+
+import alarm_stock as a_s
+
+
+def make_program(arr_stock_code, arr_period, other_kwargs, remark=''):
+    return {
+            'algorithm': 'macd_cross',
+            'arr_stock_code': arr_stock_code,
+            'arr_period': arr_period,
+            'other_kwargs': other_kwargs,
+            'remark': remark,
+            'info_stock': {},
+            }
+
+
+def make_plan(*arr_info):
+    obj_plan = a_s.ExecutionPlan()
+    for i, info in enumerate(arr_info):
+        obj_plan.add_program(i, info)
+    obj_plan.compile()
+    return obj_plan
+
+
+def test_dedup():
+    info_a = make_program(['000300.XSHG', '000905.XSHG'], ['1m', '5m'], {'x': 1, 'y': 2}, 'a')
+    # 参数相同、书写顺序不同，合并
+    info_b = make_program(['000905.XSHG', '399006.XSHE'], ['5m'], {'y': 2, 'x': 1}, 'b')
+    # 参数不同，另一组
+    info_c = make_program(['000300.XSHG'], ['1m'], None, 'c')
+    obj_plan = make_plan(info_a, info_b, info_c)
+    assert obj_plan.n_task_request == 7
+    assert obj_plan.count_task() == 6
+    assert len(obj_plan.info_runner) == 2
+    obj_program = obj_plan.info_runner[('macd_cross', '{"x": 1, "y": 2}')]
+    assert obj_program.info_program['arr_task'] == [
+            ('000300.XSHG', '1m'), ('000300.XSHG', '5m'),
+            ('000905.XSHG', '1m'), ('000905.XSHG', '5m'),
+            ('399006.XSHE', '5m'),
+            ]
+    assert obj_program.info_program['arr_period'] == ['1m', '5m']
+
+
+def test_run_dispatch():
+    ''' 每个任务只执行一次，报警信息分发给包含该任务的所有报警程序 '''
+    info_a = make_program(['000300.XSHG', '000905.XSHG'], ['1m'], None, 'a')
+    info_b = make_program(['000905.XSHG'], ['1m'], None, 'b')
+    obj_plan = make_plan(info_a, info_b)
+    (obj_program,) = obj_plan.info_runner.values()
+    arr_call = []
+
+    def evaluate(s_now, only_once, arr_label=None):
+        arr_call.append(s_now)
+        arr_msg = [
+                (s_now, stock_code, period, 'msg')
+                for stock_code, period in obj_program.get_task()
+                ]
+        info_state = {
+                'info_last_time_run': {task: s_now for task in obj_program.get_task()},
+                'info_alarm_msg': {},
+                }
+        return arr_msg, info_state
+
+    obj_program.evaluate = evaluate
+    arr_alarm_msg = obj_plan.run('2020-10-14 09:31', False)
+    assert arr_call == ['2020-10-14 09:31']
+    assert sorted(arr_alarm_msg) == [
+            ('2020-10-14 09:31', '000300.XSHG', '1m', 'msg'),
+            ('2020-10-14 09:31', '000905.XSHG', '1m', 'msg'),
+            ]
+    assert len(info_a['arr_alarm_msg']) == 2
+    assert info_b['arr_alarm_msg'] == [('2020-10-14 09:31', '000905.XSHG', '1m', 'msg')]
+    # 结果被接受，运行状态更新
+    assert obj_program.info_last_time_run[('000905.XSHG', '1m')] == '2020-10-14 09:31'
+
+
+def test_compile_keep_state():
+    ''' 重新编译时，已有的分组保留原来的报警程序(运行状态) '''
+    info_a = make_program(['000300.XSHG'], ['1m'], None, 'a')
+    obj_plan = make_plan(info_a)
+    (obj_program,) = obj_plan.info_runner.values()
+    obj_program.info_last_time_run[('000300.XSHG', '1m')] = '2020-10-14 09:31'
+    obj_plan_new = a_s.ExecutionPlan()
+    obj_plan_new.add_program(0, make_program(['000300.XSHG', '000905.XSHG'], ['1m'], None, 'a'))
+    obj_plan_new.compile(obj_plan)
+    assert obj_plan_new.info_runner[('macd_cross', 'null')] is obj_program
+    assert obj_program.info_program['arr_stock_code'] == ['000300.XSHG', '000905.XSHG']
+    assert obj_program.info_last_time_run == {('000300.XSHG', '1m'): '2020-10-14 09:31'}
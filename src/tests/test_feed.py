@@ -0,0 +1,140 @@
+# -*- encoding: utf-8 -*-
+''' 推送行情: QueueFeed ---> push_bar/push_tick ---> 执行相关的报警程序 '''
+
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import alarm_stock as a_s
+import feed
+
+stock_code = '000300.XSHG'
+
+
+class Recorder:
+    ''' 记录数据表的写入 (obj_db、obj_Writer) '''
+
+    def __init__(self):
+        self.arr_kline = []
+        self.n_commit = 0
+
+    def read_db__kline(self, t_name, n_bars=None, end_time=None, start_time=None):
+        raise ValueError(f'{t_name}数据表不存在')
+
+    def save_db__kline(self, df, t_name):
+        self.arr_kline.append((t_name, df))
+
+    def add_kline(self, t_name, df):
+        self.arr_kline.append((t_name, df))
+
+    def commit(self):
+        self.n_commit += 1
+
+
+@pytest.fixture
+def obj_stock():
+    ''' 09:30 ... 09:58 的1m k线，k线周期: 1m, 5m '''
+    index = pd.date_range('2020-10-14 09:30', periods=29, freq='min', name='date')
+    price = np.arange(29, dtype=np.float64) + 100.0
+    df = pd.DataFrame(
+            {'open': price, 'high': price + 1, 'low': price - 1, 'close': price},
+            index=index,
+            )
+    obj = a_s.SingleStockInfo(
+            stock_code, 'test', '1m', Recorder(), None,
+            data_kline={'1m': df}, n_lookback=29,
+            )
+    obj.obj_Writer = Recorder()
+    obj.period_add('5m')
+    return obj
+
+
+@pytest.fixture
+def obj_kline_info(obj_stock):
+    ''' 只有推送行情需要的部分 (不连接数据库、数据源) '''
+    obj = a_s.KlineInfo.__new__(a_s.KlineInfo)
+    obj.lock = threading.RLock()
+    obj.info_stock = {stock_code: obj_stock}
+    obj.obj_Writer = Recorder()
+    obj.thread_feed = None
+    obj.arr_traverse = []
+
+    def traverse_the_alarm_program(only_once, s_now, arr_label):
+        obj.arr_traverse.append((s_now, set(arr_label)))
+        return True
+
+    obj.traverse_the_alarm_program = traverse_the_alarm_program
+    return obj
+
+
+def wait_for(func, timeout=5):
+    ''' 等待推送行情的线程处理 '''
+    t_end = time.time() + timeout
+    while time.time() < t_end:
+        if func():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_push_bar(obj_stock):
+    assert obj_stock.push_bar('2020-10-14 09:59', 1, 2, 0.5, 1.5) == [
+            (stock_code, '1m', pd.Timestamp('2020-10-14 09:59')),
+            (stock_code, '5m', pd.Timestamp('2020-10-14 09:59')),
+            ]
+    assert obj_stock.get_bar('5m').iloc[-1].tolist() == [125.0, 129.0, 0.5, 1.5]
+    # 重复、过时的k线
+    assert obj_stock.push_bar('2020-10-14 09:59', 1, 2, 0.5, 1.5) == []
+    assert obj_stock.push_bar('2020-10-14 10:00', 1, 2, 0.5, 1.5) == [
+            (stock_code, '1m', pd.Timestamp('2020-10-14 10:00')),
+            ]
+    assert [t_name for t_name, _ in obj_stock.obj_Writer.arr_kline] == [
+            f'{stock_code}_today', f'{stock_code}_today',
+            ]
+
+
+def test_push_tick(obj_stock):
+    for s_time, price in (
+            ('09:59:05', 10.0), ('09:59:20', 12.0), ('09:59:40', 9.0),
+            ('09:59:59', 11.0),
+            ):
+        assert obj_stock.push_tick(f'2020-10-14 {s_time}', price) == []
+    # 新的分钟的tick到达，上一分钟的k线结束
+    arr_closed = obj_stock.push_tick('2020-10-14 10:00:01', 20.0)
+    assert (stock_code, '1m', pd.Timestamp('2020-10-14 09:59')) in arr_closed
+    assert obj_stock.get_bar('1m').iloc[-1].tolist() == [10.0, 12.0, 9.0, 11.0]
+    # 没有新的tick，分钟结束时合成
+    assert obj_stock.flush_tick(pd.Timestamp('2020-10-14 10:00:30')) == []
+    assert obj_stock.flush_tick(pd.Timestamp('2020-10-14 10:01:00')) == [
+            (stock_code, '1m', pd.Timestamp('2020-10-14 10:00')),
+            ]
+
+
+def test_queue_feed_trigger(obj_kline_info):
+    ''' 推送的k线结束后，执行相关的报警程序 (运行时间为1m k线的结束时间) '''
+    obj_feed = feed.QueueFeed()
+    arr_alarm = []
+    obj_kline_info.start_feed(obj_feed, lambda: arr_alarm.append(1))
+    try:
+        obj_feed.put_bar(stock_code, '2020-10-14 09:59', 1, 2, 0.5, 1.5)
+        # 不需要的股票代码，忽略
+        obj_feed.put_bar('000905.XSHG', '2020-10-14 09:59', 1, 2, 0.5, 1.5)
+        obj_feed.put_tick(stock_code, '2020-10-14 10:00:10', 3.0)
+        assert wait_for(lambda: obj_kline_info.arr_traverse)
+    finally:
+        obj_kline_info.stop_feed()
+    assert obj_kline_info.arr_traverse[0] == (
+            '2020-10-14 10:00', {(stock_code, '1m'), (stock_code, '5m')},
+            )
+    assert arr_alarm
+    assert obj_kline_info.obj_Writer.n_commit
+
+
+def test_parse_message():
+    with pytest.raises(ValueError):
+        feed.parse_message({'type': 'bar', 'stock_code': stock_code})
+    with pytest.raises(ValueError):
+        feed.parse_message({'type': 'quote', 'stock_code': stock_code, 'date': '2020-10-14'})
@@ -0,0 +1,119 @@
+# -*- encoding: utf-8 -*-
+''' plugins/kernel.py: 批量计算、增量计算与talib的结果一致
+    KDJ在talib中没有对应的指标，只比较批量计算与增量计算。
+'''
+
+import numpy as np
+import pytest
+
+from plugins import kernel
+
+talib = pytest.importorskip('talib')
+
+# 随机序列的长度
+n_size = 300
+# 增量计算: seed()的k线数量，之后逐个update()
+n_seed = 120
+
+
+def assert_close(actual, desired):
+    np.testing.assert_allclose(actual, desired, rtol=1e-9, atol=1e-9)
+
+
+@pytest.fixture
+def bars():
+    ''' 随机的k线 (high, low, close) '''
+    rs = np.random.RandomState(0)
+    close = 10.0 + np.cumsum(rs.randn(n_size) * 0.1)
+    high = close + rs.rand(n_size) * 0.2
+    low = close - rs.rand(n_size) * 0.2
+    return high, low, close
+
+
+def run_stream(obj, *arr):
+    ''' seed()前n_seed个k线，之后逐个update() '''
+    out = obj.seed(*[o[:n_seed] for o in arr])
+    arr_update = [obj.update(*value) for value in zip(*[o[n_seed:] for o in arr])]
+    if isinstance(out, tuple):
+        return tuple(
+                np.concatenate([o, [value[i] for value in arr_update]])
+                for i, o in enumerate(out)
+                )
+    return np.concatenate([out, arr_update])
+
+
+@pytest.mark.parametrize('name, args, func_talib, kernel_class', [
+        ('ema', (30,), talib.EMA, kernel.EMA),
+        ('sma', (30,), talib.SMA, kernel.SMA),
+        ('rsi', (14,), talib.RSI, kernel.RSI),
+        ])
+def test_single_output(bars, name, args, func_talib, kernel_class):
+    _, _, close = bars
+    expected = func_talib(close, *args)
+    assert_close(getattr(kernel, name)(close, *args), expected)
+    assert_close(run_stream(kernel_class(*args), close), expected)
+
+
+def test_macd(bars):
+    _, _, close = bars
+    expected = talib.MACD(close, 12, 26, 9)
+    for actual in (
+            kernel.macd(close, 12, 26, 9),
+            kernel.macd(close, 26, 12, 9),
+            run_stream(kernel.MACD(12, 26, 9), close),
+            ):
+        for o, e in zip(actual, expected):
+            assert_close(o, e)
+
+
+def test_bbands(bars):
+    _, _, close = bars
+    expected = talib.BBANDS(close, 20, 2.0, 2.0, 0)
+    for actual in (
+            kernel.bbands(close, 20, 2.0, 2.0),
+            run_stream(kernel.BBANDS(20, 2.0, 2.0), close),
+            ):
+        for o, e in zip(actual, expected):
+            assert_close(o, e)
+
+
+def test_atr(bars):
+    high, low, close = bars
+    expected = talib.ATR(high, low, close, 14)
+    assert_close(kernel.atr(high, low, close, 14), expected)
+    assert_close(run_stream(kernel.ATR(14), high, low, close), expected)
+
+
+def test_kdj_stream(bars):
+    expected = kernel.kdj(*bars)
+    for o, e in zip(run_stream(kernel.KDJ(), *bars), expected):
+        assert_close(o, e)
+
+
+def test_batch_2d_skip_nan(bars):
+    ''' 2维数组每行单独计算；nan跳过，结果与去除nan的序列相同 '''
+    _, _, close = bars
+    arr = np.vstack([close, close[::-1]])
+    arr[1, 50:60] = np.nan
+    diff, dea, bar = kernel.macd(arr)
+    valid = ~np.isnan(arr[1])
+    for o, e in zip((diff[1], dea[1], bar[1]), talib.MACD(arr[1][valid])):
+        assert_close(o[valid], e)
+        assert np.isnan(o[~valid]).all()
+    assert_close(diff[0], talib.MACD(close)[0])
+
+
+def test_state_restore(bars):
+    ''' get_state() / set_state() 之后，增量计算的结果不变 '''
+    _, _, close = bars
+    obj = kernel.MACD()
+    obj.seed(close[:n_seed])
+    obj_new = kernel.MACD()
+    obj_new.set_state(obj.get_state())
+    for x in close[n_seed:]:
+        assert_close(obj_new.update(x), obj.update(x))
+
+
+def test_kernel_is_abstract():
+    with pytest.raises(TypeError):
+        kernel.Kernel()
@@ -0,0 +1,75 @@
+# -*- encoding: utf-8 -*-
+''' replay.verify: 向量化回放与逐分钟回放的报警信息相同 '''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import alarm_stock as a_s
+import replay
+import trading_calendar
+
+stock_code = '000300.XSHG'
+
+
+@pytest.fixture(scope='module')
+def db_name(tmp_path_factory):
+    ''' 历史数据表{stock_code}_{year}，随机的1m k线 '''
+    db_name = f'sqlite:///{tmp_path_factory.mktemp("replay") / "replay.db"}'
+    obj_db = a_s.DataTable(db_name)
+    obj_calendar = trading_calendar.get_calendar(stock_code)
+    index = obj_calendar.trading_minutes(
+            pd.Timestamp('2019-12-02'), pd.Timestamp('2020-01-10 15:00'),
+            )
+    rs = np.random.RandomState(0)
+    price = 100.0 + np.cumsum(rs.randn(index.size) * 0.1)
+    df = pd.DataFrame(
+            {'open': price, 'high': price + 0.05, 'low': price - 0.05, 'close': price},
+            index=pd.DatetimeIndex(index, name='date'),
+            )
+    obj_db.save_db__batch({
+            f'{stock_code}_{year}': df.loc[df.index.year == year]
+            for year in (2019, 2020)
+            })
+    return db_name
+
+
+@pytest.mark.parametrize('arr_period, other_kwargs', [
+        (['1m', '5m'], None),
+        (['5m'], {'period_long': '30m'}),
+        ])
+def test_verify(db_name, arr_period, other_kwargs):
+    info_program = {
+            'algorithm': 'macd_cross',
+            'arr_stock_code': [stock_code],
+            'arr_period': arr_period,
+            'other_kwargs': other_kwargs,
+            'remark': None,
+            }
+    arr_record, _ = replay.replay_chunk(
+            db_name, info_program, [stock_code], '2020-01-08', '2020-01-09',
+            )
+    assert arr_record
+    arr_only_vector, arr_only_step = replay.verify(
+            'macd_cross', stock_code, arr_period, '2020-01-08', '2020-01-09',
+            other_kwargs, db_name,
+            )
+    assert arr_only_vector == []
+    assert arr_only_step == []
+
+
+def test_verify_report_difference(db_name, monkeypatch):
+    ''' 两种方式的报警信息不同时，返回不同的部分 '''
+    replay_chunk = replay.replay_chunk
+
+    def replay_chunk_drop_first(*args):
+        arr_record, n_bars = replay_chunk(*args)
+        return arr_record[1:], n_bars
+
+    monkeypatch.setattr(replay, 'replay_chunk', replay_chunk_drop_first)
+    arr_only_vector, arr_only_step = replay.verify(
+            'macd_cross', stock_code, ['5m'], '2020-01-08', '2020-01-09',
+            None, db_name,
+            )
+    assert arr_only_vector == []
+    assert len(arr_only_step) == 1
@@ -0,0 +1,434 @@
+# -*- encoding: utf-8 -*-
+''' 交易日历
+交易时段:
+    每个交易市场一张交易时段表 (info_session)，
+    市场由股票代码的后缀决定，例如: 000300.XSHG ---> XSHG
+节假日:
+    本地节假日文件 (settings.f_name_holiday)，每行一个日期，"#"之后为注释。
+        2021-01-01              # 所有市场
+        XSHG 2021-02-11         # 指定市场
+    周六、周日固定休市，不需要写入节假日文件。
+预先计算:
+    交易日序列、每个日期的下一个交易日、一天之内每分钟的交易序号。
+    "下一个开市时间"、"是否交易分钟"的查询为O(1)。
+k线的时间为开始时间:
+    1m的2020-10-10T09:30 对应于 2020-10-10T09:30:00.000 --- 09:30:59.999
+    A股上午的1m数据: 09:30 .. 11:29，下午的1m数据: 13:00 .. 14:59
+'''
+
+import datetime
+import os
+
+import numpy as np
+import pandas as pd
+
+# our apps
+import settings as settings
+
+# 日志
+logger = settings.logging.getLogger(__name__)
+
+# 交易时段表 (开始时间, 结束时间)
+session_a_share = (
+        (datetime.time(9, 30), datetime.time(11, 30)),
+        (datetime.time(13, 0), datetime.time(15, 0)),
+        )
+info_session = {
+        # 上海证券交易所
+        'XSHG': session_a_share,
+        # 深圳证券交易所
+        'XSHE': session_a_share,
+        # 中国金融期货交易所
+        'CCFX': session_a_share,
+        }
+# 一天的分钟数
+n_minute_day = 24 * 60
+# 交易日历的缓存
+info_calendar = {}
+# 节假日的缓存
+info_holiday = None
+
+
+def get_market(stock_code):
+    ''' 股票代码 ---> 交易市场
+        '000300.XSHG'   --->    'XSHG'
+    '''
+    _, _, suffix = stock_code.rpartition('.')
+    if suffix not in info_session:
+        suffix = settings.market_default
+    return suffix
+
+
+def load_holiday(f_name=None):
+    ''' 读取节假日文件
+    返回值: dict
+        {
+                '*': set([datetime.date, ...]),        # 所有市场
+                'XSHG': set([datetime.date, ...]),     # 指定市场
+                ...
+                }
+    '''
+    if f_name is None:
+        f_name = settings.f_name_holiday
+    info = {'*': set()}
+    if not os.path.exists(f_name):
+        logger.warning(f'节假日文件不存在: {f_name}，仅按周末休市处理')
+        return info
+    with open(f_name, encoding='utf-8') as f:
+        for i, line in enumerate(f, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            arr = line.split()
+            if len(arr) == 1:
+                market, s_date = '*', arr[0]
+            else:
+                market, s_date = arr[0], arr[1]
+            try:
+                day = datetime.date.fromisoformat(s_date)
+            except ValueError:
+                logger.error(f'节假日文件格式错误: {f_name}:{i} {line}')
+                continue
+            info.setdefault(market, set()).add(day)
+    return info
+
+
+def get_calendar(str_market):
+    ''' 交易日历 (同一个交易市场，共用一个实例)
+        str_market          交易市场 or 股票代码
+    '''
+    global info_holiday
+    market = get_market(str_market)
+    obj = info_calendar.get(market)
+    if obj is None:
+        if info_holiday is None:
+            info_holiday = load_holiday()
+        set_holiday = info_holiday['*'] | info_holiday.get(market, set())
+        obj = TradingCalendar(market, info_session[market], set_holiday)
+        info_calendar[market] = obj
+    return obj
+
+
+def calc_session(arr_calendar, now, t_extend=datetime.timedelta(0)):
+    ''' 多个交易市场的开市状态
+    入口参数:
+        arr_calendar        交易日历的集合
+        now                 当前时间
+        t_extend            闭市后，继续运行的时间
+    返回值: (market_opening, next_time)
+        market_opening      任一市场在开市期间
+        next_time           最近的下一个开市时间
+    '''
+    market_opening = False
+    next_time = None
+    for obj in arr_calendar:
+        if obj.is_session_time(now, t_extend):
+            market_opening = True
+        t_open = obj.next_session_open(now)
+        if next_time is None or t_open < next_time:
+            next_time = t_open
+    return (market_opening, next_time)
+
+
+class TradingCalendar:
+    ''' 单个交易市场的交易日历
+    arr_minute_index    一天之内每分钟的交易序号，非交易分钟为-1
+        09:30 ---> 0, 09:31 ---> 1, ..., 11:29 ---> 119, 13:00 ---> 120, ...
+    arr_minute_of_day   交易序号 ---> 一天之内的分钟数
+    info_next_day       日期 ---> 下一个交易日
+    '''
+    # 交易市场
+    market = None
+    # 交易时段 ((开始时间, 结束时间), ...)
+    arr_session = None
+    # 交易时段的分钟数 ((开始分钟, 结束分钟), ...)
+    arr_session_minute = None
+    # 节假日
+    set_holiday = None
+    # 一天之内每分钟的交易序号
+    arr_minute_index = None
+    # 交易序号 ---> 一天之内的分钟数
+    arr_minute_of_day = None
+    # 交易日的集合
+    set_trading_day = None
+    # 交易日序列, numpy.datetime64[D]
+    arr_trading_day = None
+    # 日期 ---> 下一个交易日
+    info_next_day = None
+    # 预先计算的年份范围 [year_begin, year_end]
+    year_begin = None
+    year_end = None
+
+    def __init__(self, market, arr_session, set_holiday):
+        self.market = market
+        self.arr_session = arr_session
+        self.set_holiday = set_holiday
+        self.arr_session_minute = tuple(
+                (t_begin.hour * 60 + t_begin.minute,
+                 t_end.hour * 60 + t_end.minute)
+                for t_begin, t_end in arr_session
+                )
+        self.init_minute_table()
+        year = datetime.date.today().year
+        self.init_day_table(year - 2, year + 1)
+
+    def init_minute_table(self):
+        ''' 一天之内每分钟的交易序号 '''
+        self.arr_minute_index = np.full(n_minute_day, -1, dtype=np.int32)
+        arr = []
+        for m_begin, m_end in self.arr_session_minute:
+            arr.extend(range(m_begin, m_end))
+        self.arr_minute_of_day = np.array(arr, dtype=np.int32)
+        self.arr_minute_index[self.arr_minute_of_day] = np.arange(
+                self.arr_minute_of_day.size, dtype=np.int32
+                )
+
+    def init_day_table(self, year_begin, year_end):
+        ''' 交易日序列，每个日期的下一个交易日 '''
+        self.year_begin, self.year_end = year_begin, year_end
+        day = datetime.date(year_begin, 1, 1)
+        # 多算一年，保证年末的日期也有下一个交易日
+        day_end = datetime.date(year_end + 2, 1, 1)
+        one_day = datetime.timedelta(days=1)
+        arr_day = []
+        while day < day_end:
+            if day.weekday() < 5 and day not in self.set_holiday:
+                arr_day.append(day)
+            day += one_day
+        self.set_trading_day = set(arr_day)
+        self.arr_trading_day = np.array(arr_day, dtype='datetime64[D]')
+        self.info_next_day = {}
+        day = datetime.date(year_begin, 1, 1)
+        day_end = datetime.date(year_end + 1, 1, 1)
+        i = 0
+        while day < day_end:
+            while arr_day[i] <= day:
+                i += 1
+            self.info_next_day[day] = arr_day[i]
+            day += one_day
+
+    def check_year(self, day):
+        ''' 日期超出预先计算的范围时，扩展交易日序列 '''
+        if not (self.year_begin <= day.year <= self.year_end):
+            self.init_day_table(
+                    min(self.year_begin, day.year),
+                    max(self.year_end, day.year),
+                    )
+
+    def is_trading_day(self, day):
+        ''' 是否交易日 '''
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        self.check_year(day)
+        return day in self.set_trading_day
+
+    def next_trading_day(self, day):
+        ''' 下一个交易日 (不包含day) '''
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        self.check_year(day)
+        return self.info_next_day[day]
+
+    def prev_trading_day(self, day):
+        ''' 上一个交易日 (不包含day) '''
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        one_day = datetime.timedelta(days=1)
+        day -= one_day
+        while not self.is_trading_day(day):
+            day -= one_day
+        return day
+
+    def next_trading_minute(self, dt):
+        ''' 下一个交易分钟 (k线的开始时间，不包含dt) '''
+        dt = pd.Timestamp(dt).floor('min')
+        if self.is_trading_day(dt):
+            minute = dt.hour * 60 + dt.minute
+            arr = self.arr_minute_of_day
+            i = np.searchsorted(arr, minute, 'right')
+            if i < arr.size:
+                return dt.normalize() + pd.Timedelta(minutes=int(arr[i]))
+        return pd.Timestamp(self.next_session_open(dt.to_pydatetime()))
+
+    def is_trading_minute(self, dt):
+        ''' 是否交易分钟 (k线的开始时间) '''
+        return (
+                self.is_trading_day(dt)
+                and 0 <= self.arr_minute_index[dt.hour * 60 + dt.minute]
+                )
+
+    def is_session_time(self, dt, t_extend=datetime.timedelta(0)):
+        ''' 是否在开市期间 [开始时间, 结束时间 + t_extend] '''
+        if not self.is_trading_day(dt):
+            return False
+        day = datetime.datetime(dt.year, dt.month, dt.day)
+        for m_begin, m_end in self.arr_session_minute:
+            t_begin = day + datetime.timedelta(minutes=m_begin)
+            t_end = day + datetime.timedelta(minutes=m_end) + t_extend
+            if t_begin <= dt <= t_end:
+                return True
+        return False
+
+    def next_session_open(self, dt):
+        ''' 下一个开市时间 (不早于dt) '''
+        day = datetime.datetime(dt.year, dt.month, dt.day)
+        if self.is_trading_day(dt):
+            for m_begin, _ in self.arr_session_minute:
+                t_begin = day + datetime.timedelta(minutes=m_begin)
+                if dt <= t_begin:
+                    return t_begin
+        next_day = self.next_trading_day(dt)
+        m_begin = self.arr_session_minute[0][0]
+        return (
+                datetime.datetime(next_day.year, next_day.month, next_day.day)
+                + datetime.timedelta(minutes=m_begin)
+                )
+
+    def session_close(self, day):
+        ''' 当天的闭市时间 '''
+        if isinstance(day, datetime.datetime):
+            day = day.date()
+        m_end = self.arr_session_minute[-1][1]
+        return (
+                datetime.datetime(day.year, day.month, day.day)
+                + datetime.timedelta(minutes=m_end)
+                )
+
+    def trading_minutes(self, start, end):
+        ''' 时间范围[start, end]内，所有交易分钟 (1m k线的开始时间)
+        返回值: pandas.DatetimeIndex
+        '''
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+        if end < start:
+            return pd.DatetimeIndex([], name='date')
+        self.check_year(start.date())
+        self.check_year(end.date())
+        arr_day = self.arr_trading_day
+        i = np.searchsorted(arr_day, np.datetime64(start.date(), 'D'), 'left')
+        j = np.searchsorted(arr_day, np.datetime64(end.date(), 'D'), 'right')
+        arr_minute = (
+                arr_day[i:j, None].astype('datetime64[m]')
+                + self.arr_minute_of_day[None, :].astype('timedelta64[m]')
+                ).ravel()
+        index = pd.DatetimeIndex(arr_minute, name='date')
+        return index[(start <= index) & (index <= end)]
+
+    def count_trading_minutes(self, start, end):
+        ''' 时间范围[start, end]内，交易分钟的数量 '''
+        return self.trading_minutes(start, end).size
+
+    def group_trading_day(self, arr_day, n):
+        ''' 每n个交易日一组，每年的第一个交易日开始分组 (年末的分组可能不足n个交易日)
+        入口参数:
+            arr_day     日期, numpy.ndarray, datetime64[D]
+            n           每组的交易日数量
+        返回值: (arr_first, arr_last)
+            分组的第一个、最后一个交易日, numpy.ndarray, datetime64[D]
+            非交易日: 原来的日期
+        '''
+        if arr_day.size:
+            self.check_year(pd.Timestamp(arr_day.min()).date())
+            self.check_year(pd.Timestamp(arr_day.max()).date())
+        arr_trading_day = self.arr_trading_day
+        arr_year = arr_day.astype('datetime64[Y]')
+        arr_year_begin = np.searchsorted(
+                arr_trading_day, arr_year.astype('datetime64[D]')
+                )
+        arr_year_end = np.searchsorted(
+                arr_trading_day, (arr_year + 1).astype('datetime64[D]')
+                )
+        n_max = arr_trading_day.size - 1
+        arr_pos = np.minimum(np.searchsorted(arr_trading_day, arr_day), n_max)
+        mask = arr_trading_day[arr_pos] == arr_day
+        arr_pos_first = arr_year_begin + (arr_pos - arr_year_begin) // n * n
+        arr_pos_last = np.minimum(arr_pos_first + n, arr_year_end) - 1
+        arr_first = np.where(
+                mask, arr_trading_day[np.minimum(arr_pos_first, n_max)], arr_day
+                )
+        arr_last = np.where(
+                mask, arr_trading_day[np.minimum(arr_pos_last, n_max)], arr_day
+                )
+        return arr_first, arr_last
+
+    def bin_labels(self, index, obj_PeriodType):
+        ''' k线周期的分组标签 (周期的开始时间)
+            按交易分钟分组，午休不计入k线周期:
+                60m: 09:30, 10:30, 13:00, 14:00
+            日线: 每count个交易日一组(group_trading_day())，标签为第一个交易日
+            非交易分钟的k线，保留原来的时间。
+        入口参数:
+            index               1m k线的时间, pandas.DatetimeIndex
+            obj_PeriodType      k线周期
+        返回值: pandas.DatetimeIndex
+        '''
+        arr_time = index.values.astype('datetime64[m]')
+        arr_day = arr_time.astype('datetime64[D]')
+        if obj_PeriodType.key == 'd':
+            if 1 < obj_PeriodType.count:
+                arr_day, _ = self.group_trading_day(arr_day, obj_PeriodType.count)
+            return pd.DatetimeIndex(arr_day, name=index.name)
+        n = obj_PeriodType.get_minutes()
+        arr_minute = (arr_time - arr_day).astype(np.int64)
+        arr_ordinal = self.arr_minute_index[arr_minute]
+        arr_label = np.maximum(arr_ordinal // n * n, 0)
+        arr_label_minute = np.where(
+                0 <= arr_ordinal, self.arr_minute_of_day[arr_label], arr_minute
+                )
+        arr_label_time = (
+                arr_day.astype('datetime64[m]')
+                + arr_label_minute.astype('timedelta64[m]')
+                )
+        return pd.DatetimeIndex(arr_label_time, name=index.name)
+
+    def bar_close_time(self, index, obj_PeriodType):
+        ''' k线的结束时间 (不包含)
+            分组内最后一个交易分钟 + 1分钟:
+                60m: 10:30 ---> 11:30, 13:00 ---> 14:00
+                d: 当天的闭市时间，多个交易日: 分组的最后一个交易日的闭市时间
+            非交易分钟的k线: 开始时间 + 周期
+        入口参数:
+            index               k线的开始时间(bin_labels()), pandas.DatetimeIndex
+            obj_PeriodType      k线周期
+        返回值: numpy.ndarray, datetime64[m]
+        '''
+        arr_time = index.values.astype('datetime64[m]')
+        arr_day = arr_time.astype('datetime64[D]').astype('datetime64[m]')
+        if obj_PeriodType.key == 'd':
+            if 1 < obj_PeriodType.count:
+                _, arr_last = self.group_trading_day(
+                        arr_time.astype('datetime64[D]'), obj_PeriodType.count
+                        )
+                arr_day = arr_last.astype('datetime64[m]')
+            m_close = int(self.arr_minute_of_day[-1]) + 1
+            return arr_day + np.timedelta64(m_close, 'm')
+        n = obj_PeriodType.get_minutes()
+        n_day = self.arr_minute_of_day.size
+        arr_minute = (arr_time - arr_day).astype(np.int64)
+        arr_ordinal = self.arr_minute_index[arr_minute]
+        arr_last = np.minimum(arr_ordinal // n * n + n, n_day) - 1
+        arr_close_minute = np.where(
+                0 <= arr_ordinal,
+                self.arr_minute_of_day[arr_last] + 1,
+                arr_minute + n,
+                )
+        return arr_day + arr_close_minute.astype('timedelta64[m]')
+
+    def is_bar_closed(self, now, obj_PeriodType):
+        ''' now(分钟的开始)时刻，是否有k线结束
+            now之前的1分钟为交易分钟，并且是k线的最后一分钟。
+        '''
+        last = pd.Timestamp(now).floor('min') - pd.Timedelta(minutes=1)
+        if not self.is_trading_minute(last):
+            return False
+        index = self.bin_labels(pd.DatetimeIndex([last]), obj_PeriodType)
+        arr_close = self.bar_close_time(index, obj_PeriodType)
+        return arr_close[0] == np.datetime64(last, 'm') + np.timedelta64(1, 'm')
+
+    def asof_index(self, index_short, obj_short, index_long, obj_long):
+        ''' 短周期的每个k线，对应的最后一个已结束的长周期k线的序号 (as-of)
+            长周期k线的结束时间 <= 短周期k线的结束时间；没有时为-1。
+        返回值: numpy.ndarray, int64
+        '''
+        arr_short = self.bar_close_time(index_short, obj_short)
+        arr_long = self.bar_close_time(index_long, obj_long)
+        return np.searchsorted(arr_long, arr_short, 'right') - 1